@@ -12,121 +12,149 @@ Main script to run experiments.
 """
 
 import os
+import csv
 import sys
 import json
-import glob
+import time
+import argparse
 
 from tqdm import tqdm
 
 # we assume that the simmc2 data is just outside the current folder (sibling dir)
 sys.path.append('../')
-# imported here to make sure it works, but used in src.evaluation.py
-from simmc2.model.mm_dst.utils.evaluate_dst import evaluate_from_flat_list
-SIMMC2_FOLDER = '../simmc2/data'
+try:
+	# imported here to make sure it works, but src.evaluation.py uses a copy of it in src/evaluate_dst.py
+	from simmc2.model.mm_dst.utils.evaluate_dst import evaluate_from_flat_list
+except ImportError:
+	print('SIMMC2 repository not found next to this one, using the copy of its evaluation script in src/')
 
 from src import *
-from src import evaluation
+from src import alignment, entropy, error_analysis, evaluation, indexing, pipeline, predictions, profiling, registry, spatial, splits, tag_statistics, watch
+from src.pipeline import FileInput
 
-DATA_FOLDER = 'data'
+# known args only, so the script can also be run cell by cell in an interactive console
+parser = argparse.ArgumentParser(description='Run the experiments of the paper')
+parser.add_argument('--simmc2-folder', default='../simmc2/data', help='folder with the SIMMC2 data')
+parser.add_argument('--data-folder', default='data', help='folder with a sub-folder with the output of each model')
+parser.add_argument('--no-cache', action='store_true', help='always recompute all the stages')
+parser.add_argument('--cache-folder', default=pipeline.CACHE_FOLDER, help='folder to cache the stages')
+parser.add_argument('--include', nargs='+', default=None, help='glob patterns of the models to evaluate')
+parser.add_argument('--exclude', nargs='+', default=[], help='glob patterns of the models to skip')
+parser.add_argument('--processes', type=int, default=None, help='processes to parse the model outputs')
+parser.add_argument('--watch', action='store_true', help='keep evaluating new or changed model outputs')
+parser.add_argument('--watch-pattern', default=watch.DEFAULT_PATTERN, help='model output files to watch')
+parser.add_argument('--watch-interval', type=float, default=watch.DEFAULT_INTERVAL, help='seconds between checks')
+parser.add_argument('--results-file', default='results.tsv', help='table where the watch mode appends its results')
+parser.add_argument(
+	'--tagger', default=tagging.DEFAULT_TAGGER, choices=tagging.get_tagger_names(),
+	help='tagger backend of the CEs, see python -m src.tagger_benchmark')
+parser.add_argument(
+	'--check-evaluation', action='store_true',
+	help='also evaluate every split turn by turn with evaluation.evaluate_dataset and check the results are the same')
+parser.add_argument(
+	'--profile', nargs='?', const='profile.json', default=None,
+	help='save the time and memory of each stage as a Chrome trace (default profile.json)')
+args, _ = parser.parse_known_args()
+SIMMC2_FOLDER = args.simmc2_folder
+DATA_FOLDER = args.data_folder
+
+if args.profile:
+	profiling.enable()
+
+# each stage is cached on disk by the hash of its inputs and code, see src/pipeline.py
+experiment_pipeline = pipeline.Pipeline(args.cache_folder, enabled=not args.no_cache)
 #%%
 
 # read original SIMMC 2.0 data
-simmc2_metadata = {}
-for domain in tqdm(['fashion', 'furniture'], desc='Reading Metadata'):
-	with open(os.path.join(SIMMC2_FOLDER, f"{domain}_prefab_metadata_all.json"), 'r') as f_in:
-		simmc2_metadata = {**simmc2_metadata, **json.load(f_in)}
-
-simmc2_scenes_jsons ={}
-_files = glob.glob(f"{SIMMC2_FOLDER}/simmc2_scene_jsons_dstc10_public/*.json")
-for file in tqdm(_files, desc='  JSON scenes'):
-	with open(file, "r") as f_in:
-		simmc2_scenes_jsons[os.path.splitext(os.path.basename(file))[0]] = json.load(f_in)
-
-with open(os.path.join(SIMMC2_FOLDER, 'simmc2_dials_dstc10_devtest.json'), 'r') as f_in:
-	simmc2_dataset = json.load(f_in)
+@pipeline.stage()
+def load_metadata(metadata_files: list) -> dict:
+	simmc2_metadata = {}
+	for file in tqdm(metadata_files, desc='Reading Metadata'):
+		with open(file, 'r') as f_in:
+			simmc2_metadata = {**simmc2_metadata, **json.load(f_in)}
+	return simmc2_metadata
+
+
+@pipeline.stage()
+def load_scenes(scene_files: list) -> dict:
+	simmc2_scenes_jsons = {}
+	for file in tqdm(scene_files, desc='  JSON scenes'):
+		with open(file, "r") as f_in:
+			simmc2_scenes_jsons[os.path.splitext(os.path.basename(file))[0]] = json.load(f_in)
+	profiling.count('scenes loaded', len(scene_files))
+	return simmc2_scenes_jsons
+
+
+@pipeline.stage(iterate_over_dataset_entries, alignment.get_turn_keys)
+def load_turn_keys(dataset_file: str) -> list:
+	with open(dataset_file, 'r') as f_in:
+		return alignment.get_turn_keys(json.load(f_in))
+
+
+simmc2_metadata = experiment_pipeline.run(load_metadata, FileInput(
+	[os.path.join(SIMMC2_FOLDER, f"{domain}_prefab_metadata_all.json") for domain in ['fashion', 'furniture']]))
+simmc2_scenes_jsons = experiment_pipeline.run(
+	load_scenes, FileInput(f"{SIMMC2_FOLDER}/simmc2_scene_jsons_dstc10_public/*.json"))
+simmc2_dataset_file = FileInput(os.path.join(SIMMC2_FOLDER, 'simmc2_dials_dstc10_devtest.json'))
+simmc2_turn_keys = experiment_pipeline.run(load_turn_keys, simmc2_dataset_file)
 #%%
 
 # read model output files
-model_outputs = {}
-
-for subdir, dirs, files in os.walk(DATA_FOLDER):
-	if 'coref-pred-devtest-mini.json' in files:
-		with open(f"{subdir}/coref-pred-devtest-mini.json", 'r') as f_in:
-			model_name = subdir.split('/')[-1]
-			model_outputs[model_name] = json.load(f_in)
-			# make sure that the dialogues have at most 1 turn (it's a specific format from SIMMC2 challenge)
-			for dialogue in model_outputs[model_name]['dialogue_data'][:3]:
-				if len(dialogue['dialogue']) > 1:
-					# we need to fix this dataset!
-					model_outputs[model_name] = fix_prediction_data_format(model_outputs[model_name])
-					break
-
-# sort dictionary by key
-model_outputs = dict(sorted(model_outputs.items(), key=lambda item: item[0]))
-
-# This is another variant of the Baseline GPT-2 from the challenge without the MultiModal help
-del model_outputs['Baseline_GPT2_noMM']
-# We process the output of this model, but Team9 skipped predictions for ambiguous (Before-CR) turns and
-# that needs to be changed in their original code. We left here for comparing All and After-CR turns
-del model_outputs['Team9']
-
-all_models = list(model_outputs.keys())
+@pipeline.stage(registry.parse_model_file, alignment, predictions)
+def load_model_predictions(model_name: str, model_file: str, turn_keys: list) -> tuple:
+	return registry.parse_model_file(model_name, model_file, turn_keys)
+
+
+# models are selected before reading any file, Baseline_GPT2_noMM is another variant of the Baseline GPT-2
+# from the challenge without the MultiModal help. Team9 skipped predictions for ambiguous (Before-CR) turns,
+# so they are missing in the alignment and skipped in the evaluation. A CE is only evaluated if both of its turns
+# have a prediction, so Team9 only has results for All Turns (use alignment.MISSING_EMPTY to count them as empty)
+model_registry = registry.ModelRegistry(
+	DATA_FOLDER, include=args.include, exclude=['Baseline_GPT2_noMM'] + args.exclude)
+model_files = model_registry.discover()     # sorted by model name
+
+all_models = list(model_files.keys())
+model_predictions = {
+	model_name: experiment_pipeline.run(load_model_predictions, model_name, FileInput(model_file), simmc2_turn_keys)
+	for model_name, model_file in model_files.items()}
+
+# parse the models that are not cached yet in parallel
+uncached_models = [x for x in all_models if not experiment_pipeline.is_cached(model_predictions[x])]
+if len(uncached_models) > 0:
+	model_turn_keys = simmc2_turn_keys.value
+	with profiling.stage('parse model files', models=len(uncached_models)):
+		loaded_models = model_registry.load(
+			model_turn_keys, {x: model_files[x] for x in uncached_models}, processes=args.processes)
+	for model_name, loaded_model in loaded_models.items():
+		experiment_pipeline.set_value(model_predictions[model_name], loaded_model)
+
 print(f"Loaded outputs: {all_models}")
+for model_name in all_models:
+	model_alignment = model_predictions[model_name].value[1]
+	if not model_alignment.is_complete or len(model_alignment.extra_turns) > 0:
+		print(f"  {model_alignment}")
+#%%
 
 # do some pre-processing on the original simmc2 data
-last_ambiguous_turn = None
-
-# we can iterate the original data easily, but the model output data is formatted
-# in a slightly different way, so we need the t_index to access the turn
-print('Preprocessing dataset and printing example Clarification Exchanges (CEs)')
-for t_index, simmc2_datum in enumerate(iterate_over_dataset_entries(simmc2_dataset)):
-	simmc2_dialogue, simmc2_turn = simmc2_datum
-	simmc2_turn['model_outputs'] = {}
-	simmc2_turn['scene_idx'], simmc2_turn['previous_scene_idx'] = get_scene_idx(
-		simmc2_dialogue['scene_ids'], simmc2_turn['turn_idx'])
-
-	for model_name, model_output in model_outputs.items():
-		pred_dialogue = model_output['dialogue_data'][t_index]
-		pred_turn = pred_dialogue['dialogue'][0]	# in model outputs, there is at most 1 turn per dialogue
-
-		# check that we are in the same dialogue and turn in all the model outputs
-		assert simmc2_dialogue['dialogue_idx'] == pred_dialogue['dialogue_idx'] \
-		       and simmc2_turn['turn_idx'] == pred_turn['turn_idx'], \
-			f"Model output {model_name} does not match the original SIMMC2 data: " \
-			f"Dialogue {simmc2_dialogue['dialogue_idx']} Turn {simmc2_turn['turn_idx']} " \
-			f"Dialogue {pred_dialogue['dialogue_idx']} Turn {pred_turn['turn_idx']}"
-
-		# add the model output to the turn as 'synced' or joint data
-		simmc2_turn['model_outputs'][model_name] = pred_turn
-
-	# check for Clarification Exchanges
-	if ce.is_ambiguous_turn(simmc2_turn):
-		last_ambiguous_turn = simmc2_dialogue, simmc2_turn
-	elif last_ambiguous_turn is not None:
-		# this is the turn after the CR, make sure they are the same dialogue
-		if last_ambiguous_turn[0]['dialogue_idx'] == simmc2_dialogue['dialogue_idx']:
-			ce.mark_clarification_exchange(
-				ambiguous_turn=last_ambiguous_turn[1], response_turn=simmc2_turn)
-		last_ambiguous_turn = None
-
-# last_ambiguous_turn = None	# reset for new dialogues, probs redundant
+@pipeline.stage(prepare_dataset, iterate_over_dataset_entries, indexing.SceneIndex, ce, tagging, tagging._TAG_KEYWORDS)
+def preprocess_dataset(dataset_file: str, tagger_name: str) -> dict:
+	tagging.set_default_tagger(tagger_name)
+	with open(dataset_file, 'r') as f_in:
+		return prepare_dataset(json.load(f_in))
+
+
+simmc2_dataset = experiment_pipeline.run(preprocess_dataset, simmc2_dataset_file, args.tagger)
 #%%
-# Define dataset splits as filters through the original SIMMC2 data
-all_splits = [
-	('All Turns', None),
-	# ('Unambiguous Turns (All - CR Turns)', lambda x: not ce.is_ce_turn(x)),
-	('CR Turns', lambda x: ce.is_ce_turn(x)),
-	('Individual Property', lambda x: ce.is_tag_in_ce(x, tagging.TAG_INDIVIDUAL_PROPERTY)),
-	('Dialogue History', lambda x: ce.is_tag_in_ce(x, tagging.TAG_DIALOGUE_HISTORY)),
-	('Relational Context', lambda x: ce.is_tag_in_ce(x, tagging.TAG_RELATIONAL_CONTEXT)),
-]
+# Define dataset splits as expressions over the original SIMMC2 data, see src/splits.py to add more,
+# e.g., splits.parse_split('tag:spatial & domain:furniture') or splits.get_tag_combinations()
+all_splits = list(splits.PAPER_SPLITS)
 #%%
 # Create the Evaluation Table 2 from the paper by analysing the data and printing to a LaTex format
 print(f"Evaluation Results Table (Latex)\n{'=' * 24}\n")
 
-def format_row_as_latex(_analysis):
+def format_row_as_latex(_analysis, model_names):
 	final_str = []
-	for _model_name in all_models:
+	for _model_name in model_names:
 		if 'Before-CR' in _analysis:
 			final_str += [
 				f"{format_f1(_analysis['Before-CR'][_model_name]):<14}",
@@ -137,30 +165,255 @@ def format_row_as_latex(_analysis):
 
 	return ' & '.join(final_str) + ' \\\\'
 
-analysis = {}
-for split_name, filter_func in all_splits:
-	if split_name == 'All Turns':
-		# first time! print headers
-		headers = ["\multicolumn{3}{c}{" + x + "}}" for x in all_models]
-		subheaders = ['Before-CR     ', 'After-CR      ', '$\\Delta$  '] * len(all_models)
-		print(' & '.join(['Model' + ' '*15] + [f"{h:<44}" for h in headers]) + ' \\\\')
-		print(f"{' & '.join(['Split' + ' '*15] + subheaders)} \\\\")
-
-	# use the filter func to create a split of the data, then check the results of each model
-	analysis[split_name] = evaluation.evaluate_dataset(simmc2_dataset, filter_func)
-	print(f"{split_name:<20} & {format_row_as_latex(analysis[split_name])}")
+
+def format_evaluation_table(_analysis, model_names) -> str:
+	headers = ["\multicolumn{3}{c}{" + x + "}}" for x in model_names]
+	subheaders = ['Before-CR     ', 'After-CR      ', '$\\Delta$  '] * len(model_names)
+	lines = [
+		' & '.join(['Model' + ' '*15] + [f"{h:<44}" for h in headers]) + ' \\\\',
+		f"{' & '.join(['Split' + ' '*15] + subheaders)} \\\\"]
+	for split_name in _analysis:
+		lines.append(f"{split_name:<20} & {format_row_as_latex(_analysis[split_name], model_names)}")
+	return '\n'.join(lines)
+
+
+# the splits are compiled to masks over an index of the turns, so evaluating a split only sums the object counts
+# of its turns and many splits (e.g., splits.get_tag_combinations()) cost about the same as a few
+dataset_index = indexing.DatasetIndex.from_dataset(simmc2_dataset.value)
+split_masks = splits.compile_splits(dataset_index, all_splits)
+
+
+def evaluate_model(model_name: str, model_prediction) -> dict:
+	# each model is counted on its own, then merged into a single analysis
+	model_counts = {model_name: evaluation.ModelObjectCounts(dataset_index, model_prediction.value[0], model_name)}
+	return {
+		split_name: evaluation.evaluate_model_counts(
+			dataset_index, model_counts, split_masks[split_name], missing_policy=alignment.MISSING_SKIP)
+		for split_name, _ in all_splits}
+
+
+@pipeline.stage(evaluation, evaluation.evaluate_from_flat_list, alignment, ce)
+def evaluate_split(dataset: dict, model_predictions: tuple, filter_func, missing_policy: str) -> dict:
+	# use the filter func to create a split of the data, then check the results of the model
+	return evaluation.evaluate_dataset(
+		dataset, filter_func, missing_policy=missing_policy, predictions=model_predictions[0])
+
+
+def check_model_evaluation(model_name: str, model_prediction, model_analysis: dict) -> list:
+	# evaluates every split turn by turn with the original evaluation script, it should give the same results
+	return [
+		split_name for split_name, filter_func in all_splits
+		if json.dumps(model_analysis[split_name], sort_keys=True, default=float) != json.dumps(experiment_pipeline.run(
+			evaluate_split, simmc2_dataset, model_prediction, filter_func, alignment.MISSING_SKIP).value,
+			sort_keys=True, default=float)]
+
+
+def merge_model_analysis(analysis_by_model: dict) -> dict:
+	_analysis = {}
+	for split_name, _ in all_splits:
+		_analysis[split_name] = {}
+		for model_name, model_analysis in analysis_by_model.items():
+			if 'Before-CR' in model_analysis[split_name]:
+				for part in ['Before-CR', 'After-CR']:
+					_analysis[split_name].setdefault(part, {}).update(model_analysis[split_name][part])
+			else:
+				_analysis[split_name].update(model_analysis[split_name])
+	return _analysis
+
+
+analysis_by_model = {model_name: evaluate_model(model_name, model_predictions[model_name]) for model_name in all_models}
+print(format_evaluation_table(merge_model_analysis(analysis_by_model), all_models))
+if args.check_evaluation:
+	for model_name in all_models:
+		different_splits = check_model_evaluation(model_name, model_predictions[model_name], analysis_by_model[model_name])
+		print(f"{model_name}: {'different results in ' + ', '.join(different_splits) if different_splits else 'same results'} with evaluation.evaluate_dataset")
 #%%
 # Create the Candidate Objects Table from Appendix A.2
 print(f"Candidate Objects Table (Latex)\n{'=' * 23}\n")
 
 headers = ['Split' + ' '*15, 'Mean Candidate Objects Type (SD)  ', 'Mean Candidate Objects Colour (SD)', 'Entries']
 
+# count the candidates of every turn only once, then each split is just a mask over the turns
+@pipeline.stage(evaluation, spatial)
+def count_candidate_objects(
+	dataset: dict, simmc2_metadata: dict, scene_jsons: dict, property_keys: list, spatial_mode: str) -> dict:
+	return evaluation.extract_candidate_object_counts(
+		dataset, simmc2_metadata, scene_jsons, property_keys, spatial_mode=spatial_mode)
+
+
+candidate_counts = experiment_pipeline.run(
+	count_candidate_objects, simmc2_dataset, simmc2_metadata, simmc2_scenes_jsons, ['type', 'color', 'brand'], None).value
+
 for split_name, filter_func in all_splits:
 	if split_name == 'All Turns':
 		# first time! print headers
 		print(f"{' & '.join(headers)} \\\\")
 
-	analysis = evaluation.extract_candidate_objects(simmc2_dataset, simmc2_metadata, simmc2_scenes_jsons, filter_func)
+	analysis = evaluation.summarise_candidate_objects(candidate_counts, split_masks[split_name])
 
 	print(f"{split_name:<20} & {format_mean(analysis['type'])}{' '*23} & {format_mean(analysis['color'])}{' '*23} & {analysis['type']['count']} \\\\")
 # & {format_mean(analysis['brand'])}{' '*22} - used rarely in clarifications, so skipped from table
+#%%
+# Same as the table above, but only counting the candidate objects in the same region of the scene as
+# the targets (left/middle/right, top/bottom), which is closer to how spatial/relational CEs resolve references
+print(f"Spatial Candidate Objects Table (Latex)\n{'=' * 31}\n")
+
+candidate_counts = experiment_pipeline.run(
+	count_candidate_objects, simmc2_dataset, simmc2_metadata, simmc2_scenes_jsons, ['type', 'color'],
+	spatial.SPATIAL_REGION).value
+
+for split_name, filter_func in all_splits:
+	if split_name == 'All Turns':
+		# first time! print headers
+		print(f"{' & '.join(headers)} \\\\")
+
+	analysis = evaluation.summarise_candidate_objects(candidate_counts, split_masks[split_name])
+
+	print(f"{split_name:<20} & {format_mean(analysis['type'])}{' '*23} & {format_mean(analysis['color'])}{' '*23} & {analysis['type']['count']} \\\\")
+
+#%%
+# Frequency of each tag in the utterances of the CEs, the same counts as the simmc2_tags_*.png plots.
+# See src/tag_statistics.py for co-occurrences and F1 by tag pair, in any split
+print(f"Tag Frequencies Table (Latex)\n{'=' * 21}\n")
+
+ce_tag_table = tag_statistics.CETagTable.from_dataset(simmc2_dataset.value)
+tag_frequencies = {role: ce_tag_table.get_frequencies(role) for role in tag_statistics.UTTERANCE_ROLES}
+print(' & '.join(['Tag' + ' '*17] + [f"{x:<21}" for x in tag_statistics.UTTERANCE_ROLES]) + ' \\\\')
+for tag_id, tag in enumerate(ce_tag_table.tag_names):
+	print(' & '.join([f"{tag:<20}"] + [f"{tag_frequencies[x][tag_id]:<21}" for x in tag_statistics.UTTERANCE_ROLES]) + ' \\\\')
+#%%
+# Object F1 of the CR Turns by the domain and type of the objects (e.g., whether models fail more on jackets
+# than on chairs), with the same columns as the evaluation table. Objects are joined with their prefab
+# metadata through an index of the scenes, see evaluation.evaluate_model_attributes for other attributes and splits
+print(f"Object F1 by Attribute Table (Latex)\n{'=' * 28}\n")
+
+scene_object_index = indexing.SceneObjectIndex.from_dataset(
+	simmc2_dataset.value, simmc2_metadata.value, simmc2_scenes_jsons.value)
+model_object_hits = {
+	model_name: evaluation.ModelObjectHits(
+		dataset_index, scene_object_index, model_predictions[model_name].value[0], model_name)
+	for model_name in all_models}
+attribute_analysis = evaluation.evaluate_model_attributes(
+	dataset_index, scene_object_index, model_object_hits, splits.CERole('before').get_mask(dataset_index),
+	attribute_names=['domain', 'type'])
+
+attribute_rows = {}
+for part, part_analysis in attribute_analysis.items():
+	for model_name, model_analysis in part_analysis.items():
+		for attribute, attribute_values in model_analysis.items():
+			for value, results in attribute_values.items():
+				attribute_rows.setdefault(f"{attribute}={value}", {}).setdefault(part, {})[model_name] = results
+for row in attribute_rows.values():
+	for part in attribute_analysis:
+		for model_name in all_models:
+			# no gold or predicted objects with the value
+			row.setdefault(part, {}).setdefault(model_name, evaluation._evaluate_counts(0., 0., 0.))
+print(format_evaluation_table(attribute_rows, all_models))
+#%%
+# Joint entropy of the object scores of the models, the "Joint Entropy (SD)" columns of reported_results.csv.
+# Only models that dump the score of each object have it (see src/entropy.py), the others are nan as in those tables
+print(f"Joint Entropy Table (Latex)\n{'=' * 27}\n")
+
+@pipeline.stage(entropy)
+def load_model_scores(model_file: str, turn_keys: list) -> entropy.ModelObjectScores:
+	return entropy.ModelObjectScores.from_file(model_file, turn_keys)
+
+
+model_entropy = {}
+for model_name, model_file in model_files.items():
+	model_scores = experiment_pipeline.run(load_model_scores, FileInput(model_file), simmc2_turn_keys).value
+	if model_scores.has_scores.any():
+		model_entropy[model_name] = entropy.ModelEntropy(dataset_index, model_scores)
+
+merged_analysis = merge_model_analysis(analysis_by_model)
+entropy_headers = ["\\multicolumn{2}{c}{" + x + "}" for x in all_models]
+print(' & '.join(['Model' + ' '*15] + [f"{h:<29}" for h in entropy_headers]) + ' \\\\')
+print(' & '.join(['Split' + ' '*15] + ['Before-CR     ', 'After-CR      '] * len(all_models)) + ' \\\\')
+for split_name, _ in all_splits:
+	split_analysis = entropy.merge_entropy(merged_analysis[split_name], entropy.evaluate_model_entropy(
+		dataset_index, model_entropy, split_masks[split_name], model_names=all_models))
+	if 'Before-CR' in split_analysis:
+		row = [
+			f"{format_entropy(split_analysis[part][x]):<14}" for x in all_models for part in ['Before-CR', 'After-CR']]
+	else:
+		row = [f"{format_entropy(split_analysis[x]):<14} & {' '*14}" for x in all_models]
+	print(f"{split_name:<20} & {' & '.join(row)} \\\\")
+#%%
+# Error analysis: the CEs of each model with the largest drop in F1 After-CR. See src/error_analysis.py for the
+# worst turns or dialogues of any split, e.g., model_errors.get_top_dialogues(10, split_masks['Relational Context'])
+print(f"Largest Regressions After-CR\n{'=' * 28}\n")
+
+for model_name in all_models:
+	model_errors = error_analysis.ModelErrors(
+		simmc2_dataset.value, dataset_index, model_predictions[model_name].value[0], model_name)
+	print(f"{model_name}:")
+	for turn_error in model_errors.get_top_turns(3, split_masks['CR Turns'], error_analysis.RANKING_REGRESSION):
+		turn_error.pretty_print()
+#%%
+# Clarification chains: CRs answered with another ambiguity, with another CR until the response. The CEs above are
+# the last round of each chain, as in the paper. Here, the object F1 of the chains with 2 rounds or more after
+# each round, against the objects of their first ambiguous turn. See splits.CERounds, e.g., 'rounds>=3'
+print(f"Object F1 After Each Round of the Clarification Chains\n{'=' * 54}\n")
+
+model_round_counts = {
+	model_name: evaluation.ModelRoundCounts(dataset_index, model_predictions[model_name].value[0], model_name)
+	for model_name in all_models}
+chain_mask = splits.parse_split('rounds>=2').get_mask(dataset_index)
+round_analysis = evaluation.evaluate_model_rounds(dataset_index, model_round_counts, chain_mask)
+print(f"{int(chain_mask.sum())} chains with 2 rounds or more")
+print(' & '.join([f"{'Round':<14}"] + [f"{x:<14}" for x in all_models]) + ' \\\\')
+for part, part_analysis in round_analysis.items():
+	print(' & '.join([f"{part:<14}"] + [f"{format_f1(part_analysis[x]):<14}" for x in all_models]) + ' \\\\')
+#%%
+print(experiment_pipeline)
+#%%
+# Watch mode: keep checking the model folders (e.g., while training) and only evaluate the new or changed
+# model outputs. Their results are appended to a table, and the LaTeX table is regenerated from the
+# results of the other models, which are already in memory or cached
+def append_results(output_name: str, model_file: str, model_analysis: dict) -> None:
+	write_header = not os.path.exists(args.results_file)
+	with open(args.results_file, 'a', newline='') as f_out:
+		writer = csv.writer(f_out, delimiter='\t')
+		if write_header:
+			writer.writerow(['time', 'model', 'file', 'split', 'part', 'object_f1', 'object_f1_stderr', 'entries'])
+		for split_name, split_analysis in model_analysis.items():
+			parts = ['Before-CR', 'After-CR'] if 'Before-CR' in split_analysis else [None]
+			for part in parts:
+				results = split_analysis[part][output_name] if part else split_analysis[output_name]
+				writer.writerow([
+					time.strftime('%Y-%m-%d %H:%M:%S'), output_name, model_file, split_name, part or 'All',
+					results['object_f1'], results['object_f1_stderr'], results['entries_evaluated']])
+
+
+def evaluate_changed_files(changed_files: dict) -> None:
+	for output_name, model_file in changed_files.items():
+		print(f"Evaluating {model_file}")
+		try:
+			# the file is parsed lazily when evaluating the model, so any error in it is raised here
+			model_prediction = experiment_pipeline.run(
+				load_model_predictions, output_name, FileInput(model_file), simmc2_turn_keys)
+			model_analysis = evaluate_model(output_name, model_prediction)
+		except Exception as e:      # e.g., not a valid model output, keep watching with the previous results
+			print(f"  Could not evaluate {model_file}: {type(e).__name__}: {e}")
+			continue
+		model_predictions[output_name], analysis_by_model[output_name] = model_prediction, model_analysis
+		append_results(output_name, model_file, analysis_by_model[output_name])
+		if output_name not in all_models:
+			all_models.append(output_name)
+
+	evaluation_table = format_evaluation_table(merge_model_analysis(analysis_by_model), all_models)
+	with open(f"{os.path.splitext(args.results_file)[0]}.tex", 'w') as f_out:
+		f_out.write(evaluation_table + '\n')
+	print(f"Evaluation Results Table (Latex)\n{'=' * 24}\n\n{evaluation_table}")
+	print(experiment_pipeline)
+
+
+if args.watch:
+	model_watcher = watch.PredictionFileWatcher(model_registry, args.watch_pattern, known_files=model_files)
+	print(f"Watching {DATA_FOLDER} for {args.watch_pattern} files every {args.watch_interval}s, Ctrl+C to stop")
+	model_watcher.watch(evaluate_changed_files, args.watch_interval)
+#%%
+if args.profile:
+	profiler = profiling.disable()
+	profiler.save(args.profile)
+	print(f"Profile saved to {args.profile} (open it in chrome://tracing or https://ui.perfetto.dev)\n{profiler.summary()}")
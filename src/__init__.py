@@ -9,22 +9,58 @@
 Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
 """
 
-import copy
+import bisect
+
+import numpy as np
+
+from . import profiling
+from .views import SingleTurnDatasetView
 
 
 def iterate_over_dataset_entries(dataset, limit=None):
+	"""
+	Iterates over all the turns of a dataset, yielding (dialogue, turn). It works the same
+	for the original SIMMC2 data and the model outputs, including those viewed as one
+	turn per dialogue (see fix_prediction_data_format).
+
+	:param dataset: dataset in the same format as SIMMC2, a view over it or a list of (dialogue, turn)
+	:param limit: maximum number of turns to yield, the first ones. See sampling.py for a representative sample
+	:return: generator of (dialogue, turn)
+	"""
 	if isinstance(dataset, list):
 		for x in dataset:
 			yield x
 
 	else:
-		for _dialogue_datum in dataset['dialogue_data']:
-			for _entry_datum in _dialogue_datum['dialogue']:
+		_turns = dataset.iterate_turns() if isinstance(dataset, SingleTurnDatasetView) else (
+			(_dialogue_datum, _entry_datum)
+			for _dialogue_datum in dataset['dialogue_data'] for _entry_datum in _dialogue_datum['dialogue'])
+		turns_scanned = 0
+		try:
+			for _dialogue_datum, _entry_datum in _turns:
 				if limit is not None:
 					limit -= 1
 					if limit < 0:
 						return
+				turns_scanned += 1
 				yield _dialogue_datum, _entry_datum
+		finally:
+			profiling.count('turns scanned', turns_scanned)
+
+
+def get_split_mask(dataset, filter_func=None) -> np.ndarray:
+	"""
+	Creates a boolean mask over the turns of a dataset, in the same order as
+	iterate_over_dataset_entries, with the turns that pass a filter function.
+
+	:param dataset: dataset in the same format as SIMMC2
+	:param filter_func: function that takes a turn and returns True if it is in the split.
+		All turns are in the split if None
+	:return: boolean array with one entry per turn
+	"""
+	return np.array([
+		filter_func is None or bool(filter_func(turn))
+		for _, turn in iterate_over_dataset_entries(dataset)], dtype=bool)
 
 
 def join_dataset_splits(dataset_list: list) -> dict:
@@ -34,31 +70,93 @@ def join_dataset_splits(dataset_list: list) -> dict:
 	return joined_dataset
 
 
-def fix_prediction_data_format(dataset):
-	dialogue_data = []
-	for dialogue_datum, turn in iterate_over_dataset_entries(dataset):
+def fix_prediction_data_format(dataset) -> SingleTurnDatasetView:
+	"""
+	Model outputs in the SIMMC2 challenge format have at most 1 turn per dialogue, but
+	some models output whole dialogues. This returns a view of the model output with one
+	turn per dialogue, where 'pred_objects' defaults to the objects in 'transcript_annotated'.
+	The dialogues are not copied and the original model output is not modified.
 
-		dialogue_data.append(copy.copy(dialogue_datum))
-		if 'pred_objects' not in turn:
-			turn['pred_objects'] = turn['transcript_annotated']['act_attributes']['objects']
-		dialogue_data[-1]['dialogue'] = [turn]
+	:param dataset: the model output, in the same format as SIMMC2
+	:return: view over the model output with one turn per dialogue
+	"""
+	return SingleTurnDatasetView(dataset)
 
-	dataset['dialogue_data'] = dialogue_data
-	return dataset
+
+def get_scene_boundaries(dialogue_scenes: dict) -> tuple:
+	"""
+	Sorts the scenes of a dialogue by the turn where they start.
+
+	:param dialogue_scenes: the 'scene_ids' of a SIMMC2 dialogue, turn index (as str) -> scene id
+	:return: (list of sorted turn indexes, list of scene ids in the same order)
+	"""
+	scene_list = sorted((int(turn_idx), scene_idx) for turn_idx, scene_idx in dialogue_scenes.items())
+	return [x[0] for x in scene_list], [x[1] for x in scene_list]
 
 
 def get_scene_idx(dialogue_scenes: dict, turn_idx: int) -> tuple:
-	# resolve scene id from the dialogue list
-	scene_idx_list = []
-	for scene_id in reversed(list(dialogue_scenes.keys())):
-		if turn_idx >= int(scene_id):
-			scene_idx_list.append(dialogue_scenes[scene_id])
+	"""
+	Resolves the scenes of a turn from the scenes of its dialogue. To resolve all the turns
+	of a dataset, use indexing.SceneIndex instead, which sorts the scenes only once.
+
+	:param dialogue_scenes: the 'scene_ids' of a SIMMC2 dialogue, turn index (as str) -> scene id
+	:param turn_idx: index of the turn in the dialogue
+	:return: (current scene id, previous scene id or None)
+	"""
+	scene_boundaries, scene_ids = get_scene_boundaries(dialogue_scenes)
+	num_scenes = bisect.bisect_right(scene_boundaries, turn_idx)
+	if num_scenes == 0 or num_scenes > 2:
+		raise ValueError(f"Turn {turn_idx} has {num_scenes} scenes, expected 1 or 2")
+
+	# current scene, previous scene
+	return scene_ids[num_scenes - 1], scene_ids[num_scenes - 2] if num_scenes > 1 else None
+
+
+def prepare_dataset(dataset: dict) -> dict:
+	"""
+	Pre-processes the original SIMMC2 data in place: sets the global turn id, the scenes and the domain
+	of every turn, and marks the Clarification Exchanges (CEs), printing some examples.
+
+	CEs with several rounds (a CR answered with another ambiguity) are found as clarification chains,
+	see ce.ClarificationChainDetector. The CE of the paper is the last round of each chain.
+
+	:param dataset: the original SIMMC2 data
+	:return: the same dataset
+	"""
+	chain_detector = ce.ClarificationChainDetector()
+	scene_index = indexing.SceneIndex.from_dataset(dataset)
+
+	print('Preprocessing dataset and printing example Clarification Exchanges (CEs)')
+	for t_index, simmc2_datum in enumerate(iterate_over_dataset_entries(dataset)):
+		simmc2_dialogue, simmc2_turn = simmc2_datum
+		# global turn id, used to get the predictions of the models from their PredictionStore
+		simmc2_turn['turn_id'] = t_index
+		simmc2_turn['scene_idx'], simmc2_turn['previous_scene_idx'] = scene_index.get_scene_idx(t_index)
+		simmc2_turn['domain'] = simmc2_dialogue.get('domain')
+
+		# check for Clarification Exchanges, the turn after the CR marks the CE of the last round of its chain
+		ce_chain = chain_detector.feed(simmc2_dialogue, simmc2_turn, t_index)
+		if ce_chain is not None:
+			profiling.count('CEs marked')
+			if ce_chain.rounds > 1:
+				profiling.count('CE chains with several rounds')
+	chain_detector.close()
+
+	return dataset
 
-	if len(scene_idx_list) == 0 or len(scene_idx_list) > 2:
-		raise ValueError
 
-	# current scene, previous scene, image_name
-	return scene_idx_list[0], scene_idx_list[1] if len(scene_idx_list) > 1 else None
+def get_object_property(object_metadata: dict, property_key):
+	"""
+	Gets a property of an object from its prefab metadata.
+
+	:param object_metadata: the metadata of the object, from the SIMMC2 prefab metadata
+	:param property_key: the property, e.g., 'type', or a tuple of properties
+		for a conjunction, e.g., ('type', 'color')
+	:return: the value of the property, or a tuple of values for a conjunction
+	"""
+	if isinstance(property_key, tuple):
+		return tuple(object_metadata[key] for key in property_key)
+	return object_metadata[property_key]
 
 
 def format_number(float_number, decimals=2, to_percentage=False):
@@ -85,6 +183,10 @@ def format_mean(data):
 	return f"{format_number(data['mean'], 2)} ({format_number(data['std'])})"
 
 
+def format_entropy(data):
+	return f"{format_number(data['joint_entropy'], 2)} ({format_number(data['joint_entropy_sd'], 3)})"
+
+
 def format_delta(data_before, data_after):
 	delta = format_number(data_after['object_f1'] / data_before['object_f1'] - 1, 1, True) if data_before['object_f1'] != 0 else '0'
 	if delta[0] != '-':     # is delta negative? add a plus sign otherwise
@@ -96,3 +198,4 @@ def format_delta(data_before, data_after):
 
 from . import tagging
 from . import ce
+from . import indexing
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Alignment of the model outputs with the turns of the original SIMMC2 data.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import iterate_over_dataset_entries
+from .columnar import ColumnarDataset
+
+
+# what to do with a turn that a model did not predict
+MISSING_SKIP = 'skip'       # do not evaluate the turn for that model
+MISSING_EMPTY = 'empty'     # evaluate the turn as if the model predicted no objects
+MISSING_POLICIES = [MISSING_SKIP, MISSING_EMPTY]
+
+
+class ModelAlignment:
+	"""
+	Alignment between the turns of a model output and the turns of the original data.
+	Turns are identified by their position in iterate_over_dataset_entries (global turn id).
+
+	:param model_name: name of the model
+	:param turn_to_prediction: array with the global turn id of the prediction for each
+		turn of the original data, -1 if the model did not predict that turn
+	:param missing_turns: (dialogue_idx, turn_idx) of the turns of the original data without prediction
+	:param extra_turns: (dialogue_idx, turn_idx) of the predictions that are not in the original
+		data, or that are repeated
+	"""
+
+	def __init__(
+		self, model_name: str, turn_to_prediction: np.ndarray,
+		missing_turns: List[Tuple[int, int]], extra_turns: List[Tuple[int, int]]):
+		self.model_name = model_name
+		self.turn_to_prediction = turn_to_prediction
+		self.missing_turns = missing_turns
+		self.extra_turns = extra_turns
+
+	def __repr__(self) -> str:
+		return f"ModelAlignment({self.model_name}: {self.aligned_count} aligned, " \
+			f"{len(self.missing_turns)} missing, {len(self.extra_turns)} extra)"
+
+	@property
+	def aligned_count(self) -> int:
+		return int(np.count_nonzero(self.turn_to_prediction >= 0))
+
+	@property
+	def is_complete(self) -> bool:
+		"""Whether all the turns of the original data have a prediction, extra predictions are ignored."""
+		return len(self.missing_turns) == 0
+
+
+def get_turn_keys(dataset) -> List[Tuple[int, int]]:
+	"""
+	Gets the (dialogue_idx, turn_idx) of every turn in a dataset, in the
+	same order as iterate_over_dataset_entries.
+
+	:param dataset: dataset in the same format as SIMMC2, or a model output
+	:return: list of (dialogue_idx, turn_idx)
+	"""
+	if isinstance(dataset, ColumnarDataset):
+		return dataset.turn_keys     # from its columns, without going through the turns
+	return [
+		(dialogue_datum['dialogue_idx'], turn_datum['turn_idx'])
+		for dialogue_datum, turn_datum in iterate_over_dataset_entries(dataset)]
+
+
+def align_turn_keys(
+	model_name: str, gold_keys: List[Tuple[int, int]], prediction_keys: List[Tuple[int, int]]) -> ModelAlignment:
+	"""
+	Aligns the turns of a model output with the turns of the original data by their
+	(dialogue_idx, turn_idx), in one pass over each. The order of the predictions
+	does not matter and gaps are recorded instead of raising an error.
+
+	:param model_name: name of the model
+	:param gold_keys: (dialogue_idx, turn_idx) of the original data, see get_turn_keys
+	:param prediction_keys: (dialogue_idx, turn_idx) of the model output, see get_turn_keys
+	:return: alignment of the model output
+	"""
+	prediction_index = {}
+	extra_turns = []
+	for prediction_id, key in enumerate(prediction_keys):
+		if key in prediction_index:
+			extra_turns.append(key)     # repeated prediction, keep the first one
+		else:
+			prediction_index[key] = prediction_id
+
+	turn_to_prediction = np.full(len(gold_keys), -1, dtype=np.int32)
+	missing_turns = []
+	for turn_id, key in enumerate(gold_keys):
+		prediction_id = prediction_index.pop(key, None)
+		if prediction_id is None:
+			missing_turns.append(key)
+		else:
+			turn_to_prediction[turn_id] = prediction_id
+
+	# whatever is left in the index was not in the original data
+	extra_turns.extend(prediction_index.keys())
+
+	return ModelAlignment(model_name, turn_to_prediction, missing_turns, extra_turns)
+
+
+# model outputs shared with the worker processes, set before forking so they are not pickled
+_worker_model_outputs = {}
+
+
+def _align_model_output_worker(model_name: str, gold_keys: List[Tuple[int, int]]) -> ModelAlignment:
+	return align_turn_keys(model_name, gold_keys, get_turn_keys(_worker_model_outputs[model_name]))
+
+
+def align_model_outputs(gold_dataset: dict, model_outputs: dict, processes: int = None) -> Dict[str, ModelAlignment]:
+	"""
+	Aligns the outputs of several models with the original data, see align_turn_keys.
+	Each model is aligned in parallel in a different process if the platform can fork,
+	as the model outputs are then shared with the workers without copying them.
+
+	:param gold_dataset: the original SIMMC2 data
+	:param model_outputs: dict of model name -> model output, in the same format as SIMMC2
+	:param processes: number of worker processes, default is the number of CPUs. Use 1 to align serially
+	:return: dict of model name -> alignment
+	"""
+	global _worker_model_outputs
+	gold_keys = get_turn_keys(gold_dataset)
+
+	if processes == 1 or len(model_outputs) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+		return {
+			model_name: align_turn_keys(model_name, gold_keys, get_turn_keys(model_output))
+			for model_name, model_output in model_outputs.items()}
+
+	_worker_model_outputs = model_outputs
+	try:
+		with ProcessPoolExecutor(
+			max_workers=min(processes or multiprocessing.cpu_count(), len(model_outputs)),
+			mp_context=multiprocessing.get_context('fork')) as executor:
+			futures = {
+				model_name: executor.submit(_align_model_output_worker, model_name, gold_keys)
+				for model_name in model_outputs.keys()}
+			return {model_name: future.result() for model_name, future in futures.items()}
+	finally:
+		_worker_model_outputs = {}
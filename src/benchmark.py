@@ -0,0 +1,203 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Benchmark of each stage of the experiments on synthetic data (see synthetic.py), with the time,
+throughput and memory of each stage compared against a stored baseline to find regressions.
+
+Usage:
+	python -m src.benchmark --scale 1 --save-baseline     # store the baseline of this machine
+	python -m src.benchmark --scale 1                     # compare against it, exits with 1 if slower
+"""
+
+import io
+import os
+import sys
+import glob
+import json
+import tempfile
+import argparse
+import platform
+import contextlib
+
+from . import iterate_over_dataset_entries, prepare_dataset
+from . import alignment, evaluation, profiling, spatial, splits, synthetic, tagging
+from .indexing import DatasetIndex
+from .predictions import PredictionStore, load_model_output
+from .registry import ModelRegistry
+
+
+DEFAULT_BASELINE_FILE = 'benchmark_baseline.json'
+DEFAULT_TOLERANCE = 0.25        # fraction slower (or more memory) than the baseline to be a regression
+MIN_REGRESSION_SECONDS = 0.05   # ignore differences smaller than this, they are noise
+
+BENCHMARK_STAGES = ['load', 'align', 'tag', 'mark CEs', 'evaluate', 'evaluate index', 'candidates']
+
+
+def _load_json(file_path: str):
+	with open(file_path, 'r') as f_in:
+		return json.load(f_in)
+
+
+def _run_stages(simmc2_folder: str, data_folder: str, profiler: profiling.Profiler) -> int:
+	"""Runs each stage once inside the profiler, returns the number of turns."""
+	with profiler.stage('load'):
+		dataset = _load_json(os.path.join(simmc2_folder, synthetic.DATASET_FILE))
+		metadata = {}
+		for domain in synthetic.PREFABS:
+			metadata.update(_load_json(os.path.join(simmc2_folder, f"{domain}_prefab_metadata_all.json")))
+		scene_jsons = {
+			os.path.splitext(os.path.basename(x))[0]: _load_json(x)
+			for x in glob.glob(os.path.join(simmc2_folder, synthetic.SCENES_FOLDER, '*.json'))}
+		model_outputs = {
+			model_name: load_model_output(model_file)
+			for model_name, model_file in ModelRegistry(data_folder).discover().items()}
+
+	with profiler.stage('align'):
+		turn_keys = alignment.get_turn_keys(dataset)
+		model_predictions = PredictionStore(len(turn_keys))
+		for model_name, model_output in model_outputs.items():
+			model_predictions.add_model(
+				model_name, model_output, alignment.align_turn_keys(model_name, turn_keys, alignment.get_turn_keys(model_output)))
+		del model_outputs
+
+	with profiler.stage('tag'):
+		for _, turn in iterate_over_dataset_entries(dataset):
+			tagging.extract_utterance_tags(turn['transcript'], fine_grained=True)
+
+	with profiler.stage('mark CEs'), contextlib.redirect_stdout(io.StringIO()):
+		prepare_dataset(dataset)
+
+	with profiler.stage('evaluate'):
+		for _, filter_func in splits.PAPER_SPLITS:
+			evaluation.evaluate_dataset(dataset, filter_func, predictions=model_predictions)
+
+	with profiler.stage('evaluate index'):
+		dataset_index = DatasetIndex.from_dataset(dataset, splits.PAPER_SPLITS)
+		model_counts = {
+			x: evaluation.ModelObjectCounts(dataset_index, model_predictions, x) for x in model_predictions.model_names}
+		for split_mask in dataset_index.split_masks.values():
+			evaluation.evaluate_model_counts(dataset_index, model_counts, split_mask)
+
+	with profiler.stage('candidates'):
+		evaluation.extract_candidate_object_counts(dataset, metadata, scene_jsons)
+		evaluation.extract_candidate_object_counts(
+			dataset, metadata, scene_jsons, ['type', 'color'], spatial_mode=spatial.SPATIAL_REGION)
+
+	return len(turn_keys)
+
+
+def run_benchmark(simmc2_folder: str, data_folder: str, repeat: int = 1) -> dict:
+	"""
+	Times each stage of the experiments on the data given, see BENCHMARK_STAGES.
+	The time of each stage is the fastest of all the repetitions.
+
+	:param simmc2_folder: folder with the SIMMC2 (or synthetic) data
+	:param data_folder: folder with the model outputs
+	:param repeat: number of times to run all the stages
+	:return: dict with the 'turns', the 'peak_memory_mb' and the results of each stage in 'stages'
+	"""
+	stages, num_turns, peak_memory = {}, 0, 0
+	for _ in range(repeat):
+		profiler = profiling.Profiler(memory_interval=0.01)
+		profiler.start()
+		num_turns = _run_stages(simmc2_folder, data_folder, profiler)
+		profiler.stop()
+
+		for stage_name, (_, wall_time, cpu_time, stage_memory) in profiler.stages.items():
+			if stage_name not in stages or wall_time < stages[stage_name]['wall_s']:
+				stages[stage_name] = {
+					'wall_s': wall_time, 'cpu_s': cpu_time, 'turns_per_s': num_turns / wall_time if wall_time > 0 else 0.,
+					'memory_mb': round(stage_memory / 2 ** 20, 1)}
+		peak_memory = max(peak_memory, profiler.peak_memory)
+
+	return {'turns': num_turns, 'peak_memory_mb': round(peak_memory / 2 ** 20, 1), 'stages': stages}
+
+
+def get_baseline_key(scale: float, num_models: int, seed: int) -> str:
+	"""Benchmarks are only compared with a baseline of the same data and machine."""
+	return f"scale={scale},models={num_models},seed={seed},machine={platform.node()},python={platform.python_version()}"
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+	"""
+	Compares the results of a benchmark with its baseline.
+
+	:param results: results of run_benchmark
+	:param baseline: results of run_benchmark stored before
+	:param tolerance: fraction slower or more memory than the baseline that is a regression
+	:return: list of messages with the regressions found
+	"""
+	regressions = []
+	for stage_name, stage_results in results['stages'].items():
+		if stage_name not in baseline['stages']:
+			continue
+		baseline_wall = baseline['stages'][stage_name]['wall_s']
+		if stage_results['wall_s'] > baseline_wall * (1 + tolerance) and \
+			stage_results['wall_s'] - baseline_wall > MIN_REGRESSION_SECONDS:
+			regressions.append(
+				f"{stage_name}: {stage_results['wall_s']:.3f}s vs {baseline_wall:.3f}s in the baseline "
+				f"({stage_results['wall_s'] / baseline_wall - 1:+.0%})")
+	if results['peak_memory_mb'] > baseline['peak_memory_mb'] * (1 + tolerance):
+		regressions.append(
+			f"peak memory: {results['peak_memory_mb']}MB vs {baseline['peak_memory_mb']}MB in the baseline")
+	return regressions
+
+
+def format_results(results: dict, baseline: dict = None) -> str:
+	"""Formats the results of a benchmark as a table, with the change against the baseline if given."""
+	lines = [f"{'Stage':<16} {'Wall (s)':>10} {'CPU (s)':>10} {'Turns/s':>12} {'Memory (MB)':>12} {'vs baseline':>12}"]
+	for stage_name, x in results['stages'].items():
+		change = ''
+		if baseline is not None and stage_name in baseline['stages']:
+			change = f"{x['wall_s'] / baseline['stages'][stage_name]['wall_s'] - 1:+.0%}"
+		lines.append(
+			f"{stage_name:<16} {x['wall_s']:>10.3f} {x['cpu_s']:>10.3f} {x['turns_per_s']:>12.0f} "
+			f"{x['memory_mb']:>12.1f} {change:>12}")
+	lines.append(f"{results['turns']} turns, peak memory {results['peak_memory_mb']}MB")
+	return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the stages of the experiments on synthetic data')
+	parser.add_argument('--scale', type=float, default=1., help='size of the data compared to the SIMMC2 devtest split')
+	parser.add_argument('--models', type=int, default=3, help='number of model outputs')
+	parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic data')
+	parser.add_argument('--repeat', type=int, default=3, help='times to run each stage, the fastest is kept')
+	parser.add_argument('--output-folder', default=None, help='keep the synthetic data in this folder')
+	parser.add_argument('--baseline-file', default=DEFAULT_BASELINE_FILE, help='file with the stored baselines')
+	parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+	parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed slowdown, e.g., 0.25')
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as temp_folder:
+		output_folder = args.output_folder or temp_folder
+		data_summary = synthetic.write_synthetic_data(output_folder, args.scale, args.models, args.seed)
+		print(f"Benchmarking on {data_summary['turns']} synthetic turns, {args.models} models (scale {args.scale})")
+		benchmark_results = run_benchmark(data_summary['simmc2_folder'], data_summary['data_folder'], args.repeat)
+
+	baselines = _load_json(args.baseline_file) if os.path.exists(args.baseline_file) else {}
+	baseline_key = get_baseline_key(args.scale, args.models, args.seed)
+	stored_baseline = baselines.get(baseline_key)
+	print(format_results(benchmark_results, stored_baseline))
+
+	if args.save_baseline:
+		baselines[baseline_key] = benchmark_results
+		with open(args.baseline_file, 'w') as f_out:
+			json.dump(baselines, f_out, indent=2)
+		print(f"Baseline saved to {args.baseline_file}")
+	elif stored_baseline is None:
+		print(f"No baseline for this configuration in {args.baseline_file}, use --save-baseline to store one")
+	else:
+		found_regressions = find_regressions(benchmark_results, stored_baseline, args.tolerance)
+		for regression in found_regressions:
+			print(f"REGRESSION {regression}")
+		if len(found_regressions) > 0:
+			sys.exit(1)
+		print('No regressions found')
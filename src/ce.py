@@ -9,6 +9,7 @@
 Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
 """
 
+from typing import Optional
 
 from . import tagging
 
@@ -41,9 +42,10 @@ class ClarificationExchange:
 	:param before_cr_datum: the turn of the ambiguity
 	:param after_cr_datum: the turn after the clarification request
 	:param fine_grained_tags: whether to use fine-grained tags or not, default False
+	:param tagger: the tagger backend, default the one set with tagging.set_default_tagger
 	"""
 
-	def __init__(self, before_cr_datum, after_cr_datum, fine_grained_tags=True):
+	def __init__(self, before_cr_datum, after_cr_datum, fine_grained_tags=True, tagger: tagging.Tagger = None):
 		self.before_cr_datum, self.after_cr_datum = before_cr_datum, after_cr_datum
 		self.fine_grained_tags = fine_grained_tags
 		# initial user utterance
@@ -51,7 +53,7 @@ class ClarificationExchange:
 		self.c_request = before_cr_datum['system_transcript']
 		self.c_response = after_cr_datum['transcript']
 		self.resolution = after_cr_datum['system_transcript']
-		self.__extract_ce_tags()
+		self.__extract_ce_tags(tagger or tagging.get_tagger())
 
 		self.pretty_print()
 
@@ -69,14 +71,14 @@ class ClarificationExchange:
 			f"Tags={self.tags}")
 		_print_counter -= 1
 
-	def __extract_ce_tags(self):
+	def __extract_ce_tags(self, tagger: tagging.Tagger):
 		"""Extracts the tags from the utterances and saves them in the CE class"""
 		# we simply extract the tags from as many utterances as wanted
-		self.tags_referential_ambiguity = tagging.extract_utterance_tags(
+		self.tags_referential_ambiguity = tagger.extract_tags(
 			self.referential_ambiguity, fine_grained=self.fine_grained_tags)
-		self.tags_c_request = tagging.extract_utterance_tags(
+		self.tags_c_request = tagger.extract_tags(
 			self.c_request, fine_grained=self.fine_grained_tags)
-		self.tags_c_response = tagging.extract_utterance_tags(
+		self.tags_c_response = tagger.extract_tags(
 			self.c_response, fine_grained=self.fine_grained_tags)
 		# we don't care about the coreference resolution utterance
 
@@ -95,7 +97,7 @@ class ClarificationExchange:
 		return tag in self.tags
 
 
-def mark_clarification_exchange(ambiguous_turn, response_turn) -> None:
+def mark_clarification_exchange(ambiguous_turn, response_turn, tagger: tagging.Tagger = None) -> None:
 	"""
 	Marks a clarification exchange in a turn of the SIMMC2 dataset.
 	Note it does not modify the original data, it simply sets a flag pointing
@@ -103,12 +105,110 @@ def mark_clarification_exchange(ambiguous_turn, response_turn) -> None:
 
 	:param ambiguous_turn: the turn of the ambiguity
 	:param response_turn: the turn after the clarification request
+	:param tagger: the tagger backend, default the one set with tagging.set_default_tagger
 	:return: None
 	"""
 	ambiguous_turn['ce_turn'] = 'before'
 	response_turn['ce_turn'] = 'after'
 	# simple object that makes clearer how CEs are structured in the SIMMC2 dataset
-	ambiguous_turn['ce'] = ClarificationExchange(ambiguous_turn, response_turn)
+	ambiguous_turn['ce'] = ClarificationExchange(ambiguous_turn, response_turn, tagger=tagger)
+
+
+class ClarificationChain:
+	"""
+	Clarification exchange with one or more rounds: the CR of an ambiguous turn can be answered
+	with another ambiguity, which gets another CR, and so on until a response resolves it.
+	The turns of a chain are consecutive in its dialogue, so it is stored as the range of their
+	global turn ids: start is the first ambiguous turn and end is the response. Round k is the
+	CR of the turn start + k - 1, answered in the turn start + k.
+
+	:param start: global turn id of the first ambiguous turn
+	:param end: global turn id of the response, after the last CR
+	:param round_tags: tags of each round (its ambiguity, CR and answer), the last one is the CE of the paper
+	"""
+	__slots__ = ('start', 'end', 'round_tags')
+
+	def __init__(self, start: int, end: int, round_tags: tuple):
+		self.start, self.end, self.round_tags = start, end, round_tags
+
+	def __repr__(self) -> str:
+		return f"ClarificationChain(turns {self.start}-{self.end}, {self.rounds} rounds, tags={list(self.round_tags)})"
+
+	@property
+	def rounds(self) -> int:
+		return self.end - self.start
+
+	def get_round_turn_id(self, k: int) -> int:
+		"""Global turn id of the turn after the k-th CR of the chain, the first ambiguous turn for 0."""
+		if not 0 <= k <= self.rounds:
+			raise ValueError(f"Round {k} is not in a chain of {self.rounds} rounds")
+		return self.start + k
+
+
+class ClarificationChainDetector:
+	"""
+	Detects the clarification chains of a dataset in a single pass over its turns, see prepare_dataset.
+	An ambiguous turn opens a chain, each following ambiguous turn of the same dialogue adds a round,
+	and the first turn that is not ambiguous closes it as the response. Only the chain that is open
+	is kept (its first turn, its dialogue, its last ambiguous turn and the tags of its rounds).
+
+	When a chain closes, the CE of its last round (the last ambiguous turn and the response) is
+	marked as in the paper (see mark_clarification_exchange), and the chain is set in its first
+	turn as 'ce_chain'. Chains still open at the end of their dialogue have no response and are dropped.
+
+	:param tagger: the tagger backend of the rounds, default the one set with tagging.set_default_tagger
+	"""
+
+	def __init__(self, tagger: tagging.Tagger = None):
+		self.tagger = tagger
+		self.chains_dropped = 0
+		# (dialogue, first ambiguous turn, its global turn id, last ambiguous turn, tags of the previous rounds)
+		self._open_chain = None
+
+	def feed(self, dialogue_datum: dict, turn_datum: dict, turn_id: int) -> Optional[ClarificationChain]:
+		"""
+		Processes the next turn of the dataset.
+
+		:param dialogue_datum: dialogue of the turn
+		:param turn_datum: the turn
+		:param turn_id: global turn id of the turn
+		:return: the chain closed by this turn, if any
+		"""
+		if self._open_chain is not None and self._open_chain[0] is not dialogue_datum:
+			self.close()    # the dialogue ended before the response
+
+		if is_ambiguous_turn(turn_datum):
+			if self._open_chain is None:
+				self._open_chain = (dialogue_datum, turn_datum, turn_id, turn_datum, ())
+			else:
+				# the CR of the last ambiguous turn was answered with another ambiguity, one more round
+				_, first_turn, start, last_turn, round_tags = self._open_chain
+				self._open_chain = (
+					dialogue_datum, first_turn, start, turn_datum, round_tags + (self._get_round_tags(last_turn, turn_datum),))
+			return None
+
+		if self._open_chain is None:
+			return None
+		_, first_turn, start, last_turn, round_tags = self._open_chain
+		self._open_chain = None
+		mark_clarification_exchange(last_turn, turn_datum, self.tagger)
+		first_turn['ce_chain'] = ClarificationChain(start, turn_id, round_tags + (last_turn['ce'].tags,))
+		return first_turn['ce_chain']
+
+	def close(self) -> None:
+		"""Drops the chain that is open, e.g., at the end of the data."""
+		if self._open_chain is not None:
+			self.chains_dropped += 1
+			self._open_chain = None
+
+	def _get_round_tags(self, ambiguous_turn: dict, answer_turn: dict) -> list:
+		# same tags as ClarificationExchange, for a round that is not the last one
+		tagger = self.tagger or tagging.get_tagger()
+		tags = tagging.sort_tags([
+			tag for utterance in (
+				ambiguous_turn['transcript'], ambiguous_turn['system_transcript'], answer_turn['transcript'])
+			for tag in tagger.extract_tags(utterance, fine_grained=True)])
+		return tags or [tagging.TAG_OTHER]
 
 
 def is_ce_turn(entry_datum: dict) -> bool:
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Columnar format of the SIMMC2 data and the model outputs, to open them without parsing JSON. A dataset is
+a folder with one .npy file per column (memory-mapped when opened) and a meta.json file:
+	- dialogues: dialogue_idx, domain (index into the domain names) and the turns of each dialogue in
+		dialogue_indptr, their scenes (scene_ids) in CSR style in scene_indptr, scene_turn and scene_name
+	- turns: turn_idx, disambiguation_label (-1 if not set), the objects of 'transcript_annotated' in CSR
+		style (object_indptr and object_indices), and the transcripts as UTF-8 in a string arena
+		(text_arena) with the offsets of each turn (transcript_offsets and system_transcript_offsets)
+	- model outputs: the predicted objects of each turn in CSR style (pred_indptr and pred_indices) and
+		whether the turn has them (has_pred_objects)
+
+Only these fields are kept, which are the ones used in the evaluation. ColumnarDataset reads the folder as
+the original data: dialogues and turns are views over the columns, so iterate_over_dataset_entries,
+prepare_dataset and evaluate_dataset work on it directly. Values set on the turns (e.g., the CEs) are kept
+in the views, not in the files.
+
+Usage:
+	python -m src.columnar ../simmc2/data/simmc2_dials_dstc10_devtest.json data/Team9/coref-pred-devtest-mini.json
+"""
+
+import os
+import json
+import time
+import argparse
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+COLUMNAR_SUFFIX = '.columnar'
+
+_TRANSCRIPT_KEYS = ['transcript', 'system_transcript']
+_DELETED = object()     # marks the keys deleted from a view that are still in the columns
+
+
+def get_columnar_path(file_path: str) -> str:
+	"""Default folder of the columnar version of a JSON file, e.g., devtest.json -> devtest.columnar."""
+	return os.path.splitext(file_path)[0] + COLUMNAR_SUFFIX
+
+
+def is_columnar(path: str) -> bool:
+	"""Whether a path is a folder in the columnar format."""
+	return os.path.isfile(os.path.join(path, META_FILE))
+
+
+def _get_indptr(lists: list) -> np.ndarray:
+	indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+	np.cumsum([len(x) for x in lists], out=indptr[1:])
+	return indptr
+
+
+def _get_csr(lists: list, dtype) -> tuple:
+	indptr = _get_indptr(lists)
+	return indptr, np.fromiter((y for x in lists for y in x), dtype=dtype, count=int(indptr[-1]))
+
+
+def write_columnar(dataset: dict, folder: str) -> dict:
+	"""
+	Writes a dataset in the columnar format, see the module docstring. The transcripts and predicted objects
+	are only written if some turn has them, so model outputs do not have empty transcripts.
+
+	:param dataset: the original SIMMC2 data or a model output, as loaded from its JSON file
+	:param folder: folder of the columnar dataset, created if needed
+	:return: the meta data of the dataset
+	"""
+	dialogues = dataset['dialogue_data']
+	turns = [turn_datum for dialogue_datum in dialogues for turn_datum in dialogue_datum['dialogue']]
+	domain_codes, scene_codes = {}, {}
+	scene_ids = [list(x.get('scene_ids', {}).items()) for x in dialogues]
+
+	columns = {
+		'dialogue_idx': np.array([x['dialogue_idx'] for x in dialogues], dtype=np.int64),
+		'domain': np.array([
+			domain_codes.setdefault(x['domain'], len(domain_codes)) if x.get('domain') is not None else -1
+			for x in dialogues], dtype=np.int16),
+		'dialogue_indptr': _get_indptr([x['dialogue'] for x in dialogues]),
+		'scene_indptr': _get_indptr(scene_ids),
+		'scene_turn': np.array([int(turn) for x in scene_ids for turn, _ in x], dtype=np.int32),
+		'scene_name': np.array([
+			scene_codes.setdefault(scene, len(scene_codes)) for x in scene_ids for _, scene in x], dtype=np.int32),
+		'turn_idx': np.array([x['turn_idx'] for x in turns], dtype=np.int32),
+		'disambiguation_label': np.array([x.get('disambiguation_label', -1) for x in turns], dtype=np.int8),
+	}
+	columns['object_indptr'], columns['object_indices'] = _get_csr(
+		[x['transcript_annotated']['act_attributes']['objects'] for x in turns], np.int32)
+
+	transcript_keys = [key for key in _TRANSCRIPT_KEYS if any(key in x for x in turns)]
+	if len(transcript_keys) > 0:
+		# all the transcripts in one arena, the offsets of each key index into it
+		texts = [x.get(key, '').encode('utf-8') for key in transcript_keys for x in turns]
+		text_offsets = _get_indptr(texts)
+		columns['text_arena'] = np.frombuffer(b''.join(texts), dtype=np.uint8)
+		for i, key in enumerate(transcript_keys):
+			columns[f"{key}_offsets"] = text_offsets[i * len(turns):(i + 1) * len(turns) + 1]
+
+	if any(x.get('pred_objects') is not None for x in turns):
+		columns['has_pred_objects'] = np.array([x.get('pred_objects') is not None for x in turns], dtype=bool)
+		columns['pred_indptr'], columns['pred_indices'] = _get_csr(
+			[x.get('pred_objects') or [] for x in turns], np.int32)
+
+	os.makedirs(folder, exist_ok=True)
+	for column_name, values in columns.items():
+		np.save(os.path.join(folder, f"{column_name}.npy"), values)
+	meta = {
+		'format_version': FORMAT_VERSION, 'num_dialogues': len(dialogues), 'num_turns': len(turns),
+		'columns': list(columns), 'transcript_keys': transcript_keys,
+		'domain_names': list(domain_codes), 'scene_names': list(scene_codes)}
+	with open(os.path.join(folder, META_FILE), 'w') as f_out:
+		json.dump(meta, f_out)
+	return meta
+
+
+class _ColumnarView(MutableMapping):
+	"""
+	Base of the dialogue and turn views: values are read from the columns of the dataset,
+	and values set on the view are kept in the view, on top of the columns.
+	"""
+	__slots__ = ('_dataset', '_row', '_values')
+
+	def __init__(self, dataset: 'ColumnarDataset', row: int):
+		self._dataset, self._row, self._values = dataset, row, None
+
+	def _get_column_keys(self) -> list:
+		raise NotImplementedError
+
+	def _get_column_value(self, key):
+		# raises KeyError if the key is not in the columns of this row
+		raise NotImplementedError
+
+	def __getitem__(self, key):
+		if self._values is not None and key in self._values:
+			if self._values[key] is _DELETED:
+				raise KeyError(key)
+			return self._values[key]
+		return self._get_column_value(key)
+
+	def __setitem__(self, key, value):
+		if self._values is None:
+			self._values = {}
+		self._values[key] = value
+
+	def __delitem__(self, key):
+		self[key]   # raises KeyError if it is not there
+		self[key] = _DELETED
+
+	def __iter__(self):
+		values = self._values or {}
+		yield from (x for x in self._get_column_keys() if x not in values)
+		yield from (x for x, value in values.items() if value is not _DELETED)
+
+	def __len__(self) -> int:
+		return sum(1 for _ in self)
+
+	def __repr__(self) -> str:
+		return repr(dict(self))
+
+
+class ColumnarTurn(_ColumnarView):
+	"""View over a turn of a ColumnarDataset, with the same keys as the turn in the JSON file."""
+	__slots__ = ()
+
+	def _get_column_keys(self) -> list:
+		return self._dataset.get_turn_keys(self._row)
+
+	def _get_column_value(self, key):
+		return self._dataset.get_turn_value(self._row, key)
+
+
+class ColumnarDialogue(_ColumnarView):
+	"""View over a dialogue of a ColumnarDataset, its 'dialogue' is the list of its turn views."""
+	__slots__ = ('turns',)
+
+	def __init__(self, dataset: 'ColumnarDataset', row: int, turns: list):
+		super().__init__(dataset, row)
+		self.turns = turns
+
+	def _get_column_keys(self) -> list:
+		return self._dataset.get_dialogue_keys(self._row)
+
+	def _get_column_value(self, key):
+		if key == 'dialogue':
+			return self.turns
+		return self._dataset.get_dialogue_value(self._row, key)
+
+
+class ColumnarDataset(Mapping):
+	"""
+	Dataset in the columnar format, read in the same format as SIMMC2 (see the module docstring).
+	Opening it only reads meta.json and memory-maps the columns. The dialogue and turn views are
+	created the first time 'dialogue_data' is accessed, and kept so the values set on them persist.
+
+	:param folder: folder of the columnar dataset, see write_columnar
+	"""
+
+	def __init__(self, folder: str):
+		with open(os.path.join(folder, META_FILE), 'r') as f_in:
+			self.meta = json.load(f_in)
+		if self.meta['format_version'] != FORMAT_VERSION:
+			raise ValueError(f"Columnar format version {self.meta['format_version']} in {folder}, expected {FORMAT_VERSION}")
+		self.folder = folder
+		# plain arrays over the memory maps, which are faster to index than np.memmap
+		self.columns = {
+			x: np.asarray(np.load(os.path.join(folder, f"{x}.npy"), mmap_mode='r')) for x in self.meta['columns']}
+		self.has_predictions = 'pred_indptr' in self.columns
+		self._dialogue_data = None
+
+	def __repr__(self) -> str:
+		return f"ColumnarDataset({self.meta['num_dialogues']} dialogues, {self.meta['num_turns']} turns, {self.folder})"
+
+	def __getitem__(self, key):
+		if key == 'dialogue_data':
+			return self.dialogue_data
+		raise KeyError(key)
+
+	def __iter__(self):
+		yield 'dialogue_data'
+
+	def __len__(self) -> int:
+		return 1
+
+	@property
+	def dialogue_data(self) -> list:
+		if self._dialogue_data is None:
+			dialogue_indptr = self.columns['dialogue_indptr'].tolist()
+			self._dialogue_data = [
+				ColumnarDialogue(self, i, [ColumnarTurn(self, x) for x in range(dialogue_indptr[i], dialogue_indptr[i + 1])])
+				for i in range(self.meta['num_dialogues'])]
+		return self._dialogue_data
+
+	@property
+	def turn_keys(self) -> list:
+		"""(dialogue_idx, turn_idx) of every turn, from the columns, see alignment.get_turn_keys."""
+		dialogue_idx = np.repeat(self.columns['dialogue_idx'], np.diff(self.columns['dialogue_indptr']))
+		return list(zip(dialogue_idx.tolist(), self.columns['turn_idx'].tolist()))
+
+	def get_prediction_arrays(self) -> tuple:
+		"""
+		Gets the predicted objects of every turn of a model output, in the order of the turns.
+
+		:return: (pred_indptr, pred_indices, has_pred_objects)
+		"""
+		if not self.has_predictions:
+			raise ValueError(f"{self.folder} has no predicted objects")
+		return self.columns['pred_indptr'], self.columns['pred_indices'], self.columns['has_pred_objects']
+
+	def get_dialogue_keys(self, row: int) -> list:
+		keys = ['dialogue_idx', 'dialogue']
+		if self.columns['domain'][row] >= 0:
+			keys.append('domain')
+		if self.columns['scene_indptr'][row + 1] > self.columns['scene_indptr'][row]:
+			keys.append('scene_ids')
+		return keys
+
+	def get_dialogue_value(self, row: int, key: str):
+		if key == 'dialogue_idx':
+			return int(self.columns['dialogue_idx'][row])
+		if key == 'domain' and self.columns['domain'][row] >= 0:
+			return self.meta['domain_names'][self.columns['domain'][row]]
+		if key == 'scene_ids' and self.columns['scene_indptr'][row + 1] > self.columns['scene_indptr'][row]:
+			scenes = slice(self.columns['scene_indptr'][row], self.columns['scene_indptr'][row + 1])
+			return {
+				str(turn): self.meta['scene_names'][scene]
+				for turn, scene in zip(self.columns['scene_turn'][scenes].tolist(), self.columns['scene_name'][scenes].tolist())}
+		raise KeyError(key)
+
+	def get_turn_keys(self, row: int) -> list:
+		keys = ['turn_idx', *self.meta['transcript_keys'], 'transcript_annotated']
+		if self.columns['disambiguation_label'][row] >= 0:
+			keys.append('disambiguation_label')
+		if self.has_predictions and self.columns['has_pred_objects'][row]:
+			keys.append('pred_objects')
+		return keys
+
+	def get_turn_value(self, row: int, key: str):
+		if key == 'turn_idx':
+			return int(self.columns['turn_idx'][row])
+		if key == 'disambiguation_label' and self.columns['disambiguation_label'][row] >= 0:
+			return int(self.columns['disambiguation_label'][row])
+		if key in self.meta['transcript_keys']:
+			offsets = self.columns[f"{key}_offsets"]
+			return self.columns['text_arena'][offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+		if key == 'transcript_annotated':
+			objects = self.columns['object_indices'][self.columns['object_indptr'][row]:self.columns['object_indptr'][row + 1]]
+			return {'act_attributes': {'objects': objects.tolist()}}
+		if key == 'pred_objects' and self.has_predictions and self.columns['has_pred_objects'][row]:
+			return self.columns['pred_indices'][self.columns['pred_indptr'][row]:self.columns['pred_indptr'][row + 1]].tolist()
+		raise KeyError(key)
+
+
+def load_dataset(path: str):
+	"""
+	Loads a dataset from its JSON file or from its columnar folder.
+
+	:param path: path to the JSON file or the columnar folder
+	:return: the dataset, a ColumnarDataset for columnar folders
+	"""
+	if is_columnar(path):
+		return ColumnarDataset(path)
+	with open(path, 'r') as f_in:
+		return json.load(f_in)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Convert SIMMC2 data and model outputs to the columnar format')
+	parser.add_argument('files', nargs='+', help='JSON files to convert, e.g., the SIMMC2 dialogues and model outputs')
+	parser.add_argument('--output', default=None, help=f'columnar folder, default the file with {COLUMNAR_SUFFIX}. Only for one file')
+	args = parser.parse_args()
+	if args.output is not None and len(args.files) > 1:
+		parser.error('--output can only be used with one file')
+
+	for json_file in args.files:
+		columnar_folder = args.output or get_columnar_path(json_file)
+		start_time = time.perf_counter()
+		write_columnar(load_dataset(json_file), columnar_folder)
+		convert_time = time.perf_counter() - start_time
+
+		start_time = time.perf_counter()
+		load_dataset(json_file)
+		json_time = time.perf_counter() - start_time
+		start_time = time.perf_counter()
+		load_dataset(columnar_folder)
+		columnar_time = time.perf_counter() - start_time
+		print(
+			f"{json_file} -> {columnar_folder} in {convert_time:.2f}s, "
+			f"load {json_time * 1000:.1f}ms (JSON) vs {columnar_time * 1000:.1f}ms (columnar)")
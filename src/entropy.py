@@ -0,0 +1,248 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Joint entropy of the object predictions of a model, the "Joint Entropy (SD)" columns of the
+reported_results.csv files. Models that score each object of the scene (e.g., the probability that it
+is referred to) can dump the scores of each turn, either in their prediction file or in a separate file:
+	- prediction file: each turn has 'pred_object_scores', e.g., {"12": 0.93, "40": 0.02} or [[12, 0.93], [40, 0.02]]
+	- score dump (.jsonl): one line per turn, {"dialogue_idx": 1, "turn_idx": 0, "pred_object_scores": {...}}
+
+Each object is a binary choice (referred to or not), so the joint entropy of a turn is the sum of the
+binary entropy (in bits) of all its objects. It is computed for all the turns at once over the scores in
+CSR style (or padded), and summarised as mean and SD by split, Before-CR and After-CR. Models without
+scores get NaN, as in the reported tables.
+"""
+
+import json
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from . import iterate_over_dataset_entries
+from .indexing import DatasetIndex, CE_ROLE_BEFORE
+from .predictions import load_model_output
+
+
+SCORE_KEY = 'pred_object_scores'
+
+
+def iterate_score_dump(file_path: str, score_key: str = SCORE_KEY) -> Iterator[tuple]:
+	"""
+	Streams the object scores of each turn from a score dump (.jsonl, read line by line) or a prediction
+	file (.json, the turns with scores). Turns without scores are skipped.
+
+	:param file_path: path to the file
+	:param score_key: key with the scores of each turn
+	:return: iterator of (dialogue_idx, turn_idx, object indexes, scores)
+	"""
+	def _get_objects_scores(turn_scores):
+		if isinstance(turn_scores, dict):
+			return [int(x) for x in turn_scores.keys()], list(turn_scores.values())
+		return [int(x) for x, _ in turn_scores], [score for _, score in turn_scores]
+
+	if file_path.endswith('.jsonl'):
+		with open(file_path, 'r') as f_in:
+			for line in f_in:
+				if line.strip():
+					turn_datum = json.loads(line)
+					if turn_datum.get(score_key) is not None:
+						yield (turn_datum['dialogue_idx'], turn_datum['turn_idx'], *_get_objects_scores(turn_datum[score_key]))
+	else:
+		for dialogue_datum, turn_datum in iterate_over_dataset_entries(load_model_output(file_path)):
+			if turn_datum.get(score_key) is not None:
+				yield (dialogue_datum['dialogue_idx'], turn_datum['turn_idx'], *_get_objects_scores(turn_datum[score_key]))
+
+
+class ModelObjectScores:
+	"""
+	Object scores of every turn for a model, in CSR style over the global turn ids: the scores
+	of the turn t are scores[indptr[t]:indptr[t + 1]], for the objects in indices. Turns
+	without scores have has_scores False, and a model without any scores has none set.
+
+	Build it with ModelObjectScores.from_file.
+	"""
+	__slots__ = ('indptr', 'indices', 'scores', 'has_scores')
+
+	def __init__(self, indptr: np.ndarray, indices: np.ndarray, scores: np.ndarray, has_scores: np.ndarray):
+		self.indptr, self.indices, self.scores, self.has_scores = indptr, indices, scores, has_scores
+
+	def __repr__(self) -> str:
+		return f"ModelObjectScores({int(np.count_nonzero(self.has_scores))}/{len(self.has_scores)} turns with scores)"
+
+	@classmethod
+	def from_file(
+		cls, file_path: str, turn_keys: List[Tuple[int, int]], score_key: str = SCORE_KEY,
+		from_logits: bool = False) -> 'ModelObjectScores':
+		"""
+		Loads the scores of a model, see iterate_score_dump. Turns not in the original data are ignored,
+		and repeated turns keep their first scores, as alignment.align_turn_keys.
+
+		:param file_path: path to the score dump or prediction file
+		:param turn_keys: (dialogue_idx, turn_idx) of the original data, see alignment.get_turn_keys
+		:param score_key: key with the scores of each turn
+		:param from_logits: whether the scores are logits, otherwise they are probabilities
+		:return: the scores
+		"""
+		turn_ids = {key: turn_id for turn_id, key in enumerate(turn_keys)}
+		lengths = np.zeros(len(turn_keys), dtype=np.int64)
+		has_scores = np.zeros(len(turn_keys), dtype=bool)
+		row_turns, indices, scores = [], [], []
+		for dialogue_idx, turn_idx, objects, object_scores in iterate_score_dump(file_path, score_key):
+			turn_id = turn_ids.get((dialogue_idx, turn_idx))
+			if turn_id is None or has_scores[turn_id]:
+				continue
+			has_scores[turn_id] = True
+			lengths[turn_id] = len(objects)
+			row_turns.append(turn_id)
+			indices.append(objects)
+			scores.append(object_scores)
+
+		# rows are in the order of the file, sort them by global turn id
+		row_order = np.argsort(row_turns, kind='stable')
+		indptr = np.zeros(len(turn_keys) + 1, dtype=np.int64)
+		np.cumsum(lengths, out=indptr[1:])
+		scores = np.array([x for i in row_order for x in scores[i]], dtype=np.float64)
+		if from_logits:
+			# sigmoid, without overflowing for large negative logits
+			scores = np.exp(-np.logaddexp(0., -scores))
+		return cls(
+			indptr, np.array([x for i in row_order for x in indices[i]], dtype=np.int32), scores, has_scores)
+
+
+def binary_entropy(probabilities: np.ndarray) -> np.ndarray:
+	"""
+	Entropy in bits of binary choices with the given probabilities, 0 for probabilities of 0 or 1.
+
+	:param probabilities: array of probabilities, clipped to [0, 1]
+	:return: array with the entropy of each probability
+	"""
+	p = np.clip(probabilities, 0., 1.)
+	q = 1. - p
+	return -(
+		p * np.log2(p, out=np.zeros_like(p), where=p > 0) + q * np.log2(q, out=np.zeros_like(q), where=q > 0))
+
+
+def get_joint_entropy(indptr: np.ndarray, probabilities: np.ndarray) -> np.ndarray:
+	"""
+	Gets the joint entropy of the objects of every turn, from their probabilities in CSR style.
+	The objects are independent, so it is the sum of their binary entropies.
+
+	:param indptr: offsets of the objects of each turn
+	:param probabilities: probabilities of the objects of all the turns
+	:return: array with the joint entropy of each turn, 0 for turns without objects
+	"""
+	rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+	return np.bincount(rows, weights=binary_entropy(probabilities), minlength=len(indptr) - 1)
+
+
+def get_padded_joint_entropy(probabilities: np.ndarray) -> np.ndarray:
+	"""
+	Same as get_joint_entropy, for probabilities padded with NaN to an array of shape (turns, max objects).
+
+	:param probabilities: padded probabilities of the objects of each turn
+	:return: array with the joint entropy of each turn
+	"""
+	return np.where(np.isnan(probabilities), 0., binary_entropy(np.nan_to_num(probabilities))).sum(axis=1)
+
+
+class ModelEntropy:
+	"""
+	Joint entropy of every turn for a model. As in evaluation.ModelObjectCounts, the entropy
+	After-CR is the entropy of the turn after the CR, kept under the turn before the CR.
+
+	:param dataset_index: index of the original data
+	:param model_scores: object scores of the model
+	"""
+	__slots__ = ('entropy', 'has_scores', 'entropy_after_cr', 'has_scores_after_cr')
+
+	def __init__(self, dataset_index: DatasetIndex, model_scores: ModelObjectScores):
+		self.entropy = get_joint_entropy(model_scores.indptr, model_scores.scores)
+		self.has_scores = model_scores.has_scores
+
+		before_cr_turns = np.flatnonzero(dataset_index.ce_after >= 0)
+		after_cr_turns = dataset_index.ce_after[before_cr_turns]
+		self.entropy_after_cr = np.zeros_like(self.entropy)
+		self.entropy_after_cr[before_cr_turns] = self.entropy[after_cr_turns]
+		self.has_scores_after_cr = np.zeros_like(self.has_scores)
+		self.has_scores_after_cr[before_cr_turns] = self.has_scores[after_cr_turns]
+
+
+def summarise_entropy(entropy: np.ndarray, turn_mask: np.ndarray) -> dict:
+	"""
+	Calculates the mean and SD of the joint entropy of some turns.
+
+	:param entropy: joint entropy of every turn
+	:param turn_mask: boolean array with the turns to summarise
+	:return: dict with 'joint_entropy', 'joint_entropy_sd' and 'entropy_entries', NaN if there are no turns
+	"""
+	entropy = entropy[turn_mask]
+	if len(entropy) == 0:
+		return {'joint_entropy': np.nan, 'joint_entropy_sd': np.nan, 'entropy_entries': 0}
+	return {'joint_entropy': float(np.mean(entropy)), 'joint_entropy_sd': float(np.std(entropy)), 'entropy_entries': len(entropy)}
+
+
+def evaluate_model_entropy(
+	dataset_index: DatasetIndex, model_entropy: dict, split_mask: np.ndarray = None, *,
+	model_names: list = None) -> dict:
+	"""
+	Same as evaluation.evaluate_model_counts, but with the mean and SD of the joint entropy of
+	the turns with scores (both turns of the CEs for Before-CR and After-CR). Models without scores
+	(in model_names but not in model_entropy) get NaN.
+
+	:param dataset_index: index of the original data
+	:param model_entropy: dict of model name -> ModelEntropy
+	:param split_mask: boolean array with the turns to evaluate, default all, see get_split_mask
+	:param model_names: all the models to report, default those in model_entropy
+	:return dict: result metrics, split by Before-CR and After-CR if the first turn of the split is the turn before a CR
+	"""
+	if split_mask is None:
+		split_mask = np.ones(len(dataset_index), dtype=bool)
+	model_names = model_names or list(model_entropy.keys())
+	no_turns = np.zeros(len(dataset_index), dtype=bool)
+	split_turns = np.flatnonzero(split_mask)
+	is_ce_split = len(split_turns) > 0 and dataset_index.ce_role[split_turns[0]] == CE_ROLE_BEFORE
+
+	def _evaluate(model_name, after_cr=False):
+		if model_name not in model_entropy:
+			return summarise_entropy(np.zeros(len(dataset_index)), no_turns)
+		x = model_entropy[model_name]
+		if after_cr:
+			return summarise_entropy(x.entropy_after_cr, split_mask & x.has_scores & x.has_scores_after_cr)
+		elif is_ce_split:   # the same CEs Before-CR and After-CR, as evaluation.evaluate_model_counts
+			return summarise_entropy(x.entropy, split_mask & x.has_scores & x.has_scores_after_cr)
+		return summarise_entropy(x.entropy, split_mask & x.has_scores)
+
+	if is_ce_split:
+		return {
+			'Before-CR': {model_name: _evaluate(model_name) for model_name in model_names},
+			'After-CR': {model_name: _evaluate(model_name, after_cr=True) for model_name in model_names},
+		}
+
+	return {model_name: _evaluate(model_name) for model_name in model_names}
+
+
+def merge_entropy(analysis: dict, entropy_analysis: dict) -> dict:
+	"""
+	Adds the joint entropy to the results of a split, next to the object F1 of each model.
+
+	:param analysis: results of a split, see evaluation.evaluate_model_counts
+	:param entropy_analysis: joint entropy of the same split, see evaluate_model_entropy
+	:return: a copy of the analysis with the joint entropy of each model, NaN for the models not in entropy_analysis
+	"""
+	no_entropy = summarise_entropy(np.zeros(0), np.zeros(0, dtype=bool))
+
+	def _merge(part_analysis, part_entropy):
+		return {
+			model_name: {**results, **part_entropy.get(model_name, no_entropy)}
+			for model_name, results in part_analysis.items()}
+
+	if 'Before-CR' in analysis:
+		return {part: _merge(analysis[part], entropy_analysis.get(part, {})) for part in ['Before-CR', 'After-CR']}
+	return _merge(analysis, entropy_analysis)
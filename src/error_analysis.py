@@ -0,0 +1,317 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Error analysis of a model: the worst turns or dialogues of any split, ranked from the object counts of every
+turn (see evaluation.ModelObjectCounts). Only the top K are selected (with a partial sort), and their CE
+utterances, tags and gold/predicted objects are only read from the data when a result is printed or inspected.
+
+Usage:
+	model_errors = ModelErrors(dataset, dataset_index, model_predictions, 'Team9')
+	for turn_error in model_errors.get_top_turns(10, split_mask, ranking=RANKING_REGRESSION):
+		turn_error.pretty_print()
+"""
+
+from typing import List
+
+import numpy as np
+
+from . import alignment, ce
+from .evaluation import ModelObjectCounts
+from .indexing import DatasetIndex
+from .predictions import PredictionStore
+
+
+# 1 - F1 of each turn, 1 - F1 After-CR (gold before the CR against the prediction after it), or F1 Before-CR - F1 After-CR
+RANKING_F1_LOSS = 'f1_loss'
+RANKING_AFTER_CR_F1_LOSS = 'after_cr_f1_loss'
+RANKING_REGRESSION = 'regression'
+RANKINGS = [RANKING_F1_LOSS, RANKING_AFTER_CR_F1_LOSS, RANKING_REGRESSION]
+
+
+def get_f1(counts: np.ndarray) -> np.ndarray:
+	"""
+	Gets the object F1 of each row of counts, 2 * correct / (true + predicted). Rows with
+	no true and no predicted objects have nothing wrong, so their F1 is 1.
+
+	:param counts: int array of shape (rows, 3) with n_true, n_pred and n_correct, see count_object_matches
+	:return: float array with the F1 of each row
+	"""
+	n_total = counts[:, 0] + counts[:, 1]
+	return np.where(n_total > 0, 2 * counts[:, 2] / np.maximum(n_total, 1), 1.)
+
+
+def get_top_k(scores: np.ndarray, tie_breaker: np.ndarray, k: int) -> np.ndarray:
+	"""
+	Gets the positions of the K highest scores, without sorting all of them. Ties are broken by the
+	highest tie_breaker and then by position, so the result does not depend on the sort algorithm.
+
+	:param scores: float array
+	:param tie_breaker: array of the same length as scores
+	:param k: number of positions to get
+	:return: positions of the top K, from the highest score
+	"""
+	if k <= 0:
+		return np.zeros(0, dtype=np.int64)
+	elif k < len(scores):
+		# all the scores tied with the k-th are candidates, then only those are sorted
+		threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+		candidates = np.flatnonzero(scores >= threshold)
+	else:
+		candidates = np.arange(len(scores))
+	order = np.lexsort((candidates, -tie_breaker[candidates], -scores[candidates]))
+	return candidates[order[:k]]
+
+
+class TurnError:
+	"""
+	A turn in the error analysis of a model, with its score and object counts. Its utterances, tags and
+	objects are read from the data the first time they are needed, see details.
+	"""
+
+	def __init__(self, model_errors: 'ModelErrors', turn_id: int, score: float):
+		self._model_errors = model_errors
+		self.turn_id = turn_id
+		self.score = score
+		self._details = None
+
+	@property
+	def dialogue_idx(self) -> int:
+		return int(self._model_errors.dataset_index.dialogue_idx[self.turn_id])
+
+	@property
+	def turn_idx(self) -> int:
+		return int(self._model_errors.dataset_index.turn_idx[self.turn_id])
+
+	@property
+	def is_ce(self) -> bool:
+		return bool(self._model_errors.dataset_index.ce_after[self.turn_id] >= 0)
+
+	@property
+	def f1(self) -> float:
+		return float(get_f1(self._model_errors.model_counts.counts[[self.turn_id]])[0])
+
+	@property
+	def f1_after_cr(self) -> float:
+		"""F1 After-CR, only for the turns before a CR (NaN otherwise)."""
+		if not self.is_ce:
+			return np.nan
+		return float(get_f1(self._model_errors.model_counts.counts_after_cr[[self.turn_id]])[0])
+
+	@property
+	def details(self) -> dict:
+		"""Utterances, tags and gold/predicted objects of the turn (and of the turn after the CR for a CE)."""
+		if self._details is None:
+			self._details = self._model_errors.get_turn_details(self.turn_id)
+		return self._details
+
+	def __repr__(self) -> str:
+		return f"TurnError(dialogue {self.dialogue_idx}, turn {self.turn_idx}, score={self.score:.3f})"
+
+	def pretty_print(self) -> None:
+		"""Prints the turn in a human-readable way, as ClarificationExchange.pretty_print but without a limit."""
+		details = self.details
+		lines = [f"  Dialogue {self.dialogue_idx}, turn {self.turn_idx} | score={self.score:.3f}, F1={self.f1:.3f}"]
+		if self.is_ce:
+			lines += [
+				f"USR: {details['referential_ambiguity']} | {details['tags_referential_ambiguity']}",
+				f"SYS: {details['c_request']} | {details['tags_c_request']}",
+				f"USR: {details['c_response']} | {details['tags_c_response']}",
+				f"SYS: {details['resolution']}",
+				f"Tags={details['tags']}",
+				f"Gold={details['gold_objects']} Before-CR={details['predicted_objects']} "
+				f"After-CR={details['predicted_objects_after_cr']} (F1 After-CR={self.f1_after_cr:.3f})"]
+		else:
+			lines += [
+				f"USR: {details['transcript']}", f"SYS: {details['system_transcript']}",
+				f"Gold={details['gold_objects']} Predicted={details['predicted_objects']}"]
+		print('\n\t'.join(lines))
+
+
+class DialogueError:
+	"""
+	A dialogue in the error analysis of a model, with its score, its F1 (After-CR for the After-CR rankings)
+	and the turns of the split that were ranked.
+	"""
+
+	def __init__(self, model_errors: 'ModelErrors', dialogue_idx: int, score: float, f1: float, turn_ids: np.ndarray):
+		self._model_errors = model_errors
+		self.dialogue_idx = dialogue_idx
+		self.score = score
+		self.f1 = f1
+		self.turn_ids = turn_ids
+
+	def get_turns(self, ranking: str = RANKING_F1_LOSS) -> List[TurnError]:
+		"""
+		Gets the turns of the dialogue in the split, from the worst.
+
+		:param ranking: how to rank the turns, see RANKINGS
+		:return: list of turns with errors
+		"""
+		split_mask = np.zeros(len(self._model_errors.dataset_index), dtype=bool)
+		split_mask[self.turn_ids] = True
+		return self._model_errors.get_top_turns(len(self.turn_ids), split_mask, ranking)
+
+	def __repr__(self) -> str:
+		return f"DialogueError(dialogue {self.dialogue_idx}, {len(self.turn_ids)} turns, score={self.score:.3f})"
+
+	def pretty_print(self, ranking: str = RANKING_F1_LOSS) -> None:
+		"""Prints the dialogue and its turns with errors, from the worst."""
+		print(f"Dialogue {self.dialogue_idx} | score={self.score:.3f}, F1={self.f1:.3f}, {len(self.turn_ids)} turns")
+		for turn_error in self.get_turns(ranking):
+			turn_error.pretty_print()
+
+
+class ModelErrors:
+	"""
+	Ranks the turns and dialogues of a model by their errors, from the object counts of every turn.
+	The data is only used to read the details of the turns that are returned.
+
+	:param dataset: the original SIMMC2 data, with the CEs marked
+	:param dataset_index: index of the original data
+	:param predictions: store with the predictions of the model
+	:param model_name: name of the model
+	:param model_counts: object counts of the model, computed if not given
+	:param missing_policy: 'skip' to leave out the turns the model did not predict, or 'empty'
+	"""
+
+	def __init__(
+		self, dataset: dict, dataset_index: DatasetIndex, predictions: PredictionStore, model_name: str,
+		model_counts: ModelObjectCounts = None, missing_policy: str = alignment.MISSING_SKIP):
+		if missing_policy not in alignment.MISSING_POLICIES:
+			raise ValueError(f"Unknown missing policy '{missing_policy}', use one of {alignment.MISSING_POLICIES}")
+		self.dataset, self.dataset_index = dataset, dataset_index
+		self.predictions, self.model_name = predictions, model_name
+		self.model_counts = model_counts or ModelObjectCounts(dataset_index, predictions, model_name)
+		self.missing_policy = missing_policy
+		# global turn id of the first turn of each dialogue, to find the turns without going through the data
+		self._dialogue_offsets = np.zeros(len(dataset['dialogue_data']) + 1, dtype=np.int64)
+		np.cumsum([len(x['dialogue']) for x in dataset['dialogue_data']], out=self._dialogue_offsets[1:])
+
+	def _get_rows(self, split_mask: np.ndarray, ranking: str) -> tuple:
+		# turns to rank and their counts, (turn ids, counts before, counts after or None)
+		if ranking not in RANKINGS:
+			raise ValueError(f"Unknown ranking '{ranking}', use one of {RANKINGS}")
+		if split_mask is None:
+			split_mask = np.ones(len(self.dataset_index), dtype=bool)
+		counts = self.model_counts
+		turn_mask = split_mask.copy()
+		if ranking == RANKING_F1_LOSS:
+			if self.missing_policy == alignment.MISSING_SKIP:
+				turn_mask &= counts.has_prediction
+			turn_ids = np.flatnonzero(turn_mask)
+			return turn_ids, counts.counts[turn_ids], None
+
+		turn_mask &= self.dataset_index.ce_after >= 0
+		if self.missing_policy == alignment.MISSING_SKIP:
+			turn_mask &= counts.has_prediction_after_cr
+			if ranking == RANKING_REGRESSION:
+				turn_mask &= counts.has_prediction
+		turn_ids = np.flatnonzero(turn_mask)
+		if ranking == RANKING_AFTER_CR_F1_LOSS:
+			return turn_ids, counts.counts_after_cr[turn_ids], None
+		return turn_ids, counts.counts[turn_ids], counts.counts_after_cr[turn_ids]
+
+	@staticmethod
+	def _get_scores(counts: np.ndarray, counts_after_cr: np.ndarray = None) -> tuple:
+		# (score, number of wrong objects to break ties) of each row
+		errors = counts[:, 0] + counts[:, 1] - 2 * counts[:, 2]
+		if counts_after_cr is None:
+			return 1. - get_f1(counts), errors
+		return get_f1(counts) - get_f1(counts_after_cr), \
+			counts_after_cr[:, 0] + counts_after_cr[:, 1] - 2 * counts_after_cr[:, 2] - errors
+
+	def get_top_turns(self, k: int = 10, split_mask: np.ndarray = None, ranking: str = RANKING_F1_LOSS) -> List[TurnError]:
+		"""
+		Gets the K worst turns of a split. Only turns with errors (a positive score) are returned.
+
+		:param k: number of turns
+		:param split_mask: boolean array over all the turns, default all, see splits.compile_splits
+		:param ranking: how to rank the turns, see RANKINGS. The After-CR rankings only rank the turns before a CR
+		:return: list of turns, from the worst
+		"""
+		turn_ids, counts, counts_after_cr = self._get_rows(split_mask, ranking)
+		scores, tie_breaker = self._get_scores(counts, counts_after_cr)
+		positive = np.flatnonzero(scores > 0)
+		top_rows = positive[get_top_k(scores[positive], tie_breaker[positive], k)]
+		return [TurnError(self, int(turn_ids[x]), float(scores[x])) for x in top_rows]
+
+	def get_top_dialogues(
+		self, k: int = 10, split_mask: np.ndarray = None, ranking: str = RANKING_F1_LOSS) -> List['DialogueError']:
+		"""
+		Gets the K worst dialogues of a split, by the F1 of all their turns in the split (micro-averaged,
+		as the F1 of a split). Only dialogues with errors (a positive score) are returned.
+
+		:param k: number of dialogues
+		:param split_mask: boolean array over all the turns, default all, see splits.compile_splits
+		:param ranking: how to rank the dialogues, see RANKINGS
+		:return: list of dialogues, from the worst
+		"""
+		turn_ids, counts, counts_after_cr = self._get_rows(split_mask, ranking)
+		dialogue_positions = np.searchsorted(self._dialogue_offsets, turn_ids, side='right') - 1
+		# sum the counts of the turns of each dialogue
+		num_dialogues = len(self._dialogue_offsets) - 1
+		dialogue_counts = np.stack([
+			np.bincount(dialogue_positions, weights=counts[:, i], minlength=num_dialogues) for i in range(3)], axis=1)
+		dialogue_counts_after_cr = None if counts_after_cr is None else np.stack([
+			np.bincount(dialogue_positions, weights=counts_after_cr[:, i], minlength=num_dialogues)
+			for i in range(3)], axis=1)
+		scores, tie_breaker = self._get_scores(dialogue_counts, dialogue_counts_after_cr)
+		# dialogues without turns in the split have no score
+		has_turns = np.bincount(dialogue_positions, minlength=num_dialogues) > 0
+		candidates = np.flatnonzero(has_turns & (scores > 0))
+		top_dialogues = candidates[get_top_k(scores[candidates], tie_breaker[candidates], k)]
+		f1 = get_f1(dialogue_counts if counts_after_cr is None else dialogue_counts_after_cr)
+
+		turn_order = np.argsort(dialogue_positions, kind='stable')
+		turn_starts = np.searchsorted(dialogue_positions[turn_order], top_dialogues, side='left')
+		turn_ends = np.searchsorted(dialogue_positions[turn_order], top_dialogues, side='right')
+		return [
+			DialogueError(
+				self, self.dataset['dialogue_data'][x]['dialogue_idx'], float(scores[x]), float(f1[x]),
+				turn_ids[turn_order[start:end]])
+			for x, start, end in zip(top_dialogues, turn_starts, turn_ends)]
+
+	def _get_turn(self, turn_id: int) -> dict:
+		dialogue_position = np.searchsorted(self._dialogue_offsets, turn_id, side='right') - 1
+		return self.dataset['dialogue_data'][dialogue_position]['dialogue'][
+			turn_id - self._dialogue_offsets[dialogue_position]]
+
+	def _get_predicted_objects(self, turn_id: int) -> list:
+		objects = self.predictions.get_objects(self.model_name, turn_id)
+		return None if objects is None else sorted(objects.tolist())
+
+	def get_turn_details(self, turn_id: int) -> dict:
+		"""
+		Reads the utterances, tags and objects of a turn from the data.
+
+		:param turn_id: global turn id
+		:return: dict with the 'transcript', 'system_transcript', 'gold_objects' and 'predicted_objects'
+			(None if not predicted) of the turn. For the turns before a CR, also the utterances of the CE
+			(see ce.ClarificationExchange), their tags and the 'predicted_objects_after_cr'
+		"""
+		turn_datum = self._get_turn(turn_id)
+		details = {
+			'transcript': turn_datum['transcript'], 'system_transcript': turn_datum['system_transcript'],
+			'gold_objects': sorted(turn_datum['transcript_annotated']['act_attributes']['objects']),
+			'predicted_objects': self._get_predicted_objects(turn_id)}
+		if ce.is_ce_turn(turn_datum):
+			clarification_exchange = turn_datum['ce']
+			details.update({
+				'referential_ambiguity': clarification_exchange.referential_ambiguity,
+				'c_request': clarification_exchange.c_request,
+				'c_response': clarification_exchange.c_response,
+				'resolution': clarification_exchange.resolution,
+				'tags': clarification_exchange.tags,
+				'tags_referential_ambiguity': clarification_exchange.tags_referential_ambiguity,
+				'tags_c_request': clarification_exchange.tags_c_request,
+				'tags_c_response': clarification_exchange.tags_c_response,
+				'predicted_objects_after_cr': self._get_predicted_objects(int(self.dataset_index.ce_after[turn_id])),
+			})
+		return details
@@ -329,6 +329,10 @@ def d_f1(n_true, n_pred, n_correct):
     # 1/r + 1/p = 2/F1
     # dr / r^2 + dp / p^2 = 2dF1 /F1^2
     # dF1 = 1/2 F1^2 (dr/r^2 + dp/p^2)
+    if n_correct == 0:
+        # undefined, it would divide by zero below
+        return np.nan
+
     dr = b_stderr(n_true, n_correct)
     dp = b_stderr(n_pred, n_correct)
 
@@ -10,7 +10,12 @@ Code released as part of the paper "'What are you referring to?' Evaluating the
 """
 
 import sys
+from collections import Counter
+
 from . import *
+from . import alignment, profiling, spatial
+from .indexing import DatasetIndex, SceneObjectIndex, CE_ROLE_BEFORE
+from .predictions import PredictionStore
 
 import numpy as np
 
@@ -19,7 +24,7 @@ import numpy as np
 # sys.path.append('../')
 # We use the original evaluation method from the SIMMC2 repository
 # from simmc2.model.mm_dst.utils.evaluate_dst import evaluate_from_flat_list
-from .evaluate_dst import evaluate_from_flat_list
+from .evaluate_dst import evaluate_from_flat_list, rec_prec_f1, d_f1
 
 
 def _reformat_frame_turn(frame_objects: list):
@@ -38,19 +43,30 @@ def _reformat_frame_turn(frame_objects: list):
 	return [frame]
 
 
-def _evaluate_from_flat_list_by_model(d_true_flat, d_pred_flat_by_model) -> dict:
+def _get_empty_evaluation() -> dict:
+	# nothing to evaluate (e.g., the model skipped all these turns), avoid dividing by zero
+	return {
+		'object_rec': np.nan, 'object_prec': np.nan, 'object_f1': np.nan,
+		'object_f1_stderr': np.nan, 'entries_evaluated': 0}
+
+
+def _evaluate_from_flat_list_by_model(d_true_flat_by_model, d_pred_flat_by_model) -> dict:
 	"""
 	Evaluate a dataset and get object F1, precision and recall for a dataset.
 	It will call the evaluation script for each model given.
 
-	:param d_true_flat: list of true objects
+	:param d_true_flat_by_model: dict of model name -> list of true objects
 	:param d_pred_flat_by_model: dict of model name -> list of predicted objects
 	:return dict: result metrics
 	"""
 	evaluation = {}
 	for model_name, d_pred_flat in d_pred_flat_by_model.items():
+		if len(d_pred_flat) == 0:
+			evaluation[model_name] = _get_empty_evaluation()
+			continue
+
 		# use the original evaluation method from simmc2
-		eval_result = evaluate_from_flat_list(d_true_flat, d_pred_flat)
+		eval_result = evaluate_from_flat_list(d_true_flat_by_model[model_name], d_pred_flat)
 
 		# remove everything that doesn't have to do with object f1
 		for key in list(eval_result.keys()):        # list avoids error when deleting
@@ -64,125 +80,633 @@ def _evaluate_from_flat_list_by_model(d_true_flat, d_pred_flat_by_model) -> dict
 	return evaluation
 
 
-def evaluate_dataset(dataset: dict, filter_func=None) -> dict:
+def get_model_names(dataset: dict) -> list:
+	"""
+	Gets the names of the models with outputs in a dataset, in the order they were added.
+
+	:param dataset: dataset with the model outputs in each turn
+	:return: list of model names
+	"""
+	model_names = {}
+	for simmc2_dialogue, simmc2_turn in iterate_over_dataset_entries(dataset):
+		model_names.update(dict.fromkeys(simmc2_turn.get('model_outputs', {})))
+	return list(model_names.keys())
+
+
+def get_predicted_objects(turn: dict, model_name: str, predictions: PredictionStore = None):
+	"""
+	Gets the objects predicted by a model for a turn, from a PredictionStore if given
+	(using the 'turn_id' of the turn) or from the 'model_outputs' of the turn otherwise.
+
+	:param turn: turn of the original data
+	:param model_name: name of the model
+	:param predictions: store with the predictions of the models
+	:return: list of predicted objects, None if the model has no output for the turn
+	"""
+	if predictions is not None:
+		pred_objects = predictions.get_objects(model_name, turn['turn_id'])
+		return pred_objects.tolist() if pred_objects is not None else None
+	return turn['model_outputs'][model_name]['pred_objects'] if model_name in turn['model_outputs'] else None
+
+
+def evaluate_dataset(
+	dataset: dict, filter_func=None, *, model_names: list = None,
+	missing_policy: str = alignment.MISSING_SKIP, predictions: PredictionStore = None,
+	evaluate_clarifications: bool = None) -> dict:
 	"""
 	Evaluate a dataset and get object F1, precision and recall for a dataset.
 	You can give a filter function to only evaluate a subset of the dataset that
 	makes the filter function return True.
 
-	If this function crashes due to zero division, the fix is to change the mm_eva
-	
+	The predictions of the models are read from a PredictionStore if given, using the
+	'turn_id' of each turn. Otherwise, they are read from the 'model_outputs' of each turn.
+
+	Models may not have an output for every turn (see alignment.py), the missing_policy
+	decides whether those turns are skipped for that model or evaluated as an
+	empty prediction. Models with no turns to evaluate get NaN metrics. When skipped,
+	a CE is only evaluated if the model has an output for both of its turns, so the
+	Before-CR and After-CR results of a model are over the same CEs.
+
+	The F1 stderr is NaN when a model gets no object right, as it is undefined.
 
 	:param dataset: dataset to evaluate, in the same format as SIMMC2
 	:param filter_func: function that takes a turn and returns True if it should be evaluated
+	:param model_names: models to evaluate, default all the models with outputs in the dataset
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:param predictions: store with the predictions of the models
+	:param evaluate_clarifications: whether to evaluate the turns Before-CR and After-CR. If None,
+		it is decided by the first turn evaluated (whether it is a CE turn)
 	:return dict: result metrics
 	"""
-	# we need to flatten turns first to evaluate with the same scripts as SIMMC2
-	d_true_flattened = []
-	d_pred_flattened_by_model_before = {
-		m: [] for m in dataset['dialogue_data'][0]['dialogue'][0]['model_outputs'].keys()}
-	d_pred_flattened_by_model_after = {
-		m: [] for m in d_pred_flattened_by_model_before.keys()}
+	if missing_policy not in alignment.MISSING_POLICIES:
+		raise ValueError(f"Unknown missing policy '{missing_policy}', use one of {alignment.MISSING_POLICIES}")
+	if model_names is None:
+		model_names = predictions.model_names if predictions is not None else get_model_names(dataset)
 
-	evaluating_clarifications = None
+	# we need to flatten turns first to evaluate with the same scripts as SIMMC2
+	d_true_flattened_by_model_before = {m: [] for m in model_names}
+	d_true_flattened_by_model_after = {m: [] for m in model_names}
+	d_pred_flattened_by_model_before = {m: [] for m in model_names}
+	d_pred_flattened_by_model_after = {m: [] for m in model_names}
+
+	def get_prediction(_turn, _model_name):
+		# predicted objects in the same format as the true objects, None to skip the turn for this model
+		pred_objects = get_predicted_objects(_turn, _model_name, predictions)
+		if pred_objects is None and missing_policy == alignment.MISSING_SKIP:
+			return None
+		return _reformat_frame_turn(pred_objects if pred_objects is not None else [])
+
+	evaluating_clarifications = evaluate_clarifications
 	for simmc2_dialogue, simmc2_turn in iterate_over_dataset_entries(dataset):
 		if filter_func is not None and not filter_func(simmc2_turn):
 			continue # skip as it doesn't pass the filter
 
-		d_true_flattened.append(_reformat_frame_turn(
-			simmc2_turn['transcript_annotated']['act_attributes']['objects']))
+		true_turn = _reformat_frame_turn(simmc2_turn['transcript_annotated']['act_attributes']['objects'])
 		if evaluating_clarifications is None:   # first time, set if eval CEs
 			evaluating_clarifications = ce.is_ce_turn(simmc2_turn)
 
-		for model_name in d_pred_flattened_by_model_before.keys():
+		for model_name in model_names:
 
 			if evaluating_clarifications:   # calculate before and after CR
-				# only doing it once for both before and after CR
-				d_pred_flattened_by_model_before[model_name].append(_reformat_frame_turn(
-					simmc2_turn['ce'].before_cr_datum['model_outputs'][model_name]['pred_objects']))
-				d_pred_flattened_by_model_after[model_name].append(_reformat_frame_turn(
-					simmc2_turn['ce'].after_cr_datum['model_outputs'][model_name]['pred_objects']))
+				# only doing it once for both before and after CR, the CE is skipped if either turn is
+				pred_before = get_prediction(simmc2_turn['ce'].before_cr_datum, model_name)
+				pred_after = get_prediction(simmc2_turn['ce'].after_cr_datum, model_name)
+				if pred_before is None or pred_after is None:
+					continue
+				d_true_flattened_by_model_before[model_name].append(true_turn)
+				d_pred_flattened_by_model_before[model_name].append(pred_before)
+				d_true_flattened_by_model_after[model_name].append(true_turn)
+				d_pred_flattened_by_model_after[model_name].append(pred_after)
 			else:
 				# evaluating all data in general
-				d_pred_flattened_by_model_before[model_name].append(_reformat_frame_turn(
-					simmc2_turn['model_outputs'][model_name]['pred_objects']))
+				pred_turn = get_prediction(simmc2_turn, model_name)
+				if pred_turn is None:
+					continue
+				d_true_flattened_by_model_before[model_name].append(true_turn)
+				d_pred_flattened_by_model_before[model_name].append(pred_turn)
 
 	if evaluating_clarifications:   # special return
-		if len(d_pred_flattened_by_model_after) != len(d_pred_flattened_by_model_before):
-			raise ValueError
-		else:
-			# return before vs after analysis
-			return {
-				'Before-CR': _evaluate_from_flat_list_by_model(
-					d_true_flattened, d_pred_flattened_by_model_before),
-				'After-CR': _evaluate_from_flat_list_by_model(
-					d_true_flattened, d_pred_flattened_by_model_after)
-			}
+		for model_name in model_names:
+			if len(d_pred_flattened_by_model_after[model_name]) != len(d_pred_flattened_by_model_before[model_name]):
+				raise ValueError(
+					f"{model_name} has {len(d_pred_flattened_by_model_before[model_name])} turns Before-CR "
+					f"but {len(d_pred_flattened_by_model_after[model_name])} After-CR, they should be the same CEs")
+
+		# return before vs after analysis
+		return {
+			'Before-CR': _evaluate_from_flat_list_by_model(
+				d_true_flattened_by_model_before, d_pred_flattened_by_model_before),
+			'After-CR': _evaluate_from_flat_list_by_model(
+				d_true_flattened_by_model_after, d_pred_flattened_by_model_after)
+		}
 
 	else:
 		# return single analysis
-		return _evaluate_from_flat_list_by_model(d_true_flattened, d_pred_flattened_by_model_before)
+		return _evaluate_from_flat_list_by_model(d_true_flattened_by_model_before, d_pred_flattened_by_model_before)
 
 
-def _extract_target_candidate_objects(
-	entry_data: dict, property_key: str, simmc2_metadata: dict, scene_jsons: dict) -> list:
+def gather_rows(indptr: np.ndarray, indices: np.ndarray, row_ids: np.ndarray) -> tuple:
 	"""
-	Extract the candidate objects for a given turn, based on some property of the
-	target object. For instance, if we are talking about a red shirt, we will extract:
-	- all shirts in the scene
-	- all red objects in the scene
-	- etc
+	Selects some rows of a CSR list of objects (see PredictionStore), without a Python loop.
+
+	:param indptr: offsets of the rows
+	:param indices: objects of all the rows
+	:param row_ids: rows to select, in the order of the result
+	:return: (indptr, indices) of the selected rows
+	"""
+	lengths = indptr[row_ids + 1] - indptr[row_ids]
+	new_indptr = np.zeros(len(row_ids) + 1, dtype=np.int64)
+	np.cumsum(lengths, out=new_indptr[1:])
+	# position of every object in the original indices, from its position in the result
+	positions = np.arange(new_indptr[-1], dtype=np.int64) - np.repeat(new_indptr[:-1] - indptr[row_ids], lengths)
+	return new_indptr, indices[positions]
+
+
+def _get_row_object_keys(indptr: np.ndarray, indices: np.ndarray) -> np.ndarray:
+	# unique (row, object) pairs as a single int64 key, with the row in the high 32 bits
+	rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+	return np.unique((rows << 32) | (indices.astype(np.int64) & 0xFFFFFFFF))
+
+
+def count_object_matches(
+	true_indptr: np.ndarray, true_indices: np.ndarray, pred_indptr: np.ndarray, pred_indices: np.ndarray) -> np.ndarray:
+	"""
+	Counts the true, predicted and correct objects of every turn, as in evaluate_from_flat_list
+	(objects are sets, so duplicates are counted once), but for all the turns at once.
+
+	:param true_indptr: offsets of the true objects of each turn
+	:param true_indices: true objects of all the turns
+	:param pred_indptr: offsets of the predicted objects of each turn, same number of turns
+	:param pred_indices: predicted objects of all the turns
+	:return: int array of shape (turns, 3) with n_true, n_pred and n_correct of each turn
+	"""
+	num_turns = len(true_indptr) - 1
+	true_keys = _get_row_object_keys(true_indptr, true_indices)
+	pred_keys = _get_row_object_keys(pred_indptr, pred_indices)
+	correct_keys = np.intersect1d(true_keys, pred_keys, assume_unique=True)
+	return np.stack(
+		[np.bincount(x >> 32, minlength=num_turns) for x in (true_keys, pred_keys, correct_keys)], axis=1)
+
+
+def evaluate_object_counts(object_counts: np.ndarray, split_mask: np.ndarray = None) -> dict:
+	"""
+	Gets object F1, precision and recall from the counts of each turn, see count_object_matches.
+	It gives the same results as evaluate_from_flat_list for the same turns.
+
+	:param object_counts: int array of shape (turns, 3) with n_true, n_pred and n_correct
+	:param split_mask: boolean array with the turns to evaluate, default all
+	:return dict: result metrics
+	"""
+	if split_mask is not None:
+		object_counts = object_counts[split_mask]
+	if len(object_counts) == 0:
+		return _get_empty_evaluation()
+
+	n_true, n_pred, n_correct = (float(x) for x in object_counts.sum(axis=0))
+	return {**_evaluate_counts(n_true, n_pred, n_correct), 'entries_evaluated': len(object_counts)}
+
+
+def _evaluate_counts(n_true: float, n_pred: float, n_correct: float) -> dict:
+	object_rec, object_prec, object_f1 = rec_prec_f1(n_correct=n_correct, n_true=n_true, n_pred=n_pred)
+	return {
+		'object_rec': object_rec, 'object_prec': object_prec, 'object_f1': object_f1,
+		'object_f1_stderr': d_f1(n_true, n_pred, n_correct)}
+
+
+class ModelObjectCounts:
+	"""
+	Object counts of every turn for a model, see count_object_matches. The counts After-CR are
+	the true objects of the turn before the CR against the prediction of the turn after the CR,
+	so they are only set for the turns before the CR.
+
+	:param dataset_index: index of the original data
+	:param predictions: store with the predictions of the model
+	:param model_name: name of the model
+	"""
+	__slots__ = ('counts', 'has_prediction', 'counts_after_cr', 'has_prediction_after_cr')
+
+	def __init__(self, dataset_index: DatasetIndex, predictions: PredictionStore, model_name: str):
+		pred_indptr, pred_indices, has_prediction = predictions.get_model_arrays(model_name)
+		self.counts = count_object_matches(
+			dataset_index.gold_indptr, dataset_index.gold_indices, pred_indptr, pred_indices)
+		self.has_prediction = has_prediction
+
+		self.counts_after_cr = np.zeros_like(self.counts)
+		self.has_prediction_after_cr = np.zeros_like(has_prediction)
+		before_cr_turns = np.flatnonzero(dataset_index.ce_after >= 0)
+		after_cr_turns = dataset_index.ce_after[before_cr_turns]
+		self.counts_after_cr[before_cr_turns] = count_object_matches(
+			*gather_rows(dataset_index.gold_indptr, dataset_index.gold_indices, before_cr_turns),
+			*gather_rows(pred_indptr, pred_indices, after_cr_turns))
+		self.has_prediction_after_cr[before_cr_turns] = has_prediction[after_cr_turns]
+
+	@property
+	def has_ce_prediction(self) -> np.ndarray:
+		"""Whether the model has a prediction for both turns of each CE, set for the turns before the CR."""
+		return self.has_prediction & self.has_prediction_after_cr
+
+	@classmethod
+	def concatenate(cls, model_counts: list) -> 'ModelObjectCounts':
+		"""
+		Joins the counts of a model over consecutive parts of the data (e.g., shards of the dialogues),
+		the same as counting over all the data, see indexing.DatasetIndex.concatenate.
+
+		:param model_counts: list of ModelObjectCounts, in the order of their turns
+		:return: the joined counts
+		"""
+		joined_counts = cls.__new__(cls)
+		for key in cls.__slots__:
+			setattr(joined_counts, key, np.concatenate([getattr(x, key) for x in model_counts]))
+		return joined_counts
+
+
+def evaluate_model_counts(
+	dataset_index: DatasetIndex, model_counts: dict, split_mask: np.ndarray = None, *,
+	missing_policy: str = alignment.MISSING_SKIP) -> dict:
+	"""
+	Same as evaluate_dataset, but from the object counts of the models, so evaluating
+	a split only sums the counts of its turns. If the first turn of the split is
+	the turn before a CR, it returns the Before-CR and After-CR results, over the
+	CEs with an output of the model for both turns when they are skipped.
+
+	:param dataset_index: index of the original data
+	:param model_counts: dict of model name -> ModelObjectCounts
+	:param split_mask: boolean array with the turns to evaluate, default all, see get_split_mask
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:return dict: result metrics
+	"""
+	if missing_policy not in alignment.MISSING_POLICIES:
+		raise ValueError(f"Unknown missing policy '{missing_policy}', use one of {alignment.MISSING_POLICIES}")
+	if split_mask is None:
+		split_mask = np.ones(len(dataset_index), dtype=bool)
+
+	def _evaluate(counts, has_prediction):
+		if missing_policy == alignment.MISSING_SKIP:
+			return evaluate_object_counts(counts, split_mask & has_prediction)
+		return evaluate_object_counts(counts, split_mask)
+
+	split_turns = np.flatnonzero(split_mask)
+	if len(split_turns) > 0 and dataset_index.ce_role[split_turns[0]] == CE_ROLE_BEFORE:
+		return {
+			'Before-CR': {
+				model_name: _evaluate(x.counts, x.has_ce_prediction) for model_name, x in model_counts.items()},
+			'After-CR': {
+				model_name: _evaluate(x.counts_after_cr, x.has_ce_prediction) for model_name, x in model_counts.items()}
+		}
+
+	return {model_name: _evaluate(x.counts, x.has_prediction) for model_name, x in model_counts.items()}
+
+
+class ModelRoundCounts:
+	"""
+	Object counts of a model after each round of the clarification chains (see ce.ClarificationChain),
+	kept under the first turn of each chain. Round 0 is the prediction of that first ambiguous turn, and
+	round k the prediction of the turn after the k-th CR, always against the true objects of the first
+	turn. The counts of round k are only set for the chains with k rounds or more. As the turns of a CE,
+	a chain only has a prediction in every round if the model has a prediction for all of its rounds, so
+	the rounds are compared over the same chains when missing predictions are skipped.
+
+	:param dataset_index: index of the original data
+	:param predictions: store with the predictions of the model
+	:param model_name: name of the model
+	:param max_rounds: last round to count, default the rounds of the longest chain
+	"""
+	__slots__ = ('counts', 'has_prediction')
+
+	def __init__(self, dataset_index: DatasetIndex, predictions: PredictionStore, model_name: str, max_rounds: int = None):
+		pred_indptr, pred_indices, has_prediction = predictions.get_model_arrays(model_name)
+		if max_rounds is None:
+			max_rounds = int(dataset_index.ce_rounds.max(initial=0))
+
+		# lists with the arrays of each round, as ModelObjectCounts.counts and has_prediction
+		self.counts, self.has_prediction = [], []
+		for k in range(max_rounds + 1):
+			chain_turns, round_turns = dataset_index.get_chain_round_turns(k)
+			round_counts = np.zeros((len(dataset_index), 3), dtype=np.int64)
+			round_counts[chain_turns] = count_object_matches(
+				*gather_rows(dataset_index.gold_indptr, dataset_index.gold_indices, chain_turns),
+				*gather_rows(pred_indptr, pred_indices, round_turns))
+			round_has_prediction = np.zeros_like(has_prediction)
+			round_has_prediction[chain_turns] = has_prediction[round_turns]
+			self.counts.append(round_counts)
+			self.has_prediction.append(round_has_prediction)
+
+		# chains with a prediction in all their rounds, the chains of round k are a subset of those of round k - 1
+		has_chain_prediction = self.has_prediction[0].copy()
+		for k in range(1, max_rounds + 1):
+			chain_turns = dataset_index.ce_rounds >= k
+			has_chain_prediction[chain_turns] &= self.has_prediction[k][chain_turns]
+		self.has_prediction = [x & has_chain_prediction for x in self.has_prediction]
+
+
+def evaluate_model_rounds(
+	dataset_index: DatasetIndex, model_rounds: dict, split_mask: np.ndarray = None, *,
+	missing_policy: str = alignment.MISSING_SKIP) -> dict:
+	"""
+	Same as evaluate_model_counts, but after each round of the clarification chains in the split,
+	e.g., with the split 'rounds>=2' (see splits.CERounds) to see whether a second CR helps the models.
+	Round k only evaluates the chains of the split with k rounds or more.
+
+	:param dataset_index: index of the original data
+	:param model_rounds: dict of model name -> ModelRoundCounts
+	:param split_mask: boolean array with the turns to evaluate, default all, only the first turns of the chains count
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:return dict: 'Before-CR' and 'After round k' for each round -> model name -> result metrics
+	"""
+	if missing_policy not in alignment.MISSING_POLICIES:
+		raise ValueError(f"Unknown missing policy '{missing_policy}', use one of {alignment.MISSING_POLICIES}")
+	if split_mask is None:
+		split_mask = np.ones(len(dataset_index), dtype=bool)
+
+	def _evaluate(counts, has_prediction, k):
+		round_mask = split_mask & (dataset_index.ce_rounds >= max(k, 1))
+		if missing_policy == alignment.MISSING_SKIP:
+			return evaluate_object_counts(counts, round_mask & has_prediction)
+		return evaluate_object_counts(counts, round_mask)
+
+	max_rounds = min(len(x.counts) for x in model_rounds.values()) - 1 if len(model_rounds) > 0 else 0
+	return {
+		'Before-CR' if k == 0 else f"After round {k}": {
+			model_name: _evaluate(x.counts[k], x.has_prediction[k], k) for model_name, x in model_rounds.items()}
+		for k in range(max_rounds + 1)}
+
+
+# value of the objects that are not in the scenes of their turn, e.g., predictions of wrong indexes
+UNRESOLVED_VALUE = '<not in scene>'
+
+
+def _get_object_hits(
+	object_index: SceneObjectIndex, row_turns: np.ndarray, true_indptr: np.ndarray, true_indices: np.ndarray,
+	pred_indptr: np.ndarray, pred_indices: np.ndarray) -> tuple:
+	# gold and predicted objects of every row (sets, as count_object_matches), with their attributes
+	true_keys = _get_row_object_keys(true_indptr, true_indices)
+	pred_keys = _get_row_object_keys(pred_indptr, pred_indices)
+	true_turns, pred_turns = row_turns[true_keys >> 32], row_turns[pred_keys >> 32]
+	return (
+		true_turns, object_index.get_object_values(true_turns, true_keys & 0xFFFFFFFF),
+		np.isin(true_keys, pred_keys, assume_unique=True),
+		pred_turns, object_index.get_object_values(pred_turns, pred_keys & 0xFFFFFFFF))
+
+
+class ModelObjectHits:
+	"""
+	Gold and predicted objects of every turn for a model, with whether each gold object was
+	predicted and the attributes of each object (see indexing.SceneObjectIndex), so the object
+	F1 can be grouped by any attribute value. As in ModelObjectCounts, the objects After-CR are the
+	gold objects of the turn before the CR against the prediction of the turn after the CR, kept
+	under the turn before the CR. Objects are resolved in the scenes of the turn they are kept
+	under, since their indexes are compared with its gold objects.
+
+	:param dataset_index: index of the original data
+	:param object_index: attributes of the objects of the scenes
+	:param predictions: store with the predictions of the model
+	:param model_name: name of the model
+	"""
+	__slots__ = ('objects', 'has_prediction', 'objects_after_cr', 'has_prediction_after_cr')
+
+	def __init__(
+		self, dataset_index: DatasetIndex, object_index: SceneObjectIndex, predictions: PredictionStore,
+		model_name: str):
+		pred_indptr, pred_indices, has_prediction = predictions.get_model_arrays(model_name)
+		# (gold turns, gold values, gold predicted, predicted turns, predicted values)
+		self.objects = _get_object_hits(
+			object_index, np.arange(len(dataset_index), dtype=np.int64),
+			dataset_index.gold_indptr, dataset_index.gold_indices, pred_indptr, pred_indices)
+		self.has_prediction = has_prediction
+
+		before_cr_turns = np.flatnonzero(dataset_index.ce_after >= 0)
+		after_cr_turns = dataset_index.ce_after[before_cr_turns]
+		self.objects_after_cr = _get_object_hits(
+			object_index, before_cr_turns,
+			*gather_rows(dataset_index.gold_indptr, dataset_index.gold_indices, before_cr_turns),
+			*gather_rows(pred_indptr, pred_indices, after_cr_turns))
+		self.has_prediction_after_cr = np.zeros_like(has_prediction)
+		self.has_prediction_after_cr[before_cr_turns] = has_prediction[after_cr_turns]
+
+	@property
+	def has_ce_prediction(self) -> np.ndarray:
+		"""Whether the model has a prediction for both turns of each CE, see ModelObjectCounts.has_ce_prediction."""
+		return self.has_prediction & self.has_prediction_after_cr
+
+
+def _evaluate_object_hits(
+	object_index: SceneObjectIndex, objects: tuple, turn_mask: np.ndarray, attribute_names: list) -> dict:
+	true_turns, true_values, true_predicted, pred_turns, pred_values = objects
+	true_kept, pred_kept = turn_mask[true_turns], turn_mask[pred_turns]
+	results = {}
+	for attribute_name in attribute_names:
+		attribute = object_index.attribute_names.index(attribute_name)
+		value_names = object_index.value_names[attribute_name] + [UNRESOLVED_VALUE]
+		# group the objects by value with bincount, unresolved objects (-1) go to the last value
+		true_codes = true_values[true_kept, attribute] % len(value_names)
+		pred_codes = pred_values[pred_kept, attribute] % len(value_names)
+		n_true = np.bincount(true_codes, minlength=len(value_names))
+		n_pred = np.bincount(pred_codes, minlength=len(value_names))
+		n_correct = np.bincount(true_codes, weights=true_predicted[true_kept], minlength=len(value_names))
+		results[attribute_name] = {
+			value_name: {
+				**_evaluate_counts(float(n_true[i]), float(n_pred[i]), float(n_correct[i])),
+				'objects_true': int(n_true[i]), 'objects_pred': int(n_pred[i])}
+			for i, value_name in enumerate(value_names) if n_true[i] + n_pred[i] > 0}
+	return results
+
+
+def evaluate_model_attributes(
+	dataset_index: DatasetIndex, object_index: SceneObjectIndex, model_hits: dict,
+	split_mask: np.ndarray = None, *, attribute_names: list = None,
+	missing_policy: str = alignment.MISSING_SKIP) -> dict:
+	"""
+	Same as evaluate_model_counts, but the object F1 is grouped by the value of each attribute
+	of the objects, e.g., the F1 of the jackets and the chairs for 'type'. Recall counts the gold
+	objects with the value and precision the predicted objects with the value, so a model that
+	predicts a chair instead of a jacket lowers the recall of jackets and the precision of chairs.
+
+	:param dataset_index: index of the original data
+	:param object_index: attributes of the objects of the scenes
+	:param model_hits: dict of model name -> ModelObjectHits
+	:param split_mask: boolean array with the turns to evaluate, default all, see get_split_mask
+	:param attribute_names: attributes to group by, default all the attributes of the object index
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:return dict: dict of model name -> attribute -> value -> result metrics, with the number of gold
+		('objects_true') and predicted ('objects_pred') objects. Split by Before-CR and After-CR
+		if the first turn of the split is the turn before a CR, as evaluate_model_counts
+	"""
+	if missing_policy not in alignment.MISSING_POLICIES:
+		raise ValueError(f"Unknown missing policy '{missing_policy}', use one of {alignment.MISSING_POLICIES}")
+	if split_mask is None:
+		split_mask = np.ones(len(dataset_index), dtype=bool)
+	attribute_names = attribute_names or object_index.attribute_names
+
+	def _evaluate(objects, has_prediction):
+		turn_mask = split_mask & has_prediction if missing_policy == alignment.MISSING_SKIP else split_mask
+		return _evaluate_object_hits(object_index, objects, turn_mask, attribute_names)
+
+	split_turns = np.flatnonzero(split_mask)
+	if len(split_turns) > 0 and dataset_index.ce_role[split_turns[0]] == CE_ROLE_BEFORE:
+		return {
+			'Before-CR': {
+				model_name: _evaluate(x.objects, x.has_ce_prediction) for model_name, x in model_hits.items()},
+			'After-CR': {
+				model_name: _evaluate(x.objects_after_cr, x.has_ce_prediction) for model_name, x in model_hits.items()}
+		}
+
+	return {model_name: _evaluate(x.objects, x.has_prediction) for model_name, x in model_hits.items()}
+
+
+def _get_scene_candidate_counter(
+	scene_idx_list: tuple, property_keys: list, simmc2_metadata: dict, scene_jsons: dict,
+	_cache: dict) -> tuple:
+	"""
+	Resolves the objects of the scenes of a turn and counts how many objects in the scenes
+	have each property value. Scenes are shared by many turns, so the result is
+	cached by the scenes given.
+
+	Objects are resolved by their index to the first object with that index in the scenes,
+	in the order given (current scene first), and all objects of all the scenes are counted.
+
+	:param scene_idx_list: tuple of scene ids, current scene first
+	:param property_keys: the properties to count, a tuple of properties is a conjunction
+	:param simmc2_metadata: the metadata of the SIMMC2 dataset
+	:param scene_jsons: the scene jsons of the SIMMC2 dataset
+	:param _cache: dict used to cache the results between turns
+	:return: (dict of object index -> metadata, dict of property key -> Counter of values)
+	"""
+	if scene_idx_list not in _cache:
+		profiling.count('scenes resolved')
+		scene_objects = [
+			_obj for scene_idx in scene_idx_list
+			for _obj in scene_jsons[f"{scene_idx}_scene"]['scenes'][0]['objects']]
+
+		object_metadata = {}
+		for _obj in scene_objects:
+			if _obj['index'] not in object_metadata:
+				# now use prefab to find actual item type
+				object_metadata[_obj['index']] = simmc2_metadata[_obj['prefab_path']]
+
+		counters = {key: Counter() for key in property_keys}
+		for _obj in scene_objects:
+			for key in property_keys:
+				counters[key][get_object_property(object_metadata[_obj['index']], key)] += 1
+
+		_cache[scene_idx_list] = object_metadata, counters
+
+	return _cache[scene_idx_list]
+
+
+def _extract_target_spatial_candidate_objects(
+	entry_data: dict, property_key: str, simmc2_metadata: dict,
+	scene_indexes: spatial.SceneSpatialIndexes, spatial_mode: str, radius: float) -> list:
+	"""
+	Extract the candidate objects for a given turn that are similar to the target
+	objects and close to them in the scene, see spatial.find_spatial_distractors.
 
 	:param entry_data: the turn to extract the candidate objects from
 	:param property_key: the property to extract the candidate objects that are similar
 	:param simmc2_metadata: the metadata of the SIMMC2 dataset
-	:param scene_jsons: the scene jsons of the SIMMC2 dataset
-	:return: list of candidate objects
+	:param scene_indexes: the spatial indexes of the scenes
+	:param spatial_mode: 'radius' or 'region'
+	:param radius: radius around each target, in pixels
+	:return: list of candidate object indexes
 	"""
-	# at a given entry, extract the candidate objects based on the target object type
-	# e.g., if the target object is a jacket, then all jackets in the scene are candidate objects
 	scene_idx_list = [entry_data['scene_idx']]
 	if entry_data['previous_scene_idx'] is not None:
 		scene_idx_list.append(entry_data['previous_scene_idx'])
 
-	_scene = [scene_jsons[f"{scene_idx}_scene"] for scene_idx in scene_idx_list]
-	def all_objects_from_scenes():
-		for scene in _scene:
-			for _obj in scene['scenes'][0]['objects']:
-				yield _obj
+	return spatial.find_spatial_distractors(
+		entry_data['transcript_annotated']['act_attributes']['objects'], property_key, simmc2_metadata,
+		[scene_indexes[f"{scene_idx}_scene"] for scene_idx in scene_idx_list],
+		spatial_mode=spatial_mode, radius=radius)
 
-	# first case: no target objects
-	if len(entry_data['transcript_annotated']['act_attributes']['objects']) == 0:
-		return []
-	else:
-		def _get_object_metadata(object_index):
-			for item in all_objects_from_scenes():
-				if item['index'] == object_index:
-					# now use prefab to find actual item type
-					return simmc2_metadata[item['prefab_path']]
 
-			assert f"Could not find object {object_index} in all scene objects {[x['index'] for x in all_objects_from_scenes()]}"
+def extract_candidate_object_counts(
+	dataset: dict, simmc2_metadata: dict, scene_jsons: dict, property_keys: list = None, *,
+	spatial_mode: str = None, radius: float = spatial.DEFAULT_RADIUS,
+	scene_indexes: spatial.SceneSpatialIndexes = None) -> dict:
+	"""
+	Count the candidate objects of every turn in a dataset, based on some properties of
+	the target objects at that turn. For instance, if we are talking about
+	a red shirt, we will count:
+	- all shirts in the scene ('type')
+	- all red objects in the scene ('color')
+	- all red shirts in the scene (('type', 'color'))
+	- etc
+
+	The targets and scenes of each turn are resolved only once for all the properties.
+	Turns with no target objects have 0 candidates.
+
+	:param dataset: the dataset to extract the candidate objects from
+	:param simmc2_metadata: the metadata of the SIMMC2 dataset
+	:param scene_jsons: the scene jsons of the SIMMC2 dataset
+	:param property_keys: the properties to count, default type, color and brand.
+		Give a tuple of properties for a conjunction, e.g., ('type', 'color')
+	:param spatial_mode: None to count candidates in the whole scene (default, as in the paper),
+		'radius' to only count those within a radius of the targets or 'region' to
+		only count those in the same region of the scene (left/middle/right, top/bottom)
+	:param radius: radius around each target, in pixels, only used with the radius mode
+	:param scene_indexes: spatial indexes of the scenes, created from scene_jsons if not given
+	:return: dict of property key -> array with the number of candidate objects of each turn,
+		in the same order as iterate_over_dataset_entries
+	"""
+	if property_keys is None:
+		# not all objects have all fields, 'assetType' and 'pattern' are only in clothes
+		property_keys = ['type', 'color', 'brand']
+	if spatial_mode is not None and scene_indexes is None:
+		scene_indexes = spatial.SceneSpatialIndexes(scene_jsons)
+
+	candidate_objects = {key: [] for key in property_keys}
+	_scene_cache = {}
+	for simmc2_dialogue, simmc2_turn in iterate_over_dataset_entries(dataset):
+		target_objects = simmc2_turn['transcript_annotated']['act_attributes']['objects']
+
+		if len(target_objects) == 0:
+			# first case: no target objects
+			for key in property_keys:
+				candidate_objects[key].append(0)
+
+		elif spatial_mode is None:
+			scene_idx_list = (simmc2_turn['scene_idx'],) if simmc2_turn['previous_scene_idx'] is None \
+				else (simmc2_turn['scene_idx'], simmc2_turn['previous_scene_idx'])
+			object_metadata, counters = _get_scene_candidate_counter(
+				scene_idx_list, property_keys, simmc2_metadata, scene_jsons, _scene_cache)
+
+			# 1, 2 or more objects, count all objects in the scenes with the same values as the targets
+			for key in property_keys:
+				target_values = {get_object_property(object_metadata[x], key) for x in target_objects}
+				candidate_objects[key].append(sum(counters[key][value] for value in target_values))
+
+		else:
+			for key in property_keys:
+				candidate_objects[key].append(len(_extract_target_spatial_candidate_objects(
+					simmc2_turn, key, simmc2_metadata, scene_indexes, spatial_mode, radius)))
 
-		# 1, 2 or more objects
-		target_object_metadata = []
-		for item_id in entry_data['transcript_annotated']['act_attributes']['objects']:
-			target_object_metadata.append(_get_object_metadata(item_id))
+	return {key: np.array(values, dtype=np.int32) for key, values in candidate_objects.items()}
 
-		target_object_types = [x[property_key] for x in target_object_metadata]
 
-		candidates = []
-		# if they are the same, then just loop over all items in scene (but target ones) and get their type
-		for scene_item in all_objects_from_scenes():
-			if scene_item not in entry_data['transcript_annotated']['act_attributes']['objects']:
-				if _get_object_metadata(scene_item['index'])[property_key] in target_object_types:
-					candidates.append(scene_item)
+def summarise_candidate_objects(candidate_counts: dict, split_mask: np.ndarray = None) -> dict:
+	"""
+	Calculates the mean and std of the candidate objects of a data split.
 
-		return candidates
+	:param candidate_counts: dict of property key -> array of counts, see extract_candidate_object_counts
+	:param split_mask: boolean array of the turns in the split, see get_split_mask. All turns if None
+	:return: dict of candidate objects, with mean, std and count
+	"""
+	summary = {}
+	for key, counts in candidate_counts.items():
+		if split_mask is not None:
+			counts = counts[split_mask]
+		summary[key] = {
+			'mean': np.mean(counts),
+			'std': np.std(counts),
+			'count': len(counts),
+		}
 
+	return summary
 
 
 def extract_candidate_objects(
-	dataset: dict, simmc2_metadata: dict, scene_jsons: dict, filter_func=None) -> dict:
+	dataset: dict, simmc2_metadata: dict, scene_jsons: dict, filter_func=None, *,
+	spatial_mode: str = None, radius: float = spatial.DEFAULT_RADIUS,
+	scene_indexes: spatial.SceneSpatialIndexes = None, candidate_counts: dict = None) -> dict:
 	"""
 	Extract the candidate objects for a given dataset, based on some property of the
 	target object at that turn. For instance, if we are talking about
@@ -196,31 +720,19 @@ def extract_candidate_objects(
 	:param scene_jsons: the scene jsons of the SIMMC2 dataset
 	:param filter_func: function that takes a turn and returns True if it should
 		be evaluated. Use it to extract from different data splits/subsets
+	:param spatial_mode: None to count candidates in the whole scene (default, as in the paper),
+		'radius' to only count those within a radius of the targets or 'region' to
+		only count those in the same region of the scene (left/middle/right, top/bottom)
+	:param radius: radius around each target, in pixels, only used with the radius mode
+	:param scene_indexes: spatial indexes of the scenes, pass the same one to all the splits
+		to avoid rebuilding them. Created from scene_jsons if not given
+	:param candidate_counts: counts from extract_candidate_object_counts, pass them when
+		extracting several splits to count the candidates only once
 	:return: dict of candidate objects, with mean, std and count
 	"""
-	# define each field that we want to extract, not all objects have all fields
-	candidate_objects = {
-		'type': [],
-		'color': [],
-		'brand': [],
-		# 'assetType': [],  # only clothes have this field, not furniture
-		# 'pattern': [],    # only clothes have this field, not furniture
-	}
-
-	for simmc2_dialogue, simmc2_turn in iterate_over_dataset_entries(dataset):
-		if filter_func is not None and not filter_func(simmc2_turn):
-			continue # skip as it doesn't pass the filter
-
-		for key in candidate_objects.keys():
-			candidate_objects[key].append(len(_extract_target_candidate_objects(
-				simmc2_turn, key, simmc2_metadata, scene_jsons)))
-
-	# calculate mean & std
-	for key in candidate_objects.keys():
-		candidate_objects[key] = {
-			'mean': np.mean(candidate_objects[key]),
-			'std': np.std(candidate_objects[key]),
-			'count': len(candidate_objects[key]),
-		}
+	if candidate_counts is None:
+		candidate_counts = extract_candidate_object_counts(
+			dataset, simmc2_metadata, scene_jsons, spatial_mode=spatial_mode, radius=radius,
+			scene_indexes=scene_indexes)
 
-	return candidate_objects
+	return summarise_candidate_objects(candidate_counts, get_split_mask(dataset, filter_func))
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Indexes of the original SIMMC2 data as arrays, with one row per turn, so it can be evaluated many times quickly.
+"""
+
+import bisect
+
+import numpy as np
+
+from . import iterate_over_dataset_entries, get_split_mask, get_scene_boundaries
+from . import ce
+
+
+# role of each turn in a clarification exchange, see ce.mark_clarification_exchange
+CE_ROLE_NONE = 0
+CE_ROLE_BEFORE = 1
+CE_ROLE_AFTER = 2
+
+# attributes of the objects, see SceneObjectIndex
+DEFAULT_OBJECT_ATTRIBUTES = ['type', 'color', 'brand', 'domain']
+
+
+class DatasetIndex:
+	"""
+	Arrays with one row per turn of the original data, in the same order as
+	iterate_over_dataset_entries (the global turn id). It keeps the gold objects of each
+	turn in CSR style (objects of turn t are gold_indices[gold_indptr[t]:gold_indptr[t + 1]])
+	and how turns are linked in clarification exchanges.
+
+	It also keeps the columns used to define data splits (see splits.py): the tags of the CE of
+	each turn before the CR as a bitmask (bit i is tag_names[i], 0 for the other turns), the
+	domain and current scene of each turn as indexes into domain_names and scene_names, and the
+	rounds of the clarification chain that starts at each turn (0 for the other turns, see ce.ClarificationChain).
+
+	Build it with DatasetIndex.from_dataset from a dataset with the CEs already marked.
+	"""
+
+	def __init__(
+		self, dialogue_idx: np.ndarray, turn_idx: np.ndarray, gold_indptr: np.ndarray,
+		gold_indices: np.ndarray, ce_role: np.ndarray, ce_after: np.ndarray, *,
+		ce_tags: np.ndarray = None, tag_names: list = None, domain: np.ndarray = None,
+		domain_names: list = None, scene: np.ndarray = None, scene_names: list = None, ce_rounds: np.ndarray = None):
+		self.dialogue_idx, self.turn_idx = dialogue_idx, turn_idx
+		self.gold_indptr, self.gold_indices = gold_indptr, gold_indices
+		self.ce_role = ce_role
+		# global turn id of the turn after the CR, only for the turns before the CR (-1 otherwise)
+		self.ce_after = ce_after
+		self.ce_tags = ce_tags if ce_tags is not None else np.zeros(len(dialogue_idx), dtype=np.int64)
+		self.tag_names = tag_names or []
+		self.domain = domain if domain is not None else np.full(len(dialogue_idx), -1, dtype=np.int16)
+		self.domain_names = domain_names or []
+		self.scene = scene if scene is not None else np.full(len(dialogue_idx), -1, dtype=np.int32)
+		self.scene_names = scene_names or []
+		self.ce_rounds = ce_rounds if ce_rounds is not None else np.zeros(len(dialogue_idx), dtype=np.int16)
+		self.split_masks = {}
+
+	def __len__(self) -> int:
+		return len(self.dialogue_idx)
+
+	def __repr__(self) -> str:
+		return f"DatasetIndex({len(self)} turns, {int(np.count_nonzero(self.ce_role == CE_ROLE_BEFORE))} CEs)"
+
+	@property
+	def num_turns(self) -> int:
+		return len(self)
+
+	@property
+	def num_objects(self) -> np.ndarray:
+		"""Number of gold objects of every turn."""
+		return np.diff(self.gold_indptr)
+
+	@property
+	def turn_keys(self) -> list:
+		"""(dialogue_idx, turn_idx) of every turn, see alignment.get_turn_keys."""
+		return list(zip(self.dialogue_idx.tolist(), self.turn_idx.tolist()))
+
+	@classmethod
+	def from_dataset(cls, dataset: dict, splits: list = None) -> 'DatasetIndex':
+		"""
+		Builds the index from a dataset where the CEs are already marked, see preprocess_dataset.
+
+		:param dataset: the original SIMMC2 data
+		:param splits: list of (split name, filter function or splits.SplitExpression) to precompute
+			their masks, see add_split
+		:return: the index
+		"""
+		dialogue_idx, turn_idx, gold_lengths, gold_indices, ce_role = [], [], [], [], []
+		ce_tags, domain, scene, ce_rounds = [], [], [], []
+		tag_codes, domain_codes, scene_codes = {}, {}, {}
+		turn_ids = {}   # id of the turn dict -> global turn id, to link the turns of the CEs
+		ce_links = []
+		for turn_id, (dialogue_datum, turn_datum) in enumerate(iterate_over_dataset_entries(dataset)):
+			dialogue_idx.append(dialogue_datum['dialogue_idx'])
+			turn_idx.append(turn_datum['turn_idx'])
+			gold_objects = turn_datum['transcript_annotated']['act_attributes']['objects']
+			gold_lengths.append(len(gold_objects))
+			gold_indices.extend(gold_objects)
+			turn_ids[id(turn_datum)] = turn_id
+			domain.append(domain_codes.setdefault(dialogue_datum.get('domain'), len(domain_codes)))
+			scene.append(scene_codes.setdefault(turn_datum.get('scene_idx'), len(scene_codes)))
+			ce_rounds.append(turn_datum['ce_chain'].rounds if 'ce_chain' in turn_datum else 0)
+
+			if ce.is_ce_turn(turn_datum):
+				ce_role.append(CE_ROLE_BEFORE)
+				ce_links.append((turn_id, turn_datum['ce'].after_cr_datum))
+				ce_tags.append(sum(1 << tag_codes.setdefault(x, len(tag_codes)) for x in set(turn_datum['ce'].tags)))
+			else:
+				ce_role.append(CE_ROLE_AFTER if turn_datum.get('ce_turn') == 'after' else CE_ROLE_NONE)
+				ce_tags.append(0)
+
+		if len(tag_codes) > 63:
+			raise ValueError(f"Too many CE tags for a 64-bit mask: {len(tag_codes)}")
+
+		ce_after = np.full(len(dialogue_idx), -1, dtype=np.int32)
+		for turn_id, after_cr_datum in ce_links:
+			ce_after[turn_id] = turn_ids[id(after_cr_datum)]
+
+		gold_indptr = np.zeros(len(gold_lengths) + 1, dtype=np.int32)
+		np.cumsum(gold_lengths, out=gold_indptr[1:])
+
+		index = cls(
+			np.array(dialogue_idx, dtype=np.int64), np.array(turn_idx, dtype=np.int32), gold_indptr,
+			np.array(gold_indices, dtype=np.int32), np.array(ce_role, dtype=np.int8), ce_after,
+			ce_tags=np.array(ce_tags, dtype=np.int64), tag_names=list(tag_codes),
+			domain=np.array(domain, dtype=np.int16), domain_names=list(domain_codes),
+			scene=np.array(scene, dtype=np.int32), scene_names=list(scene_codes),
+			ce_rounds=np.array(ce_rounds, dtype=np.int16))
+		for split_name, filter_func in splits or []:
+			# split expressions are compiled over the columns of the index, filter functions go through the turns
+			index.add_split(split_name, filter_func.get_mask(index) if hasattr(filter_func, 'get_mask') else get_split_mask(
+				dataset, filter_func))
+		return index
+
+	@classmethod
+	def concatenate(cls, indexes: list) -> 'DatasetIndex':
+		"""
+		Joins the indexes of consecutive parts of the data (e.g., shards of the dialogues) into the
+		index of all of them, the same as from_dataset over all the data. Turn ids are shifted by the
+		turns of the previous parts, and tags, domains and scenes are re-coded in the order they are
+		first seen. Only the splits in all the indexes are kept.
+
+		:param indexes: list of indexes, in the order of their turns
+		:return: the joined index
+		"""
+		turn_offsets = np.cumsum([0] + [len(x) for x in indexes])
+		gold_offsets = np.cumsum([0] + [len(x.gold_indices) for x in indexes])
+		tag_codes, domain_codes, scene_codes = {}, {}, {}
+
+		def _recode(codes, names, global_codes):
+			# the last entry maps the code -1 (none) to itself
+			return np.array([global_codes.setdefault(x, len(global_codes)) for x in names] + [-1], dtype=codes.dtype)[codes]
+
+		ce_tags = []
+		for x in indexes:
+			x_tags = np.zeros_like(x.ce_tags)
+			for bit, tag in enumerate(x.tag_names):
+				x_tags |= ((x.ce_tags >> bit) & 1) << tag_codes.setdefault(tag, len(tag_codes))
+			ce_tags.append(x_tags)
+		if len(tag_codes) > 63:
+			raise ValueError(f"Too many CE tags for a 64-bit mask: {len(tag_codes)}")
+
+		index = cls(
+			np.concatenate([x.dialogue_idx for x in indexes]), np.concatenate([x.turn_idx for x in indexes]),
+			np.concatenate([x.gold_indptr[:-1] + offset for x, offset in zip(indexes, gold_offsets)] + [
+				gold_offsets[-1:]]).astype(np.int32),
+			np.concatenate([x.gold_indices for x in indexes]), np.concatenate([x.ce_role for x in indexes]),
+			np.concatenate([
+				np.where(x.ce_after >= 0, x.ce_after + offset, -1) for x, offset in zip(indexes, turn_offsets)
+			]).astype(np.int32),
+			ce_tags=np.concatenate(ce_tags), tag_names=list(tag_codes),
+			domain=np.concatenate([_recode(x.domain, x.domain_names, domain_codes) for x in indexes]),
+			domain_names=list(domain_codes),
+			scene=np.concatenate([_recode(x.scene, x.scene_names, scene_codes) for x in indexes]),
+			scene_names=list(scene_codes), ce_rounds=np.concatenate([x.ce_rounds for x in indexes]))
+		for split_name in indexes[0].split_masks if len(indexes) > 0 else []:
+			if all(split_name in x.split_masks for x in indexes):
+				index.add_split(split_name, np.concatenate([x.split_masks[split_name] for x in indexes]))
+		return index
+
+	def get_chain_round_turns(self, k: int) -> tuple:
+		"""
+		Gets the clarification chains with k rounds or more, and their turn after the k-th CR.
+
+		:param k: the round, 0 for the first ambiguous turn of the chains
+		:return: (global turn ids of the first turn of the chains, global turn ids of their turn after round k)
+		"""
+		chain_turns = np.flatnonzero(self.ce_rounds >= max(k, 1))
+		return chain_turns, chain_turns + k
+
+	def get_tag_mask(self, tag: str) -> np.ndarray:
+		"""
+		Gets the turns before the CR whose CE has a tag.
+
+		:param tag: the tag, see tagging.py
+		:return: boolean array with one entry per turn
+		"""
+		if tag not in self.tag_names:
+			return np.zeros(len(self), dtype=bool)
+		return (self.ce_tags & (1 << self.tag_names.index(tag))) != 0
+
+	def add_split(self, split_name: str, split_mask: np.ndarray) -> None:
+		"""
+		Adds a data split to the index, as a mask over the turns.
+
+		:param split_name: name of the split
+		:param split_mask: boolean array with one entry per turn, see get_split_mask
+		"""
+		if len(split_mask) != len(self):
+			raise ValueError(f"Split {split_name} has {len(split_mask)} turns, expected {len(self)}")
+		self.split_masks[split_name] = np.asarray(split_mask, dtype=bool)
+
+
+class SceneIndex:
+	"""
+	Scenes of every dialogue and turn of the original data, resolved once when the data is loaded.
+	Each dialogue keeps its scene boundaries (the turn where each scene starts) sorted, in CSR style
+	(the boundaries of dialogue d are scene_boundaries[scene_indptr[d]:scene_indptr[d + 1]]), and
+	the current and previous scene of every turn are arrays over the global turn ids, as
+	indexes into scene_names (-1 when there is no previous scene).
+
+	Build it with SceneIndex.from_dataset.
+	"""
+
+	def __init__(
+		self, scene_names: list, dialogue_offsets: np.ndarray, scene_indptr: np.ndarray,
+		scene_boundaries: np.ndarray, scene_codes: np.ndarray, current_scene: np.ndarray,
+		previous_scene: np.ndarray):
+		self.scene_names = scene_names
+		# global turn id of the first turn of each dialogue, plus the total number of turns
+		self.dialogue_offsets = dialogue_offsets
+		self.scene_indptr, self.scene_boundaries, self.scene_codes = scene_indptr, scene_boundaries, scene_codes
+		self.current_scene, self.previous_scene = current_scene, previous_scene
+
+	def __len__(self) -> int:
+		return len(self.current_scene)
+
+	def __repr__(self) -> str:
+		return f"SceneIndex({len(self.dialogue_offsets) - 1} dialogues, {len(self)} turns, {len(self.scene_names)} scenes)"
+
+	@classmethod
+	def from_dataset(cls, dataset: dict) -> 'SceneIndex':
+		"""
+		Builds the index, sorting the scenes of each dialogue and resolving the scenes of all turns at once.
+
+		:param dataset: the original SIMMC2 data
+		:return: the index
+		"""
+		scene_names, scene_codes_by_name = [], {}
+		dialogue_lengths, scene_lengths, scene_boundaries, scene_codes, turn_idx = [], [], [], [], []
+		for dialogue_datum in dataset['dialogue_data']:
+			dialogue_boundaries, dialogue_scenes = get_scene_boundaries(dialogue_datum['scene_ids'])
+			scene_lengths.append(len(dialogue_boundaries))
+			scene_boundaries.extend(dialogue_boundaries)
+			for scene_idx in dialogue_scenes:
+				if scene_idx not in scene_codes_by_name:
+					scene_codes_by_name[scene_idx] = len(scene_names)
+					scene_names.append(scene_idx)
+				scene_codes.append(scene_codes_by_name[scene_idx])
+
+			dialogue_lengths.append(len(dialogue_datum['dialogue']))
+			turn_idx.extend(turn_datum['turn_idx'] for turn_datum in dialogue_datum['dialogue'])
+
+		dialogue_offsets = np.zeros(len(dialogue_lengths) + 1, dtype=np.int64)
+		np.cumsum(dialogue_lengths, out=dialogue_offsets[1:])
+		scene_indptr = np.zeros(len(scene_lengths) + 1, dtype=np.int64)
+		np.cumsum(scene_lengths, out=scene_indptr[1:])
+		scene_boundaries = np.array(scene_boundaries, dtype=np.int64)
+		scene_codes = np.array(scene_codes, dtype=np.int32)
+		turn_idx = np.array(turn_idx, dtype=np.int64)
+
+		# search the turns in the boundaries of all the dialogues at once, with the dialogue in the high bits
+		dialogue_positions = np.arange(len(dialogue_lengths), dtype=np.int64)
+		boundary_keys = (np.repeat(dialogue_positions, scene_lengths) << 32) + scene_boundaries
+		turn_dialogues = np.repeat(dialogue_positions, dialogue_lengths)
+		scene_positions = np.searchsorted(boundary_keys, (turn_dialogues << 32) + turn_idx, side='right')
+		num_scenes = scene_positions - scene_indptr[turn_dialogues]
+
+		invalid_turns = np.flatnonzero((num_scenes == 0) | (num_scenes > 2))
+		if len(invalid_turns) > 0:
+			turn_id = invalid_turns[0]
+			raise ValueError(
+				f"Turn {turn_idx[turn_id]} of dialogue {dataset['dialogue_data'][turn_dialogues[turn_id]]['dialogue_idx']} "
+				f"has {num_scenes[turn_id]} scenes, expected 1 or 2")
+
+		current_scene = scene_codes[scene_positions - 1]
+		previous_scene = np.where(num_scenes > 1, scene_codes[np.maximum(scene_positions - 2, 0)], -1).astype(np.int32)
+		return cls(
+			scene_names, dialogue_offsets, scene_indptr, scene_boundaries, scene_codes, current_scene, previous_scene)
+
+	def get_scene_idx(self, turn_id: int) -> tuple:
+		"""
+		Gets the scenes of a turn.
+
+		:param turn_id: global turn id, see iterate_over_dataset_entries
+		:return: (current scene id, previous scene id or None), as get_scene_idx
+		"""
+		previous_scene = self.previous_scene[turn_id]
+		return self.scene_names[self.current_scene[turn_id]], \
+			self.scene_names[previous_scene] if previous_scene >= 0 else None
+
+	def get_dialogue_position(self, turn_id: int) -> int:
+		"""Gets the position of the dialogue of a turn in the dataset."""
+		return bisect.bisect_right(self.dialogue_offsets, turn_id) - 1
+
+	def find_scene_idx(self, dialogue_position: int, turn_idx: int) -> tuple:
+		"""
+		Resolves the scenes of any turn index of a dialogue, e.g., one that is not in the data.
+
+		:param dialogue_position: position of the dialogue in the dataset, see get_dialogue_position
+		:param turn_idx: index of the turn in the dialogue
+		:return: (current scene id, previous scene id or None), as get_scene_idx
+		"""
+		start, end = self.scene_indptr[dialogue_position], self.scene_indptr[dialogue_position + 1]
+		num_scenes = bisect.bisect_right(self.scene_boundaries, turn_idx, start, end) - start
+		if num_scenes == 0 or num_scenes > 2:
+			raise ValueError(f"Turn {turn_idx} has {num_scenes} scenes, expected 1 or 2")
+
+		scene_codes = self.scene_codes[start:end]
+		return self.scene_names[scene_codes[num_scenes - 1]], \
+			self.scene_names[scene_codes[num_scenes - 2]] if num_scenes > 1 else None
+
+
+class SceneObjectIndex:
+	"""
+	Attributes of the objects of every scene, joined with the prefab metadata once, so the objects of
+	many turns can be resolved at once. Objects are sorted by (scene, object index) as int64 keys with
+	the scene in the high 32 bits, and the objects of a turn are resolved in its current scene first and
+	then in its previous scene, as evaluation.extract_candidate_object_counts. The value of each attribute
+	is kept as an index into value_names[attribute] (-1 for objects not in the scenes of the turn).
+
+	The 'domain' attribute is the domain of the dialogue of the turn, the others come from the prefab metadata.
+
+	Build it with SceneObjectIndex.from_dataset.
+	"""
+
+	def __init__(
+		self, attribute_names: list, value_names: dict, object_keys: np.ndarray, object_values: np.ndarray,
+		current_scene: np.ndarray, previous_scene: np.ndarray, turn_domain: np.ndarray):
+		self.attribute_names = attribute_names
+		self.value_names = value_names          # attribute -> list of values
+		self.object_keys = object_keys          # sorted (scene code << 32) | object index
+		self.object_values = object_values      # int32 array of shape (objects, attributes)
+		self.current_scene, self.previous_scene = current_scene, previous_scene
+		self.turn_domain = turn_domain          # domain of each turn, as an index into value_names['domain']
+
+	def __len__(self) -> int:
+		return len(self.object_keys)
+
+	def __repr__(self) -> str:
+		return f"SceneObjectIndex({len(self)} objects, {len(self.current_scene)} turns, attributes {self.attribute_names})"
+
+	@classmethod
+	def from_dataset(
+		cls, dataset: dict, simmc2_metadata: dict, scene_jsons: dict, attribute_names: list = None,
+		scene_index: SceneIndex = None) -> 'SceneObjectIndex':
+		"""
+		Builds the index with the objects of the scenes used in the dataset.
+
+		:param dataset: the original SIMMC2 data
+		:param simmc2_metadata: the prefab metadata of the SIMMC2 dataset
+		:param scene_jsons: the scene jsons of the SIMMC2 dataset
+		:param attribute_names: attributes of the objects, default DEFAULT_OBJECT_ATTRIBUTES
+		:param scene_index: scenes of the turns, created from the dataset if not given
+		:return: the index
+		"""
+		attribute_names = list(attribute_names or DEFAULT_OBJECT_ATTRIBUTES)
+		if scene_index is None:
+			scene_index = SceneIndex.from_dataset(dataset)
+
+		value_codes = {attribute: {} for attribute in attribute_names}
+		domain_codes = value_codes.get('domain', {})
+		turn_domain = np.repeat(
+			[domain_codes.setdefault(dialogue_datum.get('domain'), len(domain_codes))
+				for dialogue_datum in dataset['dialogue_data']],
+			np.diff(scene_index.dialogue_offsets)).astype(np.int32)
+
+		object_keys, object_values = [], []
+		for scene_code, scene_idx in enumerate(scene_index.scene_names):
+			seen_objects = set()
+			for scene_object in scene_jsons[f"{scene_idx}_scene"]['scenes'][0]['objects']:
+				# as in the candidate objects, an index is resolved to its first object in the scene
+				if scene_object['index'] in seen_objects:
+					continue
+				seen_objects.add(scene_object['index'])
+				object_metadata = simmc2_metadata[scene_object['prefab_path']]
+				object_keys.append((scene_code << 32) | (scene_object['index'] & 0xFFFFFFFF))
+				# the domain depends on the turn, so it is set when resolving the objects
+				object_values.append([
+					-1 if attribute == 'domain' else value_codes[attribute].setdefault(
+						object_metadata.get(attribute), len(value_codes[attribute]))
+					for attribute in attribute_names])
+
+		object_keys = np.array(object_keys, dtype=np.int64)
+		object_order = np.argsort(object_keys)
+		return cls(
+			attribute_names, {attribute: list(codes) for attribute, codes in value_codes.items()},
+			object_keys[object_order],
+			np.array(object_values, dtype=np.int32).reshape(-1, len(attribute_names))[object_order],
+			scene_index.current_scene, scene_index.previous_scene, turn_domain)
+
+	def get_object_values(self, turn_ids: np.ndarray, object_indices: np.ndarray) -> np.ndarray:
+		"""
+		Resolves objects in the scenes of their turns and gets their attributes.
+
+		:param turn_ids: global turn id of each object
+		:param object_indices: index of each object in the scene
+		:return: int32 array of shape (objects, attributes) with the value codes, -1 if the object is not in the scenes
+		"""
+		object_rows = np.full(len(turn_ids), -1, dtype=np.int64)
+		object_indices = np.asarray(object_indices, dtype=np.int64) & 0xFFFFFFFF
+		for scene_codes in (self.current_scene[turn_ids], self.previous_scene[turn_ids]):
+			object_keys = (scene_codes.astype(np.int64) << 32) | object_indices
+			positions = np.minimum(np.searchsorted(self.object_keys, object_keys), max(len(self.object_keys) - 1, 0))
+			found = (object_rows < 0) & (scene_codes >= 0) & (self.object_keys[positions] == object_keys) \
+				if len(self.object_keys) > 0 else np.zeros(len(turn_ids), dtype=bool)
+			object_rows[found] = positions[found]
+
+		resolved = object_rows >= 0
+		values = np.full((len(turn_ids), len(self.attribute_names)), -1, dtype=np.int32)
+		values[resolved] = self.object_values[object_rows[resolved]]
+		if 'domain' in self.attribute_names:
+			values[resolved, self.attribute_names.index('domain')] = self.turn_domain[turn_ids[resolved]]
+		return values
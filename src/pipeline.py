@@ -0,0 +1,350 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Pipeline stages whose outputs are cached on disk, keyed by a hash of their inputs and code.
+
+Usage (checks that editing the code of a stage invalidates its cache):
+	python -m src.pipeline
+"""
+
+import os
+import ast
+import glob
+import pickle
+import shutil
+import hashlib
+import inspect
+import tempfile
+import importlib.util
+from typing import List, Union
+
+from . import profiling
+
+
+CACHE_FOLDER = '.cache'
+
+# the code of the modules of this package is hashed with the modules they import, see hash_module
+_PACKAGE_NAME = __package__.split('.')[0]
+_package_folder = os.path.dirname(os.path.abspath(__file__))
+_module_hashes = {}
+
+
+def _hash_bytes(data: bytes) -> str:
+	return hashlib.sha1(data).hexdigest()
+
+
+def hash_file(file_path: str) -> str:
+	"""Hashes the content of a file."""
+	sha1 = hashlib.sha1()
+	with open(file_path, 'rb') as f_in:
+		for chunk in iter(lambda: f_in.read(2 ** 20), b''):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+
+def _get_module_file(module_name: str) -> str:
+	# source file of a module of this package, or None if there is no such module (e.g., a function name)
+	module_path = os.path.join(_package_folder, *module_name.split('.')[1:])
+	for file_path in [os.path.join(module_path, '__init__.py'), module_path + '.py']:
+		if os.path.isfile(file_path):
+			return file_path
+	return None
+
+
+def _get_module_imports(module_name: str, file_path: str, source: bytes) -> list:
+	# modules imported anywhere in the source, e.g., "from . import *" imports the package itself
+	package = module_name if os.path.basename(file_path) == '__init__.py' else module_name.rpartition('.')[0]
+	imports = []
+	for node in ast.walk(ast.parse(source)):
+		if isinstance(node, ast.Import):
+			imports += [x.name for x in node.names]
+		elif isinstance(node, ast.ImportFrom):
+			base = importlib.util.resolve_name('.' * node.level + (node.module or ''), package) \
+				if node.level > 0 else node.module
+			imports += [base] + [f"{base}.{x.name}" for x in node.names if x.name != '*']
+	return [x for x in imports if x.split('.')[0] == _PACKAGE_NAME]
+
+
+def hash_module(module_name: str) -> str:
+	"""
+	Hashes the source code of a module of this package and of all the modules of the package that it
+	imports, transitively. A stage that depends on src.evaluation is then recomputed if src/evaluate_dst.py,
+	src/__init__.py or any other module used by src.evaluation changes.
+
+	:param module_name: name of the module, e.g., src.evaluation
+	:return: hexadecimal hash
+	"""
+	if module_name not in _module_hashes:
+		sources, pending = {}, [module_name]
+		while len(pending) > 0:
+			name = pending.pop()
+			file_path = _get_module_file(name)
+			if name in sources or file_path is None:
+				continue
+			with open(file_path, 'rb') as f_in:
+				sources[name] = f_in.read()
+			pending += _get_module_imports(name, file_path, sources[name])
+		_module_hashes[module_name] = _hash_bytes(''.join(
+			f"{name}:{_hash_bytes(sources[name])}," for name in sorted(sources)).encode('utf-8'))
+	return _module_hashes[module_name]
+
+
+def _get_package_module_name(value) -> str:
+	# module of this package where a module, class, function or the class of an object is defined, if any
+	module_name = value.__name__ if inspect.ismodule(value) else getattr(
+		value if inspect.isclass(value) or inspect.isfunction(value) else type(value), '__module__', None)
+	return module_name if module_name and module_name.split('.')[0] == _PACKAGE_NAME else None
+
+
+def hash_value(value) -> str:
+	"""
+	Hashes a value given as input to a stage, or as a code dependency of a stage.
+	Stage results and files are hashed by their key. Modules, classes and functions of this package
+	are hashed by the source code of their module and the modules it imports (see hash_module), and
+	objects of this package (e.g., split expressions) by their representation and the same code.
+	Other modules, classes and functions are hashed by their source code, and everything else
+	by its representation.
+
+	:param value: the value to hash
+	:return: hexadecimal hash
+	"""
+	module_name = _get_package_module_name(value)
+	if isinstance(value, (StageResult, FileInput)):
+		return value.key
+	elif module_name is not None and (inspect.ismodule(value) or inspect.isclass(value) or inspect.isfunction(value)):
+		return _hash_bytes(f"{getattr(value, '__qualname__', module_name)}:{hash_module(module_name)}".encode('utf-8'))
+	elif inspect.ismodule(value) or inspect.isclass(value) or inspect.isfunction(value):
+		try:
+			return _hash_bytes(inspect.getsource(value).encode('utf-8'))
+		except (OSError, TypeError):
+			# no source available (e.g., defined in an interactive console)
+			return _hash_bytes(value.__code__.co_code) if inspect.isfunction(value) else _hash_bytes(
+				value.__name__.encode('utf-8'))
+	elif isinstance(value, dict):
+		return _hash_bytes(''.join(
+			f"{hash_value(k)}:{hash_value(v)}," for k, v in sorted(value.items(), key=lambda x: repr(x[0]))).encode('utf-8'))
+	elif isinstance(value, (list, tuple)):
+		return _hash_bytes(f"{type(value).__name__}({','.join(hash_value(x) for x in value)})".encode('utf-8'))
+	elif module_name is not None:
+		return _hash_bytes(f"{repr(value)}:{hash_module(module_name)}".encode('utf-8'))
+	else:
+		return _hash_bytes(repr(value).encode('utf-8'))
+
+
+class FileInput:
+	"""
+	Input of a stage that is one or more files. Its key is the hash of the content of the files,
+	so stages that depend on it are recomputed if any of the files change. The stage gets the path
+	if a single file path was given, or else the list of paths, even if a glob pattern matches one file.
+
+	:param paths: file path, list of paths or glob pattern
+	"""
+
+	def __init__(self, paths: Union[str, List[str]]):
+		self.is_single_file = isinstance(paths, str) and not glob.has_magic(paths)
+		if isinstance(paths, str):
+			paths = sorted(glob.glob(paths)) if glob.has_magic(paths) else [paths]
+		self.paths = paths
+		# the stage gets a path or a list, so they are different inputs even for the same file
+		self.key = _hash_bytes((f"{self.is_single_file}:" + ''.join(
+			f"{os.path.basename(x)}:{hash_file(x)}," for x in self.paths)).encode('utf-8'))
+
+	def __repr__(self) -> str:
+		return f"FileInput({len(self.paths)} files, {self.key[:8]})"
+
+
+def stage(*code_dependencies):
+	"""
+	Decorator that marks a function as a pipeline stage. The code of the function and
+	its dependencies (modules, functions or values such as keyword lists) are part
+	of the key of the stage, so changing them invalidates the cache. The dependencies
+	from this package include the modules they import, see hash_module.
+
+	:param code_dependencies: modules, functions or values that the stage depends on
+	:return: decorator
+	"""
+	def decorator(func):
+		func.stage_code_key = hash_value([func] + list(code_dependencies))
+		return func
+	return decorator
+
+
+class StageResult:
+	"""
+	Lazy result of a stage. Its key is known without running the stage, and
+	the value is only computed (or loaded from the cache) when it is accessed,
+	so the inputs of a stage are not loaded if its output is already cached.
+	"""
+
+	def __init__(self, pipeline, func, args: tuple, kwargs: dict):
+		self.pipeline, self.func, self.args, self.kwargs = pipeline, func, args, kwargs
+		self.name = func.__name__
+		self.key = hash_value([self.name, func.stage_code_key, list(args), kwargs])
+		self._has_value, self._value = False, None
+
+	def __repr__(self) -> str:
+		return f"StageResult({self.name}, {self.key[:8]})"
+
+	@property
+	def value(self):
+		if not self._has_value:
+			self._value, self._has_value = self.pipeline.get_value(self), True
+		return self._value
+
+
+def _resolve(value):
+	if isinstance(value, StageResult):
+		return value.value
+	elif isinstance(value, FileInput):
+		return value.paths[0] if value.is_single_file else value.paths
+	return value
+
+
+class Pipeline:
+	"""
+	Runs stages and caches their outputs on disk with pickle. Stages are keyed by a hash of
+	their name, code and inputs, where the inputs from other stages are hashed by their key.
+	Changing a file or a parameter only recomputes the stages that depend on it.
+
+	:param cache_folder: folder to store the outputs of the stages
+	:param enabled: whether to use the cache, otherwise all stages are always computed
+	"""
+
+	def __init__(self, cache_folder: str = CACHE_FOLDER, enabled: bool = True):
+		self.cache_folder = cache_folder
+		self.enabled = enabled
+		self.hits, self.misses = 0, 0
+
+	def __repr__(self) -> str:
+		return f"Pipeline({self.cache_folder}, {self.hits} cache hits, {self.misses} stages computed)"
+
+	def run(self, func, *args, **kwargs) -> StageResult:
+		"""
+		Adds a stage to the pipeline. Files should be given as FileInput and the outputs
+		of other stages as their StageResult, which are resolved to their values
+		before calling the stage function.
+
+		:param func: stage function, see the stage decorator
+		:return: lazy result of the stage
+		"""
+		if not hasattr(func, 'stage_code_key'):
+			raise ValueError(f"{func.__name__} is not a stage, use the @stage decorator")
+		return StageResult(self, func, args, kwargs)
+
+	def _get_cache_path(self, result: StageResult) -> str:
+		return os.path.join(self.cache_folder, f"{result.name}-{result.key}.pkl")
+
+	def is_cached(self, result: StageResult) -> bool:
+		"""Whether the output of a stage is available without computing it."""
+		return result._has_value or (self.enabled and os.path.exists(self._get_cache_path(result)))
+
+	def set_value(self, result: StageResult, value) -> None:
+		"""
+		Sets the output of a stage computed elsewhere, e.g., in parallel with other stages.
+		It must be the same output that the stage function would return.
+		"""
+		self.misses += 1
+		profiling.count('cache misses')
+		self._save(result, value)
+		result._value, result._has_value = value, True
+
+	def _save(self, result: StageResult, value) -> None:
+		if self.enabled:
+			os.makedirs(self.cache_folder, exist_ok=True)
+			# write to a temporary file first so a crash never leaves a broken cache entry
+			with tempfile.NamedTemporaryFile('wb', dir=self.cache_folder, delete=False) as f_out:
+				pickle.dump(value, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+			os.replace(f_out.name, self._get_cache_path(result))
+
+	def get_value(self, result: StageResult):
+		"""Loads the output of a stage from the cache, or computes it and caches it."""
+		cache_path = self._get_cache_path(result)
+		if self.enabled and os.path.exists(cache_path):
+			with profiling.stage(f"{result.name} (cached)"), open(cache_path, 'rb') as f_in:
+				self.hits += 1
+				profiling.count('cache hits')
+				return pickle.load(f_in)
+
+		# resolve the inputs first, so the time of the stages they come from is not added to this one
+		args = [_resolve(x) for x in result.args]
+		kwargs = {k: _resolve(v) for k, v in result.kwargs.items()}
+		with profiling.stage(result.name):
+			self.misses += 1
+			profiling.count('cache misses')
+			value = result.func(*args, **kwargs)
+			self._save(result, value)
+
+		return value
+
+
+def test_cache_invalidation():
+	"""
+	Tests that editing the code that a stage runs invalidates its cache, including the modules imported by its
+	dependencies (src/evaluate_dst.py and src/__init__.py by src.evaluation) and the code of the split expressions
+	given as inputs (src/splits.py), but not editing other modules (src/service.py). The package is copied to a
+	temporary folder, so the edits do not change the code.
+	"""
+	global _package_folder
+	from . import evaluation, splits
+
+	@stage(evaluation)
+	def evaluate_stage(filter_func) -> str:
+		return repr(filter_func)
+
+	original_folder = _package_folder
+	with tempfile.TemporaryDirectory() as temp_folder:
+		_package_folder = os.path.join(temp_folder, _PACKAGE_NAME)
+		shutil.copytree(original_folder, _package_folder, ignore=shutil.ignore_patterns('__pycache__'))
+		test_pipeline = Pipeline(os.path.join(temp_folder, CACHE_FOLDER))
+		try:
+			for file_name, is_dependency in [
+					('evaluate_dst.py', True), ('__init__.py', True), ('splits.py', True), ('service.py', False)]:
+				# decorate the stage again, as the code of the scripts is hashed when they are loaded
+				_module_hashes.clear()
+				evaluate_stage = stage(evaluation)(evaluate_stage)
+				test_pipeline.run(evaluate_stage, splits.parse_split('tag:spatial')).value
+				hits = test_pipeline.hits
+				with open(os.path.join(_package_folder, file_name), 'a') as f_out:
+					f_out.write('\n# edited\n')
+
+				_module_hashes.clear()
+				evaluate_stage = stage(evaluation)(evaluate_stage)
+				test_pipeline.run(evaluate_stage, splits.parse_split('tag:spatial')).value
+				assert (test_pipeline.hits == hits) == is_dependency, \
+					f"Test failed editing {file_name}: the cache was {'not ' if is_dependency else ''}invalidated"
+		finally:
+			_package_folder = original_folder
+			_module_hashes.clear()
+
+	print('Pipeline cache invalidation tests passed!')
+
+
+def test_file_input():
+	"""
+	Tests that a stage gets the path of a single file path, and a list of paths for a glob pattern
+	or a list, whatever the number of files that they match.
+	"""
+	with tempfile.TemporaryDirectory() as temp_folder:
+		file_path = os.path.join(temp_folder, 'scene.json')
+		with open(file_path, 'w') as f_out:
+			f_out.write('{}')
+
+		for paths, expected_value in [
+				(file_path, file_path), (os.path.join(temp_folder, '*.json'), [file_path]), ([file_path], [file_path]),
+				(os.path.join(temp_folder, '*.txt'), [])]:
+			value = _resolve(FileInput(paths))
+			assert value == expected_value, f"Test failed for FileInput({paths}): {value} != {expected_value}"
+
+	print('Pipeline file input tests passed!')
+
+
+if __name__ == '__main__':
+	test_cache_invalidation()
+	test_file_input()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Loading and compact storage of the model outputs (predictions).
+"""
+
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from . import iterate_over_dataset_entries, fix_prediction_data_format
+from .alignment import ModelAlignment
+from .columnar import ColumnarDataset, load_dataset
+
+
+def load_model_output(file_path: str):
+	"""
+	Loads a model output file. If the dialogues have more than 1 turn, it is viewed as
+	one turn per dialogue (it's a specific format from SIMMC2 challenge).
+
+	:param file_path: path to the json file with the model output, or to its columnar folder (see columnar.py)
+	:return: model output, in the same format as SIMMC2
+	"""
+	return format_model_output(load_dataset(file_path))
+
+
+def format_model_output(model_output: dict):
+	"""
+	Same as load_model_output, for a model output already in memory.
+
+	:param model_output: model output, in the same format as SIMMC2
+	:return: model output, viewed as one turn per dialogue if needed
+	"""
+	# make sure that the dialogues have at most 1 turn
+	for dialogue in model_output['dialogue_data'][:3]:
+		if len(dialogue['dialogue']) > 1:
+			# we need to fix this dataset!
+			return fix_prediction_data_format(model_output)
+
+	return model_output
+
+
+class _ModelPredictions:
+	"""Predicted objects of a model, in CSR format over the global turn ids."""
+	__slots__ = ('indptr', 'indices', 'has_prediction', 'source_path', 'turn_to_prediction')
+
+	def __init__(self, indptr, indices, has_prediction, source_path, turn_to_prediction):
+		self.indptr, self.indices, self.has_prediction = indptr, indices, has_prediction
+		self.source_path, self.turn_to_prediction = source_path, turn_to_prediction
+
+
+class PredictionStore:
+	"""
+	Compact store of the objects predicted by several models. For each model, it only keeps
+	the predicted object ids of every turn as two int32 arrays (CSR style): the objects of
+	the turn with global id t are indices[indptr[t]:indptr[t + 1]]. Global turn ids are the
+	positions of the turns of the original data in iterate_over_dataset_entries.
+
+	The rest of the model output is not kept, but the raw turn can still be loaded
+	from its file when needed, e.g., for error analysis.
+
+	:param num_turns: number of turns in the original data
+	"""
+
+	def __init__(self, num_turns: int):
+		self.num_turns = num_turns
+		self._models = {}
+		self._raw_cache = None      # (model_name, raw turns) of the last model loaded from file
+
+	def __contains__(self, model_name: str) -> bool:
+		return model_name in self._models
+
+	def __len__(self) -> int:
+		return len(self._models)
+
+	def __repr__(self) -> str:
+		return f"PredictionStore({len(self)} models, {self.num_turns} turns, {self.nbytes / 2**20:.1f}MB)"
+
+	@property
+	def model_names(self) -> List[str]:
+		return list(self._models.keys())
+
+	@property
+	def nbytes(self) -> int:
+		"""Memory used by the arrays of all the models, in bytes."""
+		return sum(
+			x.indptr.nbytes + x.indices.nbytes + x.has_prediction.nbytes + x.turn_to_prediction.nbytes
+			for x in self._models.values())
+
+	def add_model(
+		self, model_name: str, model_output, model_alignment: ModelAlignment, source_path: str = None) -> None:
+		"""
+		Adds the predictions of a model to the store. The model output can be freed afterwards.
+
+		:param model_name: name of the model
+		:param model_output: model output, in the same format as SIMMC2
+		:param model_alignment: alignment of the model output with the original data
+		:param source_path: path of the file of the model output, used to load raw turns lazily
+		"""
+		if len(model_alignment.turn_to_prediction) != self.num_turns:
+			raise ValueError(
+				f"Alignment of {model_name} has {len(model_alignment.turn_to_prediction)} turns, "
+				f"expected {self.num_turns}")
+
+		if isinstance(model_output, ColumnarDataset) and model_output.has_predictions:
+			# the predicted objects are already in CSR style, only gather the rows of each turn
+			self._add_model_rows(
+				model_name, *model_output.get_prediction_arrays(), model_alignment.turn_to_prediction, source_path)
+			return
+
+		pred_turns = [turn for _, turn in iterate_over_dataset_entries(model_output)]
+		self.add_model_objects(
+			model_name,
+			(pred_turns[x]['pred_objects'] if x >= 0 else None for x in model_alignment.turn_to_prediction),
+			source_path=source_path, turn_to_prediction=model_alignment.turn_to_prediction)
+
+	def add_model_objects(
+		self, model_name: str, objects_by_turn: Iterator[Optional[list]], source_path: str = None,
+		turn_to_prediction: np.ndarray = None) -> None:
+		"""
+		Adds the predictions of a model to the store from its predicted objects.
+
+		:param model_name: name of the model
+		:param objects_by_turn: predicted objects of each global turn id, None if the model did not predict it
+		:param source_path: path of the file of the model output, used to load raw turns lazily
+		:param turn_to_prediction: position of the prediction of each turn in the file, see ModelAlignment
+		"""
+		indptr = np.zeros(self.num_turns + 1, dtype=np.int32)
+		has_prediction = np.zeros(self.num_turns, dtype=bool)
+		indices = []
+		turn_id = -1
+		for turn_id, objects in enumerate(objects_by_turn):
+			if objects is not None:
+				has_prediction[turn_id] = True
+				indices.extend(objects)
+			indptr[turn_id + 1] = len(indices)
+
+		if turn_id + 1 != self.num_turns:
+			raise ValueError(f"Got {turn_id + 1} turns for {model_name}, expected {self.num_turns}")
+		if turn_to_prediction is None:
+			turn_to_prediction = np.where(has_prediction, np.arange(self.num_turns), -1).astype(np.int32)
+
+		self._models[model_name] = _ModelPredictions(
+			indptr, np.array(indices, dtype=np.int32), has_prediction, source_path, turn_to_prediction)
+
+	def _add_model_rows(
+		self, model_name: str, pred_indptr: np.ndarray, pred_indices: np.ndarray, has_pred_objects: np.ndarray,
+		turn_to_prediction: np.ndarray, source_path: str = None) -> None:
+		# same as add_model_objects, from the objects of the model output in CSR style
+		has_prediction = turn_to_prediction >= 0
+		has_prediction[has_prediction] = has_pred_objects[turn_to_prediction[has_prediction]]
+		rows = turn_to_prediction[has_prediction]
+		lengths = np.zeros(self.num_turns, dtype=np.int64)
+		lengths[has_prediction] = pred_indptr[rows + 1] - pred_indptr[rows]
+		indptr = np.zeros(self.num_turns + 1, dtype=np.int32)
+		np.cumsum(lengths, out=indptr[1:])
+		# position of each object in the model output: the start of its row plus its position in the row
+		indices = pred_indices[
+			np.repeat(pred_indptr[rows] - indptr[:-1][has_prediction], lengths[has_prediction]) + np.arange(indptr[-1])]
+
+		self._models[model_name] = _ModelPredictions(
+			indptr, indices.astype(np.int32), has_prediction, source_path, turn_to_prediction)
+
+	def remove_model(self, model_name: str) -> None:
+		del self._models[model_name]
+		if self._raw_cache is not None and self._raw_cache[0] == model_name:
+			self._raw_cache = None
+
+	def has_prediction(self, model_name: str, turn_id: int) -> bool:
+		return bool(self._models[model_name].has_prediction[turn_id])
+
+	def get_objects(self, model_name: str, turn_id: int) -> Optional[np.ndarray]:
+		"""
+		Gets the objects predicted by a model in a turn.
+
+		:param model_name: name of the model
+		:param turn_id: global turn id
+		:return: array of object ids, or None if the model did not predict the turn
+		"""
+		predictions = self._models[model_name]
+		if not predictions.has_prediction[turn_id]:
+			return None
+		return predictions.indices[predictions.indptr[turn_id]:predictions.indptr[turn_id + 1]]
+
+	def get_model_arrays(self, model_name: str) -> tuple:
+		"""
+		Gets the arrays of a model, to operate on all the turns at once.
+
+		:param model_name: name of the model
+		:return: (indptr, indices, has_prediction)
+		"""
+		predictions = self._models[model_name]
+		return predictions.indptr, predictions.indices, predictions.has_prediction
+
+	def get_raw_turn(self, model_name: str, turn_id: int) -> Optional[dict]:
+		"""
+		Gets the full turn of a model output, as it is in its file. The file is only loaded
+		when requested, and only the turns of the last model requested are kept in memory.
+
+		:param model_name: name of the model
+		:param turn_id: global turn id
+		:return: the turn of the model output, or None if the model did not predict the turn
+		"""
+		predictions = self._models[model_name]
+		if predictions.source_path is None:
+			raise ValueError(f"Model {model_name} was added without a source path, raw turns are not available")
+		if not predictions.has_prediction[turn_id]:
+			return None
+
+		if self._raw_cache is None or self._raw_cache[0] != model_name:
+			self._raw_cache = None      # free the previous model first
+			self._raw_cache = model_name, [
+				turn for _, turn in iterate_over_dataset_entries(load_model_output(predictions.source_path))]
+
+		return self._raw_cache[1][predictions.turn_to_prediction[turn_id]]
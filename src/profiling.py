@@ -0,0 +1,227 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Built-in profiling: wall and CPU time of each stage, counters and memory usage, saved as a Chrome trace.
+It is disabled by default, and then stage() and count() do nothing.
+
+Usage:
+	profiling.enable()
+	with profiling.stage('load data'):
+		...
+		profiling.count('turns scanned', len(turns))
+	profiler = profiling.disable()
+	profiler.save('profile.json')     # open it in chrome://tracing or https://ui.perfetto.dev
+"""
+
+import os
+import json
+import time
+import threading
+import itertools
+import contextlib
+from collections import Counter
+
+try:
+	import resource
+except ImportError:     # not available on Windows
+	resource = None
+
+
+DEFAULT_MEMORY_INTERVAL = 0.05     # seconds between memory samples
+
+
+def get_memory_usage() -> int:
+	"""
+	Gets the memory used by this process, in bytes. It is the current resident memory
+	on Linux and the peak resident memory on other platforms.
+	"""
+	try:
+		with open('/proc/self/statm', 'r') as f_in:
+			return int(f_in.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError, IndexError):
+		pass
+	if resource is not None:
+		# kilobytes on Linux, bytes on macOS
+		max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+	return 0
+
+
+class Profiler:
+	"""
+	Records the stages run, with their wall and CPU time, counters and samples of the memory
+	used by the process in a background thread. CPU time is the time of the thread that ran
+	the stage, so work done in other processes (e.g., process pools) is not included.
+	The peak memory of a stage is the highest sample taken while it ran. Only the peak of
+	the open stages is kept, and the trace only has the samples where the memory changed,
+	so profiling a long run (e.g., run_experiments.py --watch) does not grow with its time.
+
+	:param memory_interval: seconds between memory samples, None to not sample memory
+	"""
+
+	def __init__(self, memory_interval: float = DEFAULT_MEMORY_INTERVAL):
+		self.memory_interval = memory_interval
+		self.counters = Counter()
+		self.stages = {}            # name -> [calls, wall time, CPU time, peak memory]
+		self.peak_memory = 0
+		self._stage_peaks = {}      # id of each open stage -> its peak memory so far
+		self._stage_ids = itertools.count()
+		self._last_memory_mb = None
+		self._events = []           # Chrome trace events
+		self._lock = threading.Lock()
+		self._start_time = time.perf_counter()
+		self._stop_event = threading.Event()
+		self._sampler = None
+
+	def _get_timestamp(self) -> float:
+		# microseconds since the profiler started, as in Chrome traces
+		return (time.perf_counter() - self._start_time) * 1e6
+
+	def _sample_memory(self) -> None:
+		memory_usage = get_memory_usage()
+		memory_mb = round(memory_usage / 2 ** 20, 1)
+		with self._lock:
+			self.peak_memory = max(self.peak_memory, memory_usage)
+			for stage_id, peak_memory in self._stage_peaks.items():
+				self._stage_peaks[stage_id] = max(peak_memory, memory_usage)
+			# counters in the trace keep their value until the next event, so the same value is not repeated
+			if memory_mb != self._last_memory_mb:
+				self._last_memory_mb = memory_mb
+				self._events.append({
+					'name': 'memory', 'ph': 'C', 'ts': self._get_timestamp(), 'pid': os.getpid(),
+					'args': {'MB': memory_mb}})
+
+	def _run_sampler(self) -> None:
+		while not self._stop_event.wait(self.memory_interval):
+			self._sample_memory()
+
+	def start(self) -> None:
+		"""Starts sampling the memory in the background."""
+		self._sample_memory()
+		if self.memory_interval is not None and self._sampler is None:
+			self._sampler = threading.Thread(target=self._run_sampler, name='memory-sampler', daemon=True)
+			self._sampler.start()
+
+	def stop(self) -> None:
+		"""Stops sampling the memory."""
+		if self._sampler is not None:
+			self._stop_event.set()
+			self._sampler.join()
+			self._sampler = None
+		self._sample_memory()
+
+	@contextlib.contextmanager
+	def stage(self, name: str, **args):
+		"""
+		Context manager that times a stage. Stages can be nested.
+
+		:param name: name of the stage, stages with the same name are added up in the summary
+		:param args: extra information to show in the trace
+		"""
+		stage_id = next(self._stage_ids)
+		with self._lock:
+			self._stage_peaks[stage_id] = 0
+		self._sample_memory()
+		start_time, start_cpu = time.perf_counter(), time.thread_time()
+		try:
+			yield
+		finally:
+			wall_time, cpu_time = time.perf_counter() - start_time, time.thread_time() - start_cpu
+			self._sample_memory()
+			with self._lock:
+				peak_memory = self._stage_peaks.pop(stage_id)
+
+			totals = self.stages.setdefault(name, [0, 0., 0., 0])
+			totals[0] += 1
+			totals[1] += wall_time
+			totals[2] += cpu_time
+			totals[3] = max(totals[3], peak_memory)
+			self._events.append({
+				'name': name, 'ph': 'X', 'ts': (start_time - self._start_time) * 1e6, 'dur': wall_time * 1e6,
+				'pid': os.getpid(), 'tid': threading.get_ident(),
+				'args': {'cpu_ms': round(cpu_time * 1000, 3), 'peak_memory_mb': round(peak_memory / 2 ** 20, 1), **args}})
+
+	def count(self, name: str, value: int = 1) -> None:
+		"""Adds to a counter, e.g., the number of turns scanned."""
+		self.counters[name] += value
+
+	def get_trace(self) -> dict:
+		"""
+		Gets the report in the Chrome trace format, with the totals of
+		the stages, the counters and the peak memory as metadata.
+		"""
+		return {
+			'traceEvents': sorted(self._events, key=lambda x: x['ts']) + [
+				{'name': 'counters', 'ph': 'C', 'ts': self._get_timestamp(), 'pid': os.getpid(),
+					'args': dict(self.counters)}],
+			'displayTimeUnit': 'ms',
+			'otherData': {
+				'stages': {
+					name: {
+						'calls': calls, 'wall_s': wall_time, 'cpu_s': cpu_time,
+						'peak_memory_mb': round(peak_memory / 2 ** 20, 1)}
+					for name, (calls, wall_time, cpu_time, peak_memory) in self.stages.items()},
+				'counters': dict(self.counters),
+				'peak_memory_mb': round(self.peak_memory / 2 ** 20, 1),
+			},
+		}
+
+	def save(self, file_path: str) -> None:
+		"""Saves the report as a Chrome trace json, see get_trace."""
+		with open(file_path, 'w') as f_out:
+			json.dump(self.get_trace(), f_out)
+
+	def summary(self) -> str:
+		"""Gets a table with the stages sorted by wall time, the counters and the peak memory."""
+		lines = [f"{'Stage':<40} {'Calls':>6} {'Wall (s)':>10} {'CPU (s)':>10} {'Memory (MB)':>12}"]
+		for name, (calls, wall_time, cpu_time, peak_memory) in sorted(self.stages.items(), key=lambda x: -x[1][1]):
+			lines.append(f"{name:<40} {calls:>6} {wall_time:>10.3f} {cpu_time:>10.3f} {peak_memory / 2 ** 20:>12.1f}")
+		for name, value in sorted(self.counters.items()):
+			lines.append(f"{name:<40} {value:>6}")
+		lines.append(f"{'peak memory (MB)':<40} {self.peak_memory / 2 ** 20:>6.1f}")
+		return '\n'.join(lines)
+
+
+# the profiler in use, None when profiling is disabled
+_profiler = None
+
+
+def enable(memory_interval: float = DEFAULT_MEMORY_INTERVAL) -> Profiler:
+	"""Starts profiling with a new profiler, see Profiler."""
+	global _profiler
+	_profiler = Profiler(memory_interval)
+	_profiler.start()
+	return _profiler
+
+
+def disable() -> Profiler:
+	"""Stops profiling and returns the profiler with the results."""
+	global _profiler
+	profiler, _profiler = _profiler, None
+	if profiler is not None:
+		profiler.stop()
+	return profiler
+
+
+def is_enabled() -> bool:
+	return _profiler is not None
+
+
+def stage(name: str, **args):
+	"""Times a stage if profiling is enabled, see Profiler.stage."""
+	if _profiler is None:
+		return contextlib.nullcontext()
+	return _profiler.stage(name, **args)
+
+
+def count(name: str, value: int = 1) -> None:
+	"""Adds to a counter if profiling is enabled, see Profiler.count."""
+	if _profiler is not None:
+		_profiler.count(name, value)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Discovery and parallel loading of the model output files.
+"""
+
+import os
+import fnmatch
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from . import alignment
+from .predictions import PredictionStore, load_model_output
+
+
+DEFAULT_PREDICTION_FILE = 'coref-pred-devtest-mini.json'
+
+
+def parse_model_file(model_name: str, model_file: str, turn_keys: List[Tuple[int, int]]) -> tuple:
+	"""
+	Loads a model output file, aligns it with the original data and only keeps its
+	predicted objects. The result is compact, so it is cheap to send between processes.
+
+	:param model_name: name of the model
+	:param model_file: path to the model output file
+	:param turn_keys: (dialogue_idx, turn_idx) of the original data, see alignment.get_turn_keys
+	:return: (PredictionStore with only this model, ModelAlignment)
+	"""
+	model_output = load_model_output(model_file)
+	# align the model output with the original data by (dialogue_idx, turn_idx), so gaps are allowed
+	model_alignment = alignment.align_turn_keys(model_name, turn_keys, alignment.get_turn_keys(model_output))
+	# only keep the predicted objects, the rest of the model output can be loaded later if needed
+	model_predictions = PredictionStore(len(turn_keys))
+	model_predictions.add_model(model_name, model_output, model_alignment, source_path=model_file)
+	return model_predictions, model_alignment
+
+
+# turn keys of the original data in each worker process, sent once when the worker starts
+_worker_turn_keys = None
+
+
+def _init_worker(turn_keys: List[Tuple[int, int]]) -> None:
+	global _worker_turn_keys
+	_worker_turn_keys = turn_keys
+
+
+def _parse_model_file_worker(model_name: str, model_file: str) -> tuple:
+	return parse_model_file(model_name, model_file, _worker_turn_keys)
+
+
+class ModelRegistry:
+	"""
+	Finds the model output files in a folder, where each model has its own sub-folder
+	named after the model. Include and exclude rules are glob patterns over the model
+	names (e.g., 'Team*'), applied before parsing any file so only the models used are loaded.
+
+	:param data_folder: folder with the model sub-folders
+	:param prediction_file: name of the model output file in each sub-folder
+	:param include: patterns of the models to load, default all
+	:param exclude: patterns of the models to skip, they take priority over include
+	"""
+
+	def __init__(
+		self, data_folder: str, prediction_file: str = DEFAULT_PREDICTION_FILE,
+		include: List[str] = None, exclude: List[str] = None):
+		self.data_folder = data_folder
+		self.prediction_file = prediction_file
+		self.include = include or ['*']
+		self.exclude = exclude or []
+
+	def is_selected(self, model_name: str) -> bool:
+		"""Whether a model passes the include and exclude rules."""
+		return any(fnmatch.fnmatchcase(model_name, x) for x in self.include) and \
+			not any(fnmatch.fnmatchcase(model_name, x) for x in self.exclude)
+
+	def discover(self) -> Dict[str, str]:
+		"""
+		Finds the model output files of the selected models, without reading them.
+		Excluded folders are not explored.
+
+		:return: dict of model name -> model output file, sorted by model name
+		"""
+		model_files = {}
+		for subdir, dirs, files in os.walk(self.data_folder):
+			# do not go into folders of excluded models
+			dirs[:] = [x for x in dirs if not any(fnmatch.fnmatchcase(x, y) for y in self.exclude)]
+			model_name = os.path.basename(subdir)
+			if self.prediction_file in files and self.is_selected(model_name):
+				model_files[model_name] = os.path.join(subdir, self.prediction_file)
+
+		return dict(sorted(model_files.items(), key=lambda item: item[0]))
+
+	def discover_files(self, pattern: str) -> Dict[str, str]:
+		"""
+		Finds all the files of the selected models that match a glob pattern, e.g., the model
+		outputs of several checkpoints. Each file is named after its model, see get_output_name.
+
+		:param pattern: glob pattern over the file names, e.g., 'coref-pred-*.json'
+		:return: dict of output name -> file, sorted by name
+		"""
+		model_files = {}
+		for subdir, dirs, files in os.walk(self.data_folder):
+			dirs[:] = [x for x in dirs if not any(fnmatch.fnmatchcase(x, y) for y in self.exclude)]
+			model_name = os.path.basename(subdir)
+			if not self.is_selected(model_name):
+				continue
+			for file_name in fnmatch.filter(files, pattern):
+				model_files[self.get_output_name(model_name, file_name)] = os.path.join(subdir, file_name)
+
+		return dict(sorted(model_files.items(), key=lambda item: item[0]))
+
+	def get_output_name(self, model_name: str, file_name: str) -> str:
+		"""
+		Name of a model output file, which is the model name for the default prediction file
+		and 'model/suffix' for other files, e.g., 'Team9/devtest-step100' for coref-pred-devtest-step100.json.
+		"""
+		if file_name == self.prediction_file:
+			return model_name
+		suffix = os.path.splitext(file_name)[0]
+		if suffix.startswith('coref-pred-'):
+			suffix = suffix[len('coref-pred-'):]
+		return f"{model_name}/{suffix}"
+
+	def load(
+		self, turn_keys: List[Tuple[int, int]], model_files: Dict[str, str] = None,
+		processes: int = None) -> Dict[str, tuple]:
+		"""
+		Parses the model output files in parallel in a process pool if the platform can fork, see parse_model_file.
+		Only the compact predictions are sent back from the workers.
+
+		:param turn_keys: (dialogue_idx, turn_idx) of the original data, see alignment.get_turn_keys
+		:param model_files: files to load, default all the files discovered
+		:param processes: number of worker processes, default is the number of CPUs. Use 1 to load serially
+		:return: dict of model name -> (PredictionStore with only this model, ModelAlignment)
+		"""
+		if model_files is None:
+			model_files = self.discover()
+
+		if processes == 1 or len(model_files) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+			return {
+				model_name: parse_model_file(model_name, model_file, turn_keys)
+				for model_name, model_file in model_files.items()}
+
+		with ProcessPoolExecutor(
+			max_workers=min(processes or multiprocessing.cpu_count(), len(model_files)),
+			mp_context=multiprocessing.get_context('fork'), initializer=_init_worker, initargs=(turn_keys,)) as executor:
+			futures = {
+				model_name: executor.submit(_parse_model_file_worker, model_name, model_file)
+				for model_name, model_file in model_files.items()}
+			return {model_name: future.result() for model_name, future in futures.items()}
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Approximate evaluation on a stratified sample of the turns, with the sampling error of the estimates.
+Turns are stratified by their role in a CE and the tags of the CE, and sampled systematically in dialogue
+order within each stratum, so every dialogue and CE split is represented and every turn has the same
+chance of being sampled.
+
+Usage:
+	python -m src.sampling --fraction 0.05      # evaluate 5% of the turns
+	python -m src.sampling --time-budget 30     # evaluate as many turns as possible in about 30 seconds
+"""
+
+import os
+import glob
+import json
+import time
+import argparse
+
+import numpy as np
+
+from . import iterate_over_dataset_entries, prepare_dataset, format_number
+from . import alignment, ce, evaluation, splits, tagging
+from .registry import ModelRegistry
+
+
+DEFAULT_FRACTION = 0.05
+DEFAULT_PILOT_FRACTION = 0.01   # fraction of the turns evaluated to estimate the time of a time budget
+CONFIDENCE_Z = 1.96             # 95% confidence intervals
+
+# tags of the CEs that define the strata, the same as the splits of the paper
+STRATUM_TAGS = [tagging.TAG_INDIVIDUAL_PROPERTY, tagging.TAG_DIALOGUE_HISTORY, tagging.TAG_RELATIONAL_CONTEXT]
+
+
+def get_turn_stratum(turn: dict) -> tuple:
+	"""
+	Gets the stratum of a turn: its role in a CE ('before', 'after' or 'none')
+	and, for the turns before the CR, the tags of the CE.
+
+	:param turn: turn of the original data, with the CEs already marked
+	:return: (CE role, tags of the CE joined by '+')
+	"""
+	if ce.is_ce_turn(turn):
+		return 'before', '+'.join(x for x in STRATUM_TAGS if turn['ce'].is_tag_in_ce(x))
+	return turn.get('ce_turn', 'none'), ''
+
+
+class StratifiedSample:
+	"""
+	Sample of the turns of a dataset, with the stratum of each sampled turn and the size of
+	each stratum in the whole dataset and in the sample, to estimate the sampling error.
+	The turns are a list of (dialogue, turn), so they can be given to any function that
+	iterates over a dataset, e.g., evaluation.evaluate_dataset.
+
+	Draw it with StratifiedSample.from_dataset.
+	"""
+
+	def __init__(
+		self, dataset: dict, turns: list, turn_strata: np.ndarray, stratum_names: list,
+		stratum_sizes: np.ndarray, fraction: float):
+		self.dataset = dataset
+		self.turns = turns
+		self.turn_strata = turn_strata
+		self.stratum_names = stratum_names
+		self.stratum_sizes = stratum_sizes
+		self.stratum_samples = np.bincount(turn_strata, minlength=len(stratum_names))
+		self.fraction = fraction
+
+	def __len__(self) -> int:
+		return len(self.turns)
+
+	def __repr__(self) -> str:
+		return f"StratifiedSample({len(self)} of {self.num_turns} turns, {len(self.stratum_names)} strata)"
+
+	@property
+	def num_turns(self) -> int:
+		"""Number of turns in the whole dataset."""
+		return int(self.stratum_sizes.sum())
+
+	@classmethod
+	def from_dataset(cls, dataset: dict, fraction: float = DEFAULT_FRACTION, seed: int = 0) -> 'StratifiedSample':
+		"""
+		Draws a sample of the turns of a dataset. Each stratum is sampled systematically: its turns are
+		kept in dialogue order and one turn is taken every 1 / fraction turns, from a random start.
+		Every turn has the same chance of being sampled (fraction), so the metrics of the sample
+		are estimates of those of the whole dataset without weighting.
+
+		:param dataset: the original SIMMC2 data, with the CEs already marked (see prepare_dataset)
+		:param fraction: fraction of the turns to sample, between 0 and 1
+		:param seed: random seed of the sample
+		:return: the sample
+		"""
+		if not 0 < fraction <= 1:
+			raise ValueError(f"Sample fraction must be between 0 and 1, got {fraction}")
+
+		all_turns, all_strata, stratum_codes = [], [], {}
+		for dialogue_datum, turn_datum in iterate_over_dataset_entries(dataset):
+			all_turns.append((dialogue_datum, turn_datum))
+			all_strata.append(stratum_codes.setdefault(get_turn_stratum(turn_datum), len(stratum_codes)))
+		all_strata = np.array(all_strata, dtype=np.int32)
+		stratum_sizes = np.bincount(all_strata, minlength=len(stratum_codes))
+
+		rng = np.random.default_rng(seed)
+		sampled_turns = []
+		for stratum_code in range(len(stratum_codes)):
+			stratum_turns = np.flatnonzero(all_strata == stratum_code)
+			positions = np.arange(rng.uniform(0, 1 / fraction), len(stratum_turns), 1 / fraction).astype(np.int64)
+			sampled_turns.append(stratum_turns[positions])
+		sampled_turns = np.sort(np.concatenate(sampled_turns))
+
+		return cls(
+			dataset, [all_turns[x] for x in sampled_turns], all_strata[sampled_turns], list(stratum_codes),
+			stratum_sizes, fraction)
+
+	def get_ratio_stderr(self, numerators: np.ndarray, denominators: np.ndarray) -> float:
+		"""
+		Estimates the standard error of a ratio of totals over the turns (e.g., F1 or the mean
+		candidates of a split) with the linearised variance of a stratified sample.
+		Turns outside the split should have 0 in both. Strata with less than 2 sampled turns
+		do not add to the variance.
+
+		:param numerators: numerator of each sampled turn, in the same order as turns
+		:param denominators: denominator of each sampled turn, in the same order as turns
+		:return: standard error of sum(numerators) / sum(denominators), NaN if the denominator is 0
+		"""
+		weights = (self.stratum_sizes / np.maximum(self.stratum_samples, 1))[self.turn_strata]
+		denominator_total = np.sum(weights * denominators)
+		if denominator_total == 0:
+			return np.nan
+		residuals = numerators - np.sum(weights * numerators) / denominator_total * denominators
+
+		variance = 0.
+		for stratum_code, (stratum_size, stratum_samples) in enumerate(zip(self.stratum_sizes, self.stratum_samples)):
+			if stratum_samples < 2:
+				continue
+			stratum_variance = np.var(residuals[self.turn_strata == stratum_code], ddof=1)
+			variance += stratum_size ** 2 * (1 - stratum_samples / stratum_size) * stratum_variance / stratum_samples
+		return float(np.sqrt(variance) / denominator_total)
+
+
+def get_fraction_for_time_budget(
+	dataset: dict, time_budget: float, evaluate_func, pilot_fraction: float = DEFAULT_PILOT_FRACTION,
+	seed: int = 0) -> float:
+	"""
+	Finds the sample fraction that can be evaluated in a time budget, by timing the evaluation
+	of a small pilot sample and assuming the time grows linearly with the turns sampled.
+
+	:param dataset: the original SIMMC2 data, with the CEs already marked
+	:param time_budget: seconds to evaluate the sample
+	:param evaluate_func: function that takes a StratifiedSample and evaluates it
+	:param pilot_fraction: fraction of the turns of the pilot sample
+	:param seed: random seed of the pilot sample
+	:return: fraction of the turns to sample, at most 1
+	"""
+	pilot_sample = StratifiedSample.from_dataset(dataset, pilot_fraction, seed)
+	start_time = time.perf_counter()
+	evaluate_func(pilot_sample)
+	pilot_time = time.perf_counter() - start_time
+	if pilot_time <= 0:
+		return 1.
+	return float(min(1., pilot_fraction * time_budget / pilot_time))
+
+
+def _get_turn_object_counts(
+	sample: StratifiedSample, filter_func, model_name: str, part: str, missing_policy: str,
+	predictions) -> np.ndarray:
+	"""Counts (true, predicted, correct) objects of each sampled turn, as evaluate_dataset, 0 if not evaluated."""
+	object_counts = np.zeros((len(sample), 3), dtype=np.float64)
+	for i, (_, turn) in enumerate(sample.turns):
+		if filter_func is not None and not filter_func(turn):
+			continue
+		pred_turn = turn if part is None else getattr(turn['ce'], part)
+		# as evaluate_dataset, a CE is skipped if either of its turns is
+		evaluated_turns = [turn] if part is None else [turn['ce'].before_cr_datum, turn['ce'].after_cr_datum]
+		if missing_policy != alignment.MISSING_EMPTY and any(
+				evaluation.get_predicted_objects(x, model_name, predictions) is None for x in evaluated_turns):
+			continue
+		pred_objects = evaluation.get_predicted_objects(pred_turn, model_name, predictions) or []
+
+		true_objects = set(turn['transcript_annotated']['act_attributes']['objects'])
+		pred_objects = set(pred_objects)
+		object_counts[i] = len(true_objects), len(pred_objects), len(true_objects & pred_objects)
+	return object_counts
+
+
+def evaluate_sample(
+	sample: StratifiedSample, filter_func=None, *, model_names: list = None,
+	missing_policy: str = alignment.MISSING_SKIP, predictions=None) -> dict:
+	"""
+	Estimates the results of evaluation.evaluate_dataset from a sample. It evaluates the
+	sampled turns with evaluate_dataset, and adds the sampling error of the object F1
+	of each model ('object_f1_sampling_stderr') and its 95% confidence interval ('object_f1_ci').
+	The 'object_f1_stderr' is still the standard error of the F1 over the sampled turns.
+
+	:param sample: the sample of the turns, see StratifiedSample
+	:param filter_func: function that takes a turn and returns True if it should be evaluated
+	:param model_names: models to evaluate, default all the models with outputs in the sample
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:param predictions: store with the predictions of the models
+	:return dict: result metrics, in the same format as evaluate_dataset
+	"""
+	# whether the split is evaluated Before-CR and After-CR depends on its first turn in the whole dataset
+	first_turn = next((
+		turn for _, turn in iterate_over_dataset_entries(sample.dataset) if filter_func is None or filter_func(turn)), None)
+	analysis = evaluation.evaluate_dataset(
+		sample.turns, filter_func, model_names=model_names, missing_policy=missing_policy, predictions=predictions,
+		evaluate_clarifications=first_turn is not None and ce.is_ce_turn(first_turn))
+
+	def _add_sampling_error(_results, _model_name, _part):
+		object_counts = _get_turn_object_counts(sample, filter_func, _model_name, _part, missing_policy, predictions)
+		stderr = sample.get_ratio_stderr(2 * object_counts[:, 2], object_counts[:, 0] + object_counts[:, 1])
+		_results['object_f1_sampling_stderr'] = stderr
+		_results['object_f1_ci'] = (
+			_results['object_f1'] - CONFIDENCE_Z * stderr, _results['object_f1'] + CONFIDENCE_Z * stderr)
+
+	if 'Before-CR' in analysis:
+		for part, ce_turn in [('Before-CR', 'before_cr_datum'), ('After-CR', 'after_cr_datum')]:
+			for model_name, results in analysis[part].items():
+				_add_sampling_error(results, model_name, ce_turn)
+	else:
+		for model_name, results in analysis.items():
+			_add_sampling_error(results, model_name, None)
+
+	return analysis
+
+
+def estimate_candidate_objects(
+	sample: StratifiedSample, simmc2_metadata: dict, scene_jsons: dict, filter_func=None, *,
+	candidate_counts: dict = None, **kwargs) -> dict:
+	"""
+	Estimates the results of evaluation.extract_candidate_objects from a sample, adding the
+	sampling error of the mean candidates ('mean_sampling_stderr') of each property.
+
+	:param sample: the sample of the turns, see StratifiedSample
+	:param simmc2_metadata: the metadata of the SIMMC2 dataset
+	:param scene_jsons: the scene jsons of the SIMMC2 dataset
+	:param filter_func: function that takes a turn and returns True if it should be evaluated
+	:param candidate_counts: counts of the sampled turns from extract_candidate_object_counts, pass them
+		when estimating several splits to count the candidates only once
+	:param kwargs: other arguments of extract_candidate_objects, e.g., spatial_mode
+	:return: dict of candidate objects, with mean, std, count (of the sample) and mean_sampling_stderr
+	"""
+	if candidate_counts is None:
+		candidate_counts = evaluation.extract_candidate_object_counts(
+			sample.turns, simmc2_metadata, scene_jsons, **kwargs)
+	summary = evaluation.extract_candidate_objects(
+		sample.turns, simmc2_metadata, scene_jsons, filter_func, candidate_counts=candidate_counts)
+
+	split_mask = np.array([filter_func is None or bool(filter_func(turn)) for _, turn in sample.turns], dtype=bool)
+	for key, counts in candidate_counts.items():
+		summary[key]['mean_sampling_stderr'] = sample.get_ratio_stderr(
+			np.where(split_mask, counts, 0), split_mask.astype(np.float64))
+	return summary
+
+
+def format_estimate(data: dict) -> str:
+	"""Formats an F1 estimate of evaluate_sample as a percentage with its 95% confidence interval."""
+	return f"{format_number(data['object_f1'], 1, True)} ± {format_number(CONFIDENCE_Z * data['object_f1_sampling_stderr'], 1, True)}"
+
+
+def _load_json(file_path: str):
+	with open(file_path, 'r') as f_in:
+		return json.load(f_in)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Evaluate the models on a stratified sample of the SIMMC2 data')
+	parser.add_argument('--simmc2-folder', default='../simmc2/data', help='folder with the SIMMC2 data')
+	parser.add_argument('--data-folder', default='data', help='folder with a sub-folder with the output of each model')
+	parser.add_argument('--fraction', type=float, default=None, help=f"fraction of the turns (default {DEFAULT_FRACTION})")
+	parser.add_argument('--time-budget', type=float, default=None, help='seconds to evaluate, instead of a fraction')
+	parser.add_argument('--seed', type=int, default=0, help='random seed of the sample')
+	args = parser.parse_args()
+
+	print('Loading data')
+	simmc2_dataset = prepare_dataset(_load_json(os.path.join(args.simmc2_folder, 'simmc2_dials_dstc10_devtest.json')))
+	simmc2_metadata = {}
+	for domain in ['fashion', 'furniture']:
+		simmc2_metadata.update(_load_json(os.path.join(args.simmc2_folder, f"{domain}_prefab_metadata_all.json")))
+	simmc2_scenes_jsons = {
+		os.path.splitext(os.path.basename(x))[0]: _load_json(x)
+		for x in glob.glob(os.path.join(args.simmc2_folder, 'simmc2_scene_jsons_dstc10_public', '*.json'))}
+	model_registry = ModelRegistry(args.data_folder)
+	loaded_models = model_registry.load(
+		alignment.get_turn_keys(simmc2_dataset), model_registry.discover())
+	all_models = list(loaded_models.keys())
+
+	def evaluate_models(_sample: StratifiedSample) -> dict:
+		return {
+			split_name: {
+				model_name: evaluate_sample(_sample, filter_func, predictions=model_predictions)
+				for model_name, (model_predictions, _) in loaded_models.items()}
+			for split_name, filter_func in splits.PAPER_SPLITS}
+
+	sample_fraction = args.fraction or DEFAULT_FRACTION
+	if args.time_budget is not None:
+		sample_fraction = get_fraction_for_time_budget(simmc2_dataset, args.time_budget, evaluate_models, seed=args.seed)
+	sample = StratifiedSample.from_dataset(simmc2_dataset, sample_fraction, args.seed)
+	print(f"Evaluating {len(sample)} of {sample.num_turns} turns ({sample_fraction:.1%})\n")
+
+	analysis = evaluate_models(sample)
+	print(f"{'Split':<20} " + ' '.join(f"{x:>36}" for x in all_models))
+	for split_name, analysis_by_model in analysis.items():
+		row = []
+		for model_name in all_models:
+			model_analysis = analysis_by_model[model_name]
+			if 'Before-CR' in model_analysis:
+				row.append(
+					f"{format_estimate(model_analysis['Before-CR'][model_name])} -> "
+					f"{format_estimate(model_analysis['After-CR'][model_name])}")
+			else:
+				row.append(format_estimate(model_analysis[model_name]))
+		print(f"{split_name:<20} " + ' '.join(f"{x:>36}" for x in row))
+
+	print(f"\n{'Split':<20} {'Candidates Type':>16} {'Candidates Colour':>18} {'Entries':>8}")
+	sample_candidate_counts = evaluation.extract_candidate_object_counts(
+		sample.turns, simmc2_metadata, simmc2_scenes_jsons)
+	for split_name, filter_func in splits.PAPER_SPLITS:
+		candidates = estimate_candidate_objects(
+			sample, simmc2_metadata, simmc2_scenes_jsons, filter_func, candidate_counts=sample_candidate_counts)
+		print(f"{split_name:<20} " + ' '.join(
+			f"{format_number(candidates[x]['mean']) + ' ± ' + format_number(CONFIDENCE_Z * candidates[x]['mean_sampling_stderr']):>{width}}"
+			for x, width in [('type', 16), ('color', 18)]) + f" {candidates['type']['count']:>8}")
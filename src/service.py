@@ -0,0 +1,279 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Local evaluation service that keeps the original SIMMC2 data in memory, so model outputs
+can be scored many times (e.g., during training) without loading and preprocessing it again.
+
+Start it with:
+	python -m src.service --simmc2-folder ../simmc2/data
+
+Then POST a json request to http://127.0.0.1:8765/evaluate with one of:
+	{"prediction_file": "path/to/coref-pred-devtest.json"}
+	{"dialogue_data": [...]}    (a model output, in the same format as SIMMC2)
+	{"turns": [{"dialogue_idx": 0, "turn_idx": 0, "pred_objects": [1, 2]}, ...]}
+and optionally "model_name", "missing_policy" (see alignment.MISSING_POLICIES) and "splits", a dict of
+extra split name -> split expression, e.g., {"Spatial Furniture": "tag:spatial & domain:furniture"}.
+It returns the F1 of every split, with the Before-CR and After-CR results and their delta
+for the CE splits. See request_evaluation to call it from Python.
+"""
+
+import os
+import json
+import math
+import time
+import argparse
+import multiprocessing
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import prepare_dataset
+from . import alignment, evaluation, splits
+from .columnar import load_dataset
+from .indexing import DatasetIndex
+from .predictions import PredictionStore, format_model_output, load_model_output
+
+
+DEFAULT_HOST = '127.0.0.1'      # only reachable from this machine
+DEFAULT_PORT = 8765
+DEFAULT_DATASET_FILE = 'simmc2_dials_dstc10_devtest.json'
+DEFAULT_MODEL_NAME = 'model'
+
+
+def _load_request_predictions(dataset_index: DatasetIndex, turn_keys: list, request: dict) -> tuple:
+	"""
+	Loads the predictions of a request into a PredictionStore aligned with the original data.
+
+	:param dataset_index: index of the original data
+	:param turn_keys: (dialogue_idx, turn_idx) of the original data, see DatasetIndex.turn_keys
+	:param request: the request, see the module docstring
+	:return: (PredictionStore with only this model, ModelAlignment)
+	"""
+	model_name = request.get('model_name', DEFAULT_MODEL_NAME)
+	model_predictions = PredictionStore(len(dataset_index))
+
+	if 'turns' in request:
+		prediction_keys = [(x['dialogue_idx'], x['turn_idx']) for x in request['turns']]
+		model_alignment = alignment.align_turn_keys(model_name, turn_keys, prediction_keys)
+		model_predictions.add_model_objects(
+			model_name,
+			(request['turns'][x]['pred_objects'] if x >= 0 else None for x in model_alignment.turn_to_prediction),
+			turn_to_prediction=model_alignment.turn_to_prediction)
+		return model_predictions, model_alignment
+
+	if 'prediction_file' in request:
+		source_path = request['prediction_file']
+		model_output = load_model_output(source_path)
+	elif 'dialogue_data' in request:
+		source_path = None
+		model_output = format_model_output(request)
+	else:
+		raise ValueError("The request needs one of 'prediction_file', 'dialogue_data' or 'turns'")
+
+	model_alignment = alignment.align_turn_keys(model_name, turn_keys, alignment.get_turn_keys(model_output))
+	model_predictions.add_model(model_name, model_output, model_alignment, source_path=source_path)
+	return model_predictions, model_alignment
+
+
+def _get_delta(before_cr: dict, after_cr: dict) -> float:
+	# same as format_delta, as a number
+	return after_cr['object_f1'] / before_cr['object_f1'] - 1 if before_cr['object_f1'] != 0 else 0.
+
+
+def evaluate_request(dataset_index: DatasetIndex, turn_keys: list, request: dict) -> dict:
+	"""
+	Evaluates the predictions of a request on all the splits of the index, and the extra splits of the request.
+
+	:param dataset_index: index of the original data, with its splits
+	:param turn_keys: (dialogue_idx, turn_idx) of the original data, see DatasetIndex.turn_keys
+	:param request: the request, see the module docstring
+	:return: dict with the alignment of the predictions and the results of each split
+	"""
+	start_time = time.perf_counter()
+	if not isinstance(request, dict):
+		raise TypeError(f"The request must be a json object, not {type(request).__name__}")
+	request_splits = request.get('splits', {})
+	if not isinstance(request_splits, dict) or not all(isinstance(x, str) for x in request_splits.values()):
+		raise TypeError("The 'splits' of the request must be a json object of split name -> split expression")
+	missing_policy = request.get('missing_policy', alignment.MISSING_SKIP)
+	model_predictions, model_alignment = _load_request_predictions(dataset_index, turn_keys, request)
+	model_name = model_alignment.model_name
+	model_counts = {model_name: evaluation.ModelObjectCounts(dataset_index, model_predictions, model_name)}
+
+	split_masks = dict(dataset_index.split_masks)
+	for split_name, split_expression in request_splits.items():
+		split_masks[split_name] = splits.parse_split(split_expression).get_mask(dataset_index)
+
+	results = {}
+	for split_name, split_mask in split_masks.items():
+		split_analysis = evaluation.evaluate_model_counts(
+			dataset_index, model_counts, split_mask, missing_policy=missing_policy)
+		if 'Before-CR' in split_analysis:
+			before_cr, after_cr = split_analysis['Before-CR'][model_name], split_analysis['After-CR'][model_name]
+			results[split_name] = {'Before-CR': before_cr, 'After-CR': after_cr, 'delta': _get_delta(before_cr, after_cr)}
+		else:
+			results[split_name] = split_analysis[model_name]
+
+	return {
+		'model_name': model_name,
+		'alignment': {
+			'aligned': model_alignment.aligned_count, 'missing': len(model_alignment.missing_turns),
+			'extra': len(model_alignment.extra_turns)},
+		'splits': results,
+		'elapsed_ms': (time.perf_counter() - start_time) * 1000,
+	}
+
+
+def _to_json(value):
+	# NaN is not valid json, so undefined metrics are sent as null
+	if isinstance(value, dict):
+		return {k: _to_json(v) for k, v in value.items()}
+	elif isinstance(value, float) and math.isnan(value):
+		return None
+	elif hasattr(value, 'item'):   # numpy scalar
+		return _to_json(value.item())
+	return value
+
+
+# index of the original data in each worker process, sent once when the worker starts
+_worker_index = None
+_worker_turn_keys = None
+
+
+def _init_worker(dataset_index: DatasetIndex) -> None:
+	global _worker_index, _worker_turn_keys
+	_worker_index, _worker_turn_keys = dataset_index, dataset_index.turn_keys
+
+
+def _evaluate_request_worker(request_body: bytes) -> dict:
+	# the request is parsed in the worker, so big model outputs do not block the server
+	return _to_json(evaluate_request(_worker_index, _worker_turn_keys, json.loads(request_body)))
+
+
+class EvaluationService:
+	"""
+	Evaluation service with the index of the original data already built. Requests are
+	scored in a pool of worker processes, so several requests can be evaluated at the same time.
+
+	:param dataset_index: index of the original data, with the splits to evaluate
+	:param workers: number of worker processes, default is the number of CPUs
+	"""
+
+	def __init__(self, dataset_index: DatasetIndex, workers: int = None):
+		self.dataset_index = dataset_index
+		self.executor = ProcessPoolExecutor(
+			max_workers=workers or multiprocessing.cpu_count(),
+			initializer=_init_worker, initargs=(dataset_index,))
+
+	def evaluate(self, request_body: bytes) -> dict:
+		"""
+		Evaluates a request in the worker pool, see evaluate_request.
+
+		:param request_body: the request, as json
+		:return: the results, ready to send as json
+		"""
+		return self.executor.submit(_evaluate_request_worker, request_body).result()
+
+	def get_splits(self) -> dict:
+		return {
+			split_name: int(split_mask.sum()) for split_name, split_mask in self.dataset_index.split_masks.items()}
+
+	def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+		"""Serves the requests over HTTP until interrupted, each connection in its own thread."""
+		server = ThreadingHTTPServer((host, port), _EvaluationRequestHandler)
+		server.service = self
+		print(f"Serving evaluation of {self.dataset_index} on http://{host}:{server.server_port}")
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			self.close()
+
+	def close(self) -> None:
+		self.executor.shutdown()
+
+
+class _EvaluationRequestHandler(BaseHTTPRequestHandler):
+
+	def _send_json(self, status: int, data: dict) -> None:
+		body = json.dumps(data).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path == '/splits':
+			self._send_json(200, self.server.service.get_splits())
+		elif self.path == '/health':
+			self._send_json(200, {'status': 'ok', 'turns': len(self.server.service.dataset_index)})
+		else:
+			self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+	def do_POST(self):
+		if self.path != '/evaluate':
+			self._send_json(404, {'error': f"Unknown path {self.path}"})
+			return
+		request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		try:
+			self._send_json(200, self.server.service.evaluate(request_body))
+		except (ValueError, KeyError, TypeError, OSError) as e:
+			self._send_json(400, {'error': f"{type(e).__name__}: {e}"})
+		except Exception as e:      # the client always gets a response, even if the evaluation fails unexpectedly
+			self._send_json(500, {'error': f"{type(e).__name__}: {e}"})
+
+	def log_message(self, format, *args):
+		pass    # do not print every request
+
+
+def request_evaluation(request: dict, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, timeout: float = None) -> dict:
+	"""
+	Sends a request to a running evaluation service, see the module docstring.
+
+	:param request: the request, e.g., {'prediction_file': 'path/to/file.json'}
+	:param host: host of the service
+	:param port: port of the service
+	:param timeout: seconds to wait for the results
+	:return: the results of the evaluation, with null for undefined metrics
+	"""
+	http_request = urllib.request.Request(
+		f"http://{host}:{port}/evaluate", data=json.dumps(request).encode('utf-8'),
+		headers={'Content-Type': 'application/json'})
+	with urllib.request.urlopen(http_request, timeout=timeout) as response:
+		return json.loads(response.read())
+
+
+def load_dataset_index(dataset_file: str, dataset_splits: list = None) -> DatasetIndex:
+	"""
+	Loads and preprocesses the original SIMMC2 data, then builds its index.
+
+	:param dataset_file: path to the SIMMC2 dialogues file, or to its columnar folder (see columnar.py)
+	:param dataset_splits: list of (split name, split expression or filter function), default the splits of the paper
+	:return: index of the original data with the masks of the splits
+	"""
+	dataset = prepare_dataset(load_dataset(dataset_file))
+	return DatasetIndex.from_dataset(dataset, splits.PAPER_SPLITS if dataset_splits is None else dataset_splits)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve the evaluation of model outputs on the SIMMC2 data')
+	parser.add_argument('--simmc2-folder', default='../simmc2/data', help='folder with the SIMMC2 data')
+	parser.add_argument('--dataset-file', default=DEFAULT_DATASET_FILE, help='SIMMC2 dialogues file in that folder')
+	parser.add_argument('--host', default=DEFAULT_HOST, help='host to listen on')
+	parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+	parser.add_argument('--workers', type=int, default=None, help='worker processes to evaluate requests')
+	args = parser.parse_args()
+
+	EvaluationService(
+		load_dataset_index(os.path.join(args.simmc2_folder, args.dataset_file)), workers=args.workers
+	).serve(args.host, args.port)
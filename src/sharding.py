@@ -0,0 +1,296 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Sharded evaluation over several splits of the SIMMC2 data (e.g., train, dev and devtest). Instead of joining
+the splits into the first one (see join_dataset_splits), their dialogues are chained and partitioned into
+shards with about the same number of turns. Each shard is processed in a worker process: marking the CEs
+(and tagging them), building its index and split masks, counting the objects of every model and the
+candidate objects of every turn. The arrays of the shards are then concatenated in order, so the results
+are the same as processing all the data at once, see check_sharded_results.
+
+The data is shared with the worker processes by forking, so it is not copied or pickled. Platforms that
+cannot fork process the shards one by one. Either way, each shard prepares a copy of its dialogues and turns
+(see copy_dialogues), so the given datasets are never modified.
+
+Usage:
+	python -m src.sharding --simmc2-folder ../simmc2/data --processes 8
+"""
+
+import io
+import os
+import glob
+import json
+import argparse
+import itertools
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import iterate_over_dataset_entries, prepare_dataset, format_f1, format_mean
+from . import alignment, evaluation, profiling, splits
+from .indexing import DatasetIndex
+from .predictions import PredictionStore, load_model_output
+from .registry import ModelRegistry
+
+
+DEFAULT_DATASET_FILES = [
+	'simmc2_dials_dstc10_train.json', 'simmc2_dials_dstc10_dev.json', 'simmc2_dials_dstc10_devtest.json']
+SHARDS_PER_PROCESS = 4
+
+
+def chain_dataset_splits(dataset_list: list) -> dict:
+	"""
+	Chains the dialogues of several dataset splits, in order. Unlike join_dataset_splits, the splits are
+	not modified and only the references to their dialogues are copied.
+
+	:param dataset_list: list of datasets in the same format as SIMMC2
+	:return: dataset with the dialogues of all the splits
+	"""
+	return {'dialogue_data': list(itertools.chain.from_iterable(x['dialogue_data'] for x in dataset_list))}
+
+
+def copy_dialogues(dialogues: list) -> list:
+	"""
+	Copies some dialogues and their turns, but not the values in them, so marking their CEs and turn ids
+	(see prepare_dataset, which only sets keys of the turns) does not modify the original dialogues.
+
+	:param dialogues: list of dialogues in the same format as SIMMC2
+	:return: list with the copies of the dialogues
+	"""
+	return [{**x, 'dialogue': [dict(y) for y in x['dialogue']]} for x in dialogues]
+
+
+def get_shards(dataset: dict, num_shards: int) -> List[Tuple[int, int, int]]:
+	"""
+	Partitions the dialogues of a dataset into consecutive shards with about the same number of turns.
+	The turns of a dialogue (and so its CEs) are always in the same shard.
+
+	:param dataset: the original SIMMC2 data, see chain_dataset_splits
+	:param num_shards: number of shards, fewer if there are not enough dialogues
+	:return: list of (first dialogue, last dialogue + 1, global turn id of its first turn) of each shard
+	"""
+	dialogue_turns = np.cumsum([0] + [len(x['dialogue']) for x in dataset['dialogue_data']])
+	# first dialogue of each shard, at the dialogue that reaches each fraction of the turns
+	boundaries = np.searchsorted(dialogue_turns, np.linspace(0, dialogue_turns[-1], num_shards + 1)[1:-1])
+	boundaries = np.unique(np.concatenate([[0], boundaries, [len(dialogue_turns) - 1]]))
+	return [(int(x), int(y), int(dialogue_turns[x])) for x, y in zip(boundaries[:-1], boundaries[1:])]
+
+
+def evaluate_shard(
+	dataset: dict, shard: Tuple[int, int, int], model_predictions: Dict[str, tuple], simmc2_metadata: dict,
+	scene_jsons: dict, dataset_splits: list, property_keys: list = None) -> tuple:
+	"""
+	Processes the dialogues of a shard: marks the CEs of a copy of them (see prepare_dataset and copy_dialogues),
+	builds their index with the masks of the splits, and counts the objects of every model and the candidate objects.
+
+	:param dataset: the original SIMMC2 data, see chain_dataset_splits
+	:param shard: (first dialogue, last dialogue + 1, global turn id of its first turn), see get_shards
+	:param model_predictions: dict of model name -> (predicted turns of its model output, position of the
+		prediction of each global turn id in them, see alignment.ModelAlignment)
+	:param simmc2_metadata: the metadata of the SIMMC2 dataset
+	:param scene_jsons: the scene jsons of the SIMMC2 dataset
+	:param dataset_splits: list of (split name, split expression or filter function)
+	:param property_keys: properties of the candidate objects, see evaluation.extract_candidate_object_counts
+	:return: (DatasetIndex, dict of model name -> evaluation.ModelObjectCounts, candidate counts) of the shard
+	"""
+	first_dialogue, last_dialogue, turn_offset = shard
+	shard_dataset = {'dialogue_data': copy_dialogues(dataset['dialogue_data'][first_dialogue:last_dialogue])}
+	with contextlib.redirect_stdout(io.StringIO()):
+		prepare_dataset(shard_dataset)
+	for _, turn_datum in iterate_over_dataset_entries(shard_dataset):
+		turn_datum['turn_id'] += turn_offset    # global turn id, as if all the data was prepared at once
+
+	shard_index = DatasetIndex.from_dataset(shard_dataset, dataset_splits)
+	shard_predictions = PredictionStore(len(shard_index))
+	for model_name, (pred_turns, turn_to_prediction) in model_predictions.items():
+		shard_predictions.add_model_objects(model_name, (
+			pred_turns[x]['pred_objects'] if x >= 0 else None
+			for x in turn_to_prediction[turn_offset:turn_offset + len(shard_index)]))
+	model_counts = {
+		x: evaluation.ModelObjectCounts(shard_index, shard_predictions, x) for x in shard_predictions.model_names}
+
+	return shard_index, model_counts, evaluation.extract_candidate_object_counts(
+		shard_dataset, simmc2_metadata, scene_jsons, property_keys)
+
+
+# data shared with the worker processes, set before forking so it is not pickled
+_worker_args = None
+
+
+def _evaluate_shard_worker(shard: Tuple[int, int, int]) -> tuple:
+	return evaluate_shard(_worker_args[0], shard, *_worker_args[1:])
+
+
+def merge_shard_results(shard_results: list) -> tuple:
+	"""
+	Concatenates the results of the shards, in order, see evaluate_shard.
+
+	:param shard_results: list of (DatasetIndex, model counts, candidate counts) of each shard
+	:return: (DatasetIndex, dict of model name -> evaluation.ModelObjectCounts, candidate counts) of all the data
+	"""
+	shard_indexes, shard_counts, shard_candidates = zip(*shard_results)
+	return (
+		DatasetIndex.concatenate(shard_indexes),
+		{x: evaluation.ModelObjectCounts.concatenate([y[x] for y in shard_counts]) for x in shard_counts[0]},
+		{x: np.concatenate([y[x] for y in shard_candidates]) for x in shard_candidates[0]})
+
+
+def evaluate_sharded(
+	dataset_list: list, model_outputs: dict, simmc2_metadata: dict, scene_jsons: dict,
+	dataset_splits: list = None, property_keys: list = None, *, processes: int = None,
+	num_shards: int = None) -> tuple:
+	"""
+	Evaluates the models on several dataset splits at once, with the shards of their dialogues
+	processed in parallel, see evaluate_shard. The models are aligned with all the splits first.
+
+	:param dataset_list: list of datasets in the same format as SIMMC2, e.g., train, dev and devtest
+	:param model_outputs: dict of model name -> model output, in the same format as SIMMC2
+	:param simmc2_metadata: the metadata of the SIMMC2 dataset
+	:param scene_jsons: the scene jsons of the SIMMC2 dataset
+	:param dataset_splits: list of (split name, split expression or filter function), default the splits of the paper
+	:param property_keys: properties of the candidate objects, see evaluation.extract_candidate_object_counts
+	:param processes: number of worker processes, default is the number of CPUs. Use 1 to process the shards serially
+	:param num_shards: number of shards, default SHARDS_PER_PROCESS per process
+	:return: (DatasetIndex, dict of model name -> evaluation.ModelObjectCounts, candidate counts,
+		dict of model name -> alignment.ModelAlignment) of all the data
+	"""
+	global _worker_args
+	processes = processes or multiprocessing.cpu_count()
+	dataset = chain_dataset_splits(dataset_list)
+	dataset_splits = splits.PAPER_SPLITS if dataset_splits is None else dataset_splits
+
+	with profiling.stage('align', models=len(model_outputs)):
+		turn_keys = alignment.get_turn_keys(dataset)
+		model_alignments, model_predictions = {}, {}
+		for model_name, model_output in model_outputs.items():
+			model_alignments[model_name] = alignment.align_turn_keys(
+				model_name, turn_keys, alignment.get_turn_keys(model_output))
+			model_predictions[model_name] = (
+				[turn for _, turn in iterate_over_dataset_entries(model_output)],
+				model_alignments[model_name].turn_to_prediction)
+
+	shards = get_shards(dataset, num_shards or processes * SHARDS_PER_PROCESS)
+	shard_args = (dataset, model_predictions, simmc2_metadata, scene_jsons, dataset_splits, property_keys)
+	with profiling.stage('evaluate shards', shards=len(shards), processes=processes):
+		if processes == 1 or len(shards) <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+			shard_results = [evaluate_shard(dataset, shard, *shard_args[1:]) for shard in shards]
+		else:
+			_worker_args = shard_args
+			try:
+				with ProcessPoolExecutor(
+					max_workers=min(processes, len(shards)), mp_context=multiprocessing.get_context('fork')) as executor:
+					shard_results = list(executor.map(_evaluate_shard_worker, shards))
+			finally:
+				_worker_args = None
+
+	with profiling.stage('merge shards'):
+		return (*merge_shard_results(shard_results), model_alignments)
+
+
+def evaluate_serial(
+	dataset_list: list, model_outputs: dict, simmc2_metadata: dict, scene_jsons: dict,
+	dataset_splits: list = None, property_keys: list = None) -> tuple:
+	"""Same as evaluate_sharded, but processing a copy of all the data at once, without shards."""
+	dataset = {'dialogue_data': copy_dialogues(chain_dataset_splits(dataset_list)['dialogue_data'])}
+	with contextlib.redirect_stdout(io.StringIO()):
+		prepare_dataset(dataset)
+	dataset_index = DatasetIndex.from_dataset(dataset, splits.PAPER_SPLITS if dataset_splits is None else dataset_splits)
+
+	turn_keys = dataset_index.turn_keys
+	model_predictions, model_alignments = PredictionStore(len(turn_keys)), {}
+	for model_name, model_output in model_outputs.items():
+		model_alignments[model_name] = alignment.align_turn_keys(
+			model_name, turn_keys, alignment.get_turn_keys(model_output))
+		model_predictions.add_model(model_name, model_output, model_alignments[model_name])
+	model_counts = {
+		x: evaluation.ModelObjectCounts(dataset_index, model_predictions, x) for x in model_predictions.model_names}
+
+	return dataset_index, model_counts, evaluation.extract_candidate_object_counts(
+		dataset, simmc2_metadata, scene_jsons, property_keys), model_alignments
+
+
+def check_sharded_results(sharded_results: tuple, serial_results: tuple) -> List[str]:
+	"""
+	Compares the results of evaluate_sharded and evaluate_serial. The codes of the CE tags may differ
+	(tags are sets, so they are seen in a different order in each process), so the tags are compared by name.
+
+	:return: list of the arrays that are different, empty if they are the same
+	"""
+	(x_index, x_counts, x_candidates, _), (y_index, y_counts, y_candidates, _) = sharded_results, serial_results
+	differences = [
+		key for key in [
+			'dialogue_idx', 'turn_idx', 'gold_indptr', 'gold_indices', 'ce_role', 'ce_after', 'domain', 'scene', 'ce_rounds']
+		if not np.array_equal(getattr(x_index, key), getattr(y_index, key))]
+	differences += [
+		f"tag {x}" for x in set(x_index.tag_names) | set(y_index.tag_names)
+		if not np.array_equal(x_index.get_tag_mask(x), y_index.get_tag_mask(x))]
+	differences += [
+		f"split {x}" for x in set(x_index.split_masks) | set(y_index.split_masks)
+		if not np.array_equal(x_index.split_masks.get(x), y_index.split_masks.get(x))]
+	differences += [
+		f"{x} {key}" for x in set(x_counts) | set(y_counts) for key in evaluation.ModelObjectCounts.__slots__
+		if x not in x_counts or x not in y_counts or not np.array_equal(getattr(x_counts[x], key), getattr(y_counts[x], key))]
+	differences += [
+		f"candidates {x}" for x in set(x_candidates) | set(y_candidates)
+		if not np.array_equal(x_candidates.get(x), y_candidates.get(x))]
+	return differences
+
+
+def _load_json(file_path: str):
+	with open(file_path, 'r') as f_in:
+		return json.load(f_in)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Evaluate the models on several SIMMC2 splits in parallel shards')
+	parser.add_argument('--simmc2-folder', default='../simmc2/data', help='folder with the SIMMC2 data')
+	parser.add_argument(
+		'--dataset-files', nargs='+', default=DEFAULT_DATASET_FILES, help='SIMMC2 dialogues files in that folder, in order')
+	parser.add_argument('--data-folder', default='data', help='folder with a sub-folder with the output of each model')
+	parser.add_argument('--processes', type=int, default=None, help='worker processes, default the number of CPUs')
+	parser.add_argument('--shards', type=int, default=None, help=f'default {SHARDS_PER_PROCESS} per process')
+	parser.add_argument('--check-serial', action='store_true', help='also evaluate serially and compare the results')
+	args = parser.parse_args()
+
+	dataset_files = [os.path.join(args.simmc2_folder, x) for x in args.dataset_files]
+	dataset_files = [x for x in dataset_files if os.path.exists(x)]
+	if len(dataset_files) == 0:
+		parser.error(f"None of {args.dataset_files} is in {args.simmc2_folder}")
+
+	with profiling.stage('load'):
+		metadata = {}
+		for domain in ['fashion', 'furniture']:
+			metadata.update(_load_json(os.path.join(args.simmc2_folder, f"{domain}_prefab_metadata_all.json")))
+		scenes = {
+			os.path.splitext(os.path.basename(x))[0]: _load_json(x)
+			for x in glob.glob(os.path.join(args.simmc2_folder, 'simmc2_scene_jsons_dstc10_public', '*.json'))}
+		outputs = {x: load_model_output(y) for x, y in ModelRegistry(args.data_folder).discover().items()}
+		datasets = [_load_json(x) for x in dataset_files]
+
+	print(f"Evaluating {list(outputs)} on {[os.path.basename(x) for x in dataset_files]}")
+	results = evaluate_sharded(datasets, outputs, metadata, scenes, processes=args.processes, num_shards=args.shards)
+	index, counts, candidates, _ = results
+	print(index)
+	for split_name, split_mask in index.split_masks.items():
+		analysis = evaluation.evaluate_model_counts(index, counts, split_mask)
+		candidate_summary = evaluation.summarise_candidate_objects(candidates, split_mask)
+		print(f"{split_name}: candidates type {format_mean(candidate_summary['type'])}")
+		for model_name in counts:
+			if 'Before-CR' in analysis:
+				print(f"  {model_name}: {format_f1(analysis['Before-CR'][model_name])} -> {format_f1(analysis['After-CR'][model_name])}")
+			else:
+				print(f"  {model_name}: {format_f1(analysis[model_name])}")
+
+	if args.check_serial:
+		differences = check_sharded_results(results, evaluate_serial(datasets, outputs, metadata, scenes))
+		print(f"Different from the serial results: {differences}" if differences else 'Same as the serial results')
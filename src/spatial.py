@@ -0,0 +1,207 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Spatial index over the objects of the SIMMC2 scenes, used to find distractors close to the target objects.
+"""
+
+import math
+from typing import Iterator, List, Optional, Tuple
+
+from . import get_object_property
+
+
+SPATIAL_RADIUS = 'radius'
+SPATIAL_REGION = 'region'
+SPATIAL_MODES = [SPATIAL_RADIUS, SPATIAL_REGION]
+
+# in pixels of the scene image, the scenes are roughly 1920x1080
+DEFAULT_RADIUS = 300
+DEFAULT_CELL_SIZE = 150
+
+# regions of a scene, it is split in 3 columns and 2 rows
+REGIONS_HORIZONTAL = ['left', 'middle', 'right']
+REGIONS_VERTICAL = ['top', 'bottom']
+
+
+def get_object_centre(scene_object: dict) -> Tuple[float, float]:
+	"""
+	Gets the centre of an object in the scene image.
+
+	:param scene_object: object from the scene json, bbox is [x, y, height, width]
+	:return: (x, y) of the centre of the bounding box
+	"""
+	x, y, height, width = scene_object['bbox']
+	return x + width / 2, y + height / 2
+
+
+class SceneSpatialIndex:
+	"""
+	Uniform grid over the centres of the objects in a scene. It allows to query
+	the objects within a radius of a point, or the objects in the same region of
+	the scene (left/middle/right and top/bottom), without scanning all objects.
+
+	Regions are relative to the area covered by the objects in the scene, as the
+	scene jsons do not include the size of the image.
+
+	:param scene_objects: list of objects from the scene json
+	:param cell_size: size of each cell of the grid, in pixels
+	"""
+
+	def __init__(self, scene_objects: list, cell_size: float = DEFAULT_CELL_SIZE):
+		self.cell_size = cell_size
+		self.objects = {}       # object index -> scene object
+		self.centres = {}       # object index -> (x, y)
+		self.grid = {}          # (column, row) -> [object index, ...]
+		self.regions = {}       # (horizontal, vertical) -> [object index, ...]
+
+		for scene_object in scene_objects:
+			# keep the first object seen with an index, same as a linear scan would
+			if scene_object['index'] in self.objects:
+				continue
+			self.objects[scene_object['index']] = scene_object
+			self.centres[scene_object['index']] = get_object_centre(scene_object)
+			self.grid.setdefault(self._get_cell(*self.centres[scene_object['index']]), []).append(
+				scene_object['index'])
+
+		# the extent of the scene is given by the bounding boxes of all its objects
+		if len(scene_objects) > 0:
+			self.min_x = min(obj['bbox'][0] for obj in scene_objects)
+			self.max_x = max(obj['bbox'][0] + obj['bbox'][3] for obj in scene_objects)
+			self.min_y = min(obj['bbox'][1] for obj in scene_objects)
+			self.max_y = max(obj['bbox'][1] + obj['bbox'][2] for obj in scene_objects)
+		else:
+			self.min_x = self.max_x = self.min_y = self.max_y = 0
+
+		for object_index, centre in self.centres.items():
+			self.regions.setdefault(self.get_region(*centre), []).append(object_index)
+
+	def __contains__(self, object_index: int) -> bool:
+		return object_index in self.objects
+
+	def __len__(self) -> int:
+		return len(self.objects)
+
+	def _get_cell(self, x: float, y: float) -> Tuple[int, int]:
+		return int(x // self.cell_size), int(y // self.cell_size)
+
+	def get_region(self, x: float, y: float) -> Tuple[str, str]:
+		"""
+		Gets the region of the scene where a point is.
+
+		:param x: horizontal coordinate, in pixels
+		:param y: vertical coordinate, in pixels
+		:return: (horizontal region, vertical region), e.g., ('left', 'top')
+		"""
+		width = max(self.max_x - self.min_x, 1)
+		height = max(self.max_y - self.min_y, 1)
+		column = min(int((x - self.min_x) / width * len(REGIONS_HORIZONTAL)), len(REGIONS_HORIZONTAL) - 1)
+		row = min(int((y - self.min_y) / height * len(REGIONS_VERTICAL)), len(REGIONS_VERTICAL) - 1)
+		return REGIONS_HORIZONTAL[max(column, 0)], REGIONS_VERTICAL[max(row, 0)]
+
+	def query_radius(self, object_index: int, radius: float) -> Iterator[int]:
+		"""
+		Yields the objects whose centre is within a radius of the centre of another object.
+		The object itself is not included.
+
+		:param object_index: index of the object in the scene
+		:param radius: radius around the object, in pixels
+		:return: generator of object indexes
+		"""
+		x, y = self.centres[object_index]
+		min_column, min_row = self._get_cell(x - radius, y - radius)
+		max_column, max_row = self._get_cell(x + radius, y + radius)
+		for column in range(min_column, max_column + 1):
+			for row in range(min_row, max_row + 1):
+				for other_index in self.grid.get((column, row), []):
+					if other_index == object_index:
+						continue
+					other_x, other_y = self.centres[other_index]
+					if math.hypot(other_x - x, other_y - y) <= radius:
+						yield other_index
+
+	def query_region(self, object_index: int) -> Iterator[int]:
+		"""
+		Yields the objects in the same region of the scene as another object.
+		The object itself is not included.
+
+		:param object_index: index of the object in the scene
+		:return: generator of object indexes
+		"""
+		for other_index in self.regions[self.get_region(*self.centres[object_index])]:
+			if other_index != object_index:
+				yield other_index
+
+
+class SceneSpatialIndexes(dict):
+	"""
+	Lazy collection of spatial indexes, one per scene. Indexes are only built the
+	first time a scene is requested, so it can be shared between data splits.
+
+	:param scene_jsons: the scene jsons of the SIMMC2 dataset
+	:param cell_size: size of each cell of the grids, in pixels
+	"""
+
+	def __init__(self, scene_jsons: dict, cell_size: float = DEFAULT_CELL_SIZE):
+		super().__init__()
+		self.scene_jsons = scene_jsons
+		self.cell_size = cell_size
+
+	def __missing__(self, scene_key: str) -> SceneSpatialIndex:
+		self[scene_key] = SceneSpatialIndex(
+			self.scene_jsons[scene_key]['scenes'][0]['objects'], cell_size=self.cell_size)
+		return self[scene_key]
+
+
+def find_spatial_distractors(
+	target_objects: List[int], property_key: str, simmc2_metadata: dict,
+	scene_indexes: List[SceneSpatialIndex], spatial_mode: str = SPATIAL_REGION,
+	radius: Optional[float] = DEFAULT_RADIUS) -> List[int]:
+	"""
+	Finds the objects that share a property with a target object and are close to it,
+	either within a radius or in the same region of the scene. For instance,
+	if we are talking about a red shirt on the left, we will find:
+	- all shirts on the left of the scene
+	- all red objects on the left of the scene
+
+	Each target is looked up in the scenes in the order given (current scene first),
+	since positions are only comparable within the same scene image.
+
+	:param target_objects: indexes of the target objects
+	:param property_key: the property of the metadata that the distractors share, e.g., 'type',
+		or a tuple of properties that must all be shared, e.g., ('type', 'color')
+	:param simmc2_metadata: the metadata of the SIMMC2 dataset
+	:param scene_indexes: spatial indexes of the scenes of the turn, current scene first
+	:param spatial_mode: 'radius' or 'region'
+	:param radius: radius around each target, in pixels, only used with the radius mode
+	:return: list of distractor object indexes, targets are never included
+	"""
+	if spatial_mode not in SPATIAL_MODES:
+		raise ValueError(f"Unknown spatial mode '{spatial_mode}', use one of {SPATIAL_MODES}")
+
+	distractors = set()
+	for object_index in target_objects:
+		index = next((x for x in scene_indexes if object_index in x), None)
+		if index is None:
+			continue    # target not in any of the scenes, nothing to compare with
+
+		target_value = get_object_property(
+			simmc2_metadata[index.objects[object_index]['prefab_path']], property_key)
+		if spatial_mode == SPATIAL_RADIUS:
+			neighbours = index.query_radius(object_index, radius)
+		else:
+			neighbours = index.query_region(object_index)
+
+		for other_index in neighbours:
+			if other_index not in target_objects and \
+				get_object_property(
+					simmc2_metadata[index.objects[other_index]['prefab_path']], property_key) == target_value:
+				distractors.add(other_index)
+
+	return sorted(distractors)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Splits of the SIMMC2 data, defined as expressions over the turns. An expression can filter the turns
+one by one, like the filter functions of evaluation.evaluate_dataset, or be compiled to a boolean mask
+over the columns of an indexing.DatasetIndex, which is much faster for many splits.
+
+Expressions combine tags of the CE, CE roles, domains, scenes, number of objects and rounds of the
+clarification chains with & (and), | (or) and ! (not), in Python or as text:
+	Tag(tagging.TAG_SPATIAL) & ~Domain('furniture')
+	parse_split('tag:spatial & !domain:furniture & objects >= 2')
+	parse_split('rounds >= 2')      # clarification chains with 2 rounds or more, see evaluation.evaluate_model_rounds
+"""
+
+import re
+import operator
+import itertools
+
+import numpy as np
+
+from . import ce, tagging
+
+
+class SplitExpression:
+	"""
+	Base class of the split expressions. Subclasses implement __call__ to check a single
+	turn, _get_mask to compile the expression over a DatasetIndex, and __repr__ with the
+	expression as text, which parse_split reads back and is used as its cache key.
+	"""
+
+	def __call__(self, turn: dict) -> bool:
+		raise NotImplementedError
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		raise NotImplementedError
+
+	def get_mask(self, dataset_index, _cache: dict = None) -> np.ndarray:
+		"""
+		Compiles the expression to a mask over the turns of an index. The masks of the
+		sub-expressions are cached by their text, so give the same cache to compile many
+		expressions that share them (see compile_splits).
+
+		:param dataset_index: index of the data, see indexing.DatasetIndex
+		:param _cache: dict of expression text -> mask
+		:return: boolean array with one entry per turn
+		"""
+		if _cache is None:
+			_cache = {}
+		key = repr(self)
+		if key not in _cache:
+			_cache[key] = self._get_mask(dataset_index, _cache)
+		return _cache[key]
+
+	def __and__(self, other: 'SplitExpression') -> 'SplitExpression':
+		return And(self, other)
+
+	def __or__(self, other: 'SplitExpression') -> 'SplitExpression':
+		return Or(self, other)
+
+	def __invert__(self) -> 'SplitExpression':
+		return Not(self)
+
+	def __eq__(self, other) -> bool:
+		return isinstance(other, SplitExpression) and repr(self) == repr(other)
+
+	def __hash__(self) -> int:
+		return hash(repr(self))
+
+
+class AllTurns(SplitExpression):
+	"""All the turns."""
+
+	def __call__(self, turn: dict) -> bool:
+		return True
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return np.ones(len(dataset_index), dtype=bool)
+
+	def __repr__(self) -> str:
+		return 'all'
+
+
+class Tag(SplitExpression):
+	"""Turns before the CR whose CE has a tag, see tagging.py."""
+
+	def __init__(self, tag: str):
+		self.tag = tag
+
+	def __call__(self, turn: dict) -> bool:
+		return ce.is_tag_in_ce(turn, self.tag)
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return dataset_index.get_tag_mask(self.tag)
+
+	def __repr__(self) -> str:
+		return f"tag:{self.tag}"
+
+
+class CERole(SplitExpression):
+	"""Turns with a role in a CE: 'before' (the CE turns of the paper), 'after' the CR or 'none'."""
+
+	ROLES = ['none', 'before', 'after']     # in the order of indexing.CE_ROLE_*
+
+	def __init__(self, role: str):
+		if role not in self.ROLES:
+			raise ValueError(f"Unknown CE role '{role}', use one of {self.ROLES}")
+		self.role = role
+
+	def __call__(self, turn: dict) -> bool:
+		return turn.get('ce_turn', 'none') == self.role
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return dataset_index.ce_role == self.ROLES.index(self.role)
+
+	def __repr__(self) -> str:
+		return f"role:{self.role}"
+
+
+class Domain(SplitExpression):
+	"""Turns of the dialogues of a domain, 'fashion' or 'furniture'."""
+
+	def __init__(self, domain: str):
+		self.domain = domain
+
+	def __call__(self, turn: dict) -> bool:
+		return turn.get('domain') == self.domain
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		if self.domain not in dataset_index.domain_names:
+			return np.zeros(len(dataset_index), dtype=bool)
+		return dataset_index.domain == dataset_index.domain_names.index(self.domain)
+
+	def __repr__(self) -> str:
+		return f"domain:{self.domain}"
+
+
+class Scene(SplitExpression):
+	"""Turns whose current scene is the one given."""
+
+	def __init__(self, scene_idx: str):
+		self.scene_idx = scene_idx
+
+	def __call__(self, turn: dict) -> bool:
+		return turn.get('scene_idx') == self.scene_idx
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		if self.scene_idx not in dataset_index.scene_names:
+			return np.zeros(len(dataset_index), dtype=bool)
+		return dataset_index.scene == dataset_index.scene_names.index(self.scene_idx)
+
+	def __repr__(self) -> str:
+		return f"scene:{self.scene_idx}"
+
+
+class ObjectCount(SplitExpression):
+	"""Turns whose number of gold objects compares to a value, e.g., ObjectCount('>=', 2)."""
+
+	OPERATORS = {
+		'>=': operator.ge, '<=': operator.le, '==': operator.eq, '!=': operator.ne,
+		'>': operator.gt, '<': operator.lt}
+
+	def __init__(self, comparison: str, value: int):
+		if comparison not in self.OPERATORS:
+			raise ValueError(f"Unknown comparison '{comparison}', use one of {list(self.OPERATORS)}")
+		self.comparison, self.value = comparison, int(value)
+
+	def __call__(self, turn: dict) -> bool:
+		return self.OPERATORS[self.comparison](
+			len(turn['transcript_annotated']['act_attributes']['objects']), self.value)
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return self.OPERATORS[self.comparison](dataset_index.num_objects, self.value)
+
+	def __repr__(self) -> str:
+		return f"objects{self.comparison}{self.value}"
+
+
+class CERounds(SplitExpression):
+	"""
+	First turns of the clarification chains whose number of rounds compares to a value, e.g.,
+	CERounds('>=', 2) for the chains where the CR was answered with another ambiguity. See ce.ClarificationChain.
+	"""
+
+	def __init__(self, comparison: str, value: int):
+		if comparison not in ObjectCount.OPERATORS:
+			raise ValueError(f"Unknown comparison '{comparison}', use one of {list(ObjectCount.OPERATORS)}")
+		self.comparison, self.value = comparison, int(value)
+
+	def __call__(self, turn: dict) -> bool:
+		return 'ce_chain' in turn and ObjectCount.OPERATORS[self.comparison](turn['ce_chain'].rounds, self.value)
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return (dataset_index.ce_rounds > 0) & ObjectCount.OPERATORS[self.comparison](dataset_index.ce_rounds, self.value)
+
+	def __repr__(self) -> str:
+		return f"rounds{self.comparison}{self.value}"
+
+
+class And(SplitExpression):
+
+	def __init__(self, *expressions: SplitExpression):
+		self.expressions = expressions
+
+	def __call__(self, turn: dict) -> bool:
+		return all(x(turn) for x in self.expressions)
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return np.logical_and.reduce([x.get_mask(dataset_index, _cache) for x in self.expressions])
+
+	def __repr__(self) -> str:
+		return f"({' & '.join(repr(x) for x in self.expressions)})"
+
+
+class Or(SplitExpression):
+
+	def __init__(self, *expressions: SplitExpression):
+		self.expressions = expressions
+
+	def __call__(self, turn: dict) -> bool:
+		return any(x(turn) for x in self.expressions)
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return np.logical_or.reduce([x.get_mask(dataset_index, _cache) for x in self.expressions])
+
+	def __repr__(self) -> str:
+		return f"({' | '.join(repr(x) for x in self.expressions)})"
+
+
+class Not(SplitExpression):
+
+	def __init__(self, expression: SplitExpression):
+		self.expression = expression
+
+	def __call__(self, turn: dict) -> bool:
+		return not self.expression(turn)
+
+	def _get_mask(self, dataset_index, _cache: dict) -> np.ndarray:
+		return ~self.expression.get_mask(dataset_index, _cache)
+
+	def __repr__(self) -> str:
+		return f"!{self.expression!r}"
+
+
+_PREDICATES = {'tag': Tag, 'role': CERole, 'domain': Domain, 'scene': Scene}
+_COMPARISONS = {'objects': ObjectCount, 'rounds': CERounds}
+_TOKEN_PATTERN = re.compile(
+	r"\s*(?:(\(|\)|&|\||!)|(objects|rounds)\s*(>=|<=|==|!=|>|<)\s*(\d+)|([A-Za-z_]+)(?::([^\s()&|!]+))?)")
+
+
+def _tokenize_split(text: str) -> list:
+	tokens, position = [], 0
+	while position < len(text.rstrip()):
+		match = _TOKEN_PATTERN.match(text, position)
+		if match is None:
+			raise ValueError(f"Invalid split expression at {position}: '{text[position:]}'")
+		symbol, counted, comparison, value, word, argument = match.groups()
+		if symbol is not None:
+			tokens.append(symbol)
+		elif comparison is not None:
+			tokens.append(_COMPARISONS[counted](comparison, int(value)))
+		elif word in ('and', 'or', 'not') and argument is None:
+			tokens.append({'and': '&', 'or': '|', 'not': '!'}[word])
+		elif word == 'all' and argument is None:
+			tokens.append(AllTurns())
+		elif word in _PREDICATES:
+			if argument is None:
+				raise ValueError(f"Missing the value of '{word}:' in split expression '{text}'")
+			tokens.append(_PREDICATES[word](argument))
+		else:
+			raise ValueError(f"Unknown split term '{match.group().strip()}', use one of {list(_PREDICATES)}, objects, rounds or all")
+		position = match.end()
+	return tokens
+
+
+def parse_split(text: str) -> SplitExpression:
+	"""
+	Parses a split expression from text. Terms are tag:<tag>, role:<before|after|none>, domain:<domain>,
+	scene:<scene id>, objects<comparison><value> (e.g., objects>=2), rounds<comparison><value> (e.g., rounds>=2)
+	and all, combined with
+	& (and), | (or), ! (not) and parenthesis. ! binds tighter than &, and & tighter than |.
+
+	:param text: the expression, e.g., 'tag:spatial & !domain:furniture'
+	:return: the split expression
+	"""
+	tokens = _tokenize_split(text)
+	position = 0
+
+	def _peek():
+		return tokens[position] if position < len(tokens) else None
+
+	def _next():
+		nonlocal position
+		position += 1
+		return tokens[position - 1]
+
+	def _parse_binary(symbol, parse_operand, expression_class):
+		operands = [parse_operand()]
+		while _peek() == symbol:
+			_next()
+			operands.append(parse_operand())
+		return operands[0] if len(operands) == 1 else expression_class(*operands)
+
+	def _parse_or():
+		return _parse_binary('|', _parse_and, Or)
+
+	def _parse_and():
+		return _parse_binary('&', _parse_not, And)
+
+	def _parse_not():
+		if _peek() == '!':
+			_next()
+			return Not(_parse_not())
+		token = _next() if _peek() is not None else None
+		if token == '(':
+			expression = _parse_or()
+			if _peek() != ')':
+				raise ValueError(f"Missing closing parenthesis in split expression '{text}'")
+			_next()
+			return expression
+		if not isinstance(token, SplitExpression):
+			raise ValueError(f"Expected a term in split expression '{text}', got {token!r}")
+		return token
+
+	expression = _parse_or()
+	if _peek() is not None:
+		raise ValueError(f"Unexpected {_peek()!r} in split expression '{text}'")
+	return expression
+
+
+def get_tag_combinations(tags: list = None, sizes: tuple = (2, 3)) -> list:
+	"""
+	Enumerates the splits with all the combinations of some CE tags, e.g., all tag pairs and triples.
+
+	:param tags: tags to combine, default the fine-grained tags (tagging.TAGS)
+	:param sizes: number of tags of each combination
+	:return: list of (split name, split expression), e.g., ('colour+spatial', tag:colour & tag:spatial)
+	"""
+	if tags is None:
+		tags = tagging.TAGS
+	return [
+		('+'.join(combination), And(*[Tag(x) for x in combination]))
+		for size in sizes for combination in itertools.combinations(tags, size)]
+
+
+def compile_splits(dataset_index, split_list: list) -> dict:
+	"""
+	Compiles many splits to masks over the turns of an index at once, sharing the
+	masks of their common sub-expressions.
+
+	:param dataset_index: index of the data, see indexing.DatasetIndex
+	:param split_list: list of (split name, split expression or None for all turns)
+	:return: dict of split name -> boolean array with one entry per turn
+	"""
+	_cache = {}
+	return {
+		split_name: (expression or AllTurns()).get_mask(dataset_index, _cache)
+		for split_name, expression in split_list}
+
+
+# (split name, split expression or filter function that takes a turn and returns True if it is in the split)
+PAPER_SPLITS = [
+	('All Turns', None),
+	# ('Unambiguous Turns (All - CR Turns)', ~CERole('before')),
+	('CR Turns', CERole('before')),
+	('Individual Property', Tag(tagging.TAG_INDIVIDUAL_PROPERTY)),
+	('Dialogue History', Tag(tagging.TAG_DIALOGUE_HISTORY)),
+	('Relational Context', Tag(tagging.TAG_RELATIONAL_CONTEXT)),
+]
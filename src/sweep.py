@@ -0,0 +1,193 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Sweep over many checkpoints of a model, e.g., every checkpoint saved while training. The original data,
+its CEs and the split masks are prepared once, then each checkpoint is loaded, scored and freed before the
+next one (or N at a time in worker processes), so the memory does not grow with the number of checkpoints.
+The results are written as they come to a tidy table, with one row per checkpoint, split and part.
+
+Usage:
+	python -m src.sweep "data/Team9/checkpoints/coref-pred-*.json" --processes 4 --output sweep.tsv
+"""
+
+import os
+import re
+import csv
+import glob
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List
+
+from . import alignment, profiling, service, splits
+from .indexing import DatasetIndex
+from .registry import ModelRegistry
+
+
+SWEEP_COLUMNS = [
+	'checkpoint', 'file', 'split', 'part', 'object_f1', 'object_f1_stderr', 'object_rec', 'object_prec',
+	'entries_evaluated', 'aligned', 'missing', 'error']
+
+
+def get_natural_sort_key(text: str) -> list:
+	"""
+	Gets a key to sort texts with their numbers in order, e.g., 'devtest-step2' before 'devtest-step10'.
+
+	:param text: text to sort
+	:return: list of the parts of the text, with the digit runs as numbers
+	"""
+	# splitting with a group keeps the digit runs at the odd positions, so the keys are always comparable
+	return [int(x) if i % 2 == 1 else x for i, x in enumerate(re.split(r'(\d+)', text))]
+
+
+def get_checkpoint_files(patterns: List[str]) -> Dict[str, str]:
+	"""
+	Finds the checkpoint files that match some glob patterns, named as the model outputs of
+	ModelRegistry.discover_files (e.g., 'Team9/devtest-step100' for Team9/coref-pred-devtest-step100.json).
+
+	:param patterns: glob patterns of the files, ** matches any folder
+	:return: dict of checkpoint name -> file, sorted by name with the numbers in order (e.g., step2 before step10)
+	"""
+	checkpoint_files = {}
+	for pattern in patterns:
+		for file_path in glob.glob(pattern, recursive=True):
+			checkpoint_name = ModelRegistry(os.path.dirname(file_path)).get_output_name(
+				os.path.basename(os.path.dirname(os.path.abspath(file_path))), os.path.basename(file_path))
+			checkpoint_files.setdefault(checkpoint_name, file_path)
+	return dict(sorted(checkpoint_files.items(), key=lambda item: get_natural_sort_key(item[0])))
+
+
+def evaluate_checkpoint(
+	dataset_index: DatasetIndex, turn_keys: list, checkpoint_name: str, checkpoint_file: str,
+	missing_policy: str = alignment.MISSING_SKIP) -> List[dict]:
+	"""
+	Scores a checkpoint on all the splits of the index, see service.evaluate_request. Only its
+	results are returned, its predictions are freed when it finishes.
+
+	:param dataset_index: index of the original data, with its splits
+	:param turn_keys: (dialogue_idx, turn_idx) of the original data, see DatasetIndex.turn_keys
+	:param checkpoint_name: name of the checkpoint in the results
+	:param checkpoint_file: model output file of the checkpoint
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:return: list of rows with SWEEP_COLUMNS, one per split and part, or a single row with the error
+	"""
+	try:
+		results = service.evaluate_request(dataset_index, turn_keys, {
+			'prediction_file': checkpoint_file, 'model_name': checkpoint_name, 'missing_policy': missing_policy})
+	except (ValueError, KeyError, TypeError, OSError) as e:     # e.g., not a valid model output
+		return [{'checkpoint': checkpoint_name, 'file': checkpoint_file, 'error': f"{type(e).__name__}: {e}"}]
+
+	rows = []
+	for split_name, split_results in results['splits'].items():
+		for part in (['Before-CR', 'After-CR'] if 'Before-CR' in split_results else ['All']):
+			part_results = split_results[part] if part != 'All' else split_results
+			rows.append({
+				'checkpoint': checkpoint_name, 'file': checkpoint_file, 'split': split_name, 'part': part,
+				**{key: part_results[key] for key in SWEEP_COLUMNS if key in part_results},
+				'aligned': results['alignment']['aligned'], 'missing': results['alignment']['missing']})
+	return rows
+
+
+# index of the original data in each worker process, sent once when the worker starts
+_worker_index = None
+_worker_turn_keys = None
+
+
+def _init_worker(dataset_index: DatasetIndex) -> None:
+	global _worker_index, _worker_turn_keys
+	_worker_index, _worker_turn_keys = dataset_index, dataset_index.turn_keys
+
+
+def _evaluate_checkpoint_worker(checkpoint_name: str, checkpoint_file: str, missing_policy: str) -> List[dict]:
+	return evaluate_checkpoint(_worker_index, _worker_turn_keys, checkpoint_name, checkpoint_file, missing_policy)
+
+
+def sweep_checkpoints(
+	dataset_index: DatasetIndex, checkpoint_files: Dict[str, str], processes: int = 1,
+	missing_policy: str = alignment.MISSING_SKIP) -> Iterator[List[dict]]:
+	"""
+	Scores the checkpoints one by one, or in a pool of worker processes where each worker only
+	has one checkpoint in memory at a time. The index is sent once to each worker.
+
+	:param dataset_index: index of the original data, with its splits
+	:param checkpoint_files: dict of checkpoint name -> model output file, see get_checkpoint_files
+	:param processes: number of checkpoints scored at the same time
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:return: iterator of the rows of each checkpoint (see evaluate_checkpoint), in the order of checkpoint_files
+	"""
+	if processes == 1 or len(checkpoint_files) <= 1:
+		turn_keys = dataset_index.turn_keys
+		for checkpoint_name, checkpoint_file in checkpoint_files.items():
+			with profiling.stage('evaluate checkpoint', checkpoint=checkpoint_name):
+				yield evaluate_checkpoint(dataset_index, turn_keys, checkpoint_name, checkpoint_file, missing_policy)
+		return
+
+	with ProcessPoolExecutor(
+		max_workers=min(processes or multiprocessing.cpu_count(), len(checkpoint_files)),
+		initializer=_init_worker, initargs=(dataset_index,)) as executor:
+		# only the file names are queued, each worker loads its checkpoint when it starts it
+		yield from executor.map(
+			_evaluate_checkpoint_worker, checkpoint_files.keys(), checkpoint_files.values(),
+			[missing_policy] * len(checkpoint_files))
+
+
+def write_sweep_results(checkpoint_rows: Iterator[List[dict]], results_file: str) -> Iterator[List[dict]]:
+	"""
+	Writes the rows of each checkpoint to a tab-separated table as soon as they are scored.
+
+	:param checkpoint_rows: rows of each checkpoint, see sweep_checkpoints
+	:param results_file: path of the table
+	:return: iterator of the same rows, once they are written
+	"""
+	with open(results_file, 'w', newline='') as f_out:
+		writer = csv.DictWriter(f_out, SWEEP_COLUMNS, delimiter='\t')
+		writer.writeheader()
+		for rows in checkpoint_rows:
+			writer.writerows(rows)
+			f_out.flush()
+			yield rows
+
+
+def format_sweep_row(rows: List[dict]) -> str:
+	"""Formats the object F1 of each split of a checkpoint in a single line, Before-CR -> After-CR for the CE splits."""
+	if len(rows) == 1 and rows[0].get('error'):
+		return f"{rows[0]['checkpoint']}: {rows[0]['error']}"
+
+	split_f1 = {}
+	for row in rows:
+		split_f1.setdefault(row['split'], []).append(f"{row['object_f1'] * 100:.1f}")
+	return f"{rows[0]['checkpoint']}: " + ', '.join(f"{x} {' -> '.join(f1)}" for x, f1 in split_f1.items())
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Evaluate many checkpoints of a model with bounded memory')
+	parser.add_argument('patterns', nargs='+', help='glob patterns of the model output files of the checkpoints')
+	parser.add_argument('--simmc2-folder', default='../simmc2/data', help='folder with the SIMMC2 data')
+	parser.add_argument('--dataset-file', default=service.DEFAULT_DATASET_FILE, help='SIMMC2 dialogues file in that folder')
+	parser.add_argument(
+		'--split', nargs=2, action='append', default=[], metavar=('NAME', 'EXPRESSION'),
+		help='extra split to evaluate, e.g., --split "Spatial" "tag:spatial", see src/splits.py')
+	parser.add_argument('--processes', type=int, default=1, help='checkpoints to score at the same time')
+	parser.add_argument('--missing-policy', default=alignment.MISSING_SKIP, choices=alignment.MISSING_POLICIES)
+	parser.add_argument('--output', default='sweep.tsv', help='table with the results of every checkpoint')
+	args = parser.parse_args()
+
+	sweep_files = get_checkpoint_files(args.patterns)
+	if len(sweep_files) == 0:
+		parser.error(f"No files match {args.patterns}")
+
+	# the gold side (CEs, index and split masks) is prepared once for all the checkpoints
+	sweep_index = service.load_dataset_index(
+		os.path.join(args.simmc2_folder, args.dataset_file),
+		splits.PAPER_SPLITS + [(name, splits.parse_split(expression)) for name, expression in args.split])
+	print(f"Evaluating {len(sweep_files)} checkpoints on {sweep_index}, results in {args.output}")
+	for checkpoint_results in write_sweep_results(
+			sweep_checkpoints(sweep_index, sweep_files, args.processes, args.missing_policy), args.output):
+		print(format_sweep_row(checkpoint_results))
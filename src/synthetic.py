@@ -0,0 +1,304 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Deterministic generator of synthetic data in the same format and folder structure as SIMMC2
+(dialogues with CEs, scenes and prefab metadata) and of model output files, to run and benchmark
+the experiments without the SIMMC2 data. The numbers it gives are meaningless.
+
+Usage:
+	python -m src.synthetic --output-folder synthetic --scale 1 --models 3
+	python run_experiments.py --simmc2-folder synthetic/simmc2/data --data-folder synthetic/data
+"""
+
+import os
+import json
+import random
+import argparse
+
+from .registry import DEFAULT_PREDICTION_FILE
+
+
+# approximate size of the SIMMC2 devtest split (scale 1)
+DEVTEST_DIALOGUES = 1687
+DEVTEST_SCENES = 1000
+MAX_SCENES = 20000          # scenes are shared by the dialogues, so they stop growing after this
+MIN_TURNS, MAX_TURNS = 2, 8
+AMBIGUOUS_TURN_RATE = 0.1   # turns with disambiguation_label 1, most followed by a CR and a response
+PREFABS = {'fashion': 300, 'furniture': 60}
+
+DATASET_FILE = 'simmc2_dials_dstc10_devtest.json'
+SCENES_FOLDER = 'simmc2_scene_jsons_dstc10_public'
+
+_PROPERTIES = {
+	'fashion': {
+		'type': ['blouse', 'dress', 'jacket', 'coat', 'shirt', 'sweater', 'hoodie', 'skirt', 'trousers', 'tshirt'],
+		'color': ['black', 'white', 'grey', 'red', 'blue', 'brown', 'beige', 'olive', 'purple', 'black, white'],
+		'brand': ['Art Den', 'Brain Puzzles', 'Cats Are Great', 'Coats & More', 'Downtown Consignment', 'Nature Photographers'],
+	},
+	'furniture': {
+		'type': ['Sofa', 'Chair', 'Table', 'CoffeeTable', 'Shelves', 'Lamp', 'Bed', 'AreaRug'],
+		'color': ['black', 'white', 'grey', 'brown', 'wooden', 'blue', 'red'],
+		'brand': ['Uptown Gallery', 'Home Store', 'Modern Arts', 'River Chateau', 'North Lodge'],
+	},
+}
+_IMAGE_WIDTH, _IMAGE_HEIGHT = 1920, 1080
+
+_USER_REQUESTS = [
+	'What is the price of the {color} {type}?', 'Can you tell me the brand of that {type}?',
+	'How much is the {color} one?', 'What sizes does the {type} come in?', 'Add the {type} to my cart, please.',
+	'I like the {color} {type}. What are its reviews?', 'Is the {type} available in other sizes?',
+	'What about that one?', 'Show me something like the {color} {type}.']
+_SYSTEM_RESPONSES = [
+	'It is ${price}.', 'That one is from {brand}.', 'Sure, it has been added to your cart.',
+	'It has a rating of {rating}.', 'It comes in S, M and L.', 'I have found a couple of items like that.']
+_CLARIFICATION_REQUESTS = [
+	'Which one do you mean?', 'Do you mean the {color} {type} on the {region}?', 'Which {type} are you referring to?',
+	'Could you be more specific?', 'Which of the {color} ones do you mean?']
+
+
+def _load_clarification_responses() -> list:
+	"""User utterances from the tagging tests, which are realistic responses to clarification requests."""
+	test_path = os.path.join(os.path.dirname(__file__), 'tagging_tests.json')
+	with open(test_path, 'r') as f_in:
+		tagging_tests = json.load(f_in)
+	return sorted({x for utterances in tagging_tests.values() for x in utterances if not x.startswith('#')})
+
+
+def _get_prefab_path(domain: str, prefab_id: int) -> str:
+	return f"@synthetic/{domain}/prefab_{prefab_id:04d}"
+
+
+def _get_scene_name(scene_id: int) -> str:
+	return f"synthetic_store_{scene_id:05d}"
+
+
+def generate_metadata(domain: str, seed: int = 0) -> dict:
+	"""
+	Generates the prefab metadata of a domain, as in {domain}_prefab_metadata_all.json.
+
+	:param domain: 'fashion' or 'furniture'
+	:param seed: random seed
+	:return: dict of prefab path -> properties
+	"""
+	rnd = random.Random(f"{seed}-metadata-{domain}")
+	return {
+		_get_prefab_path(domain, i): {
+			key: rnd.choice(values) for key, values in _PROPERTIES[domain].items()}
+		for i in range(PREFABS[domain])}
+
+
+def generate_scene(scene_id: int, seed: int = 0) -> dict:
+	"""
+	Generates a scene json. Objects have their index as id and a bbox [x, y, height, width].
+
+	:param scene_id: id of the scene, it decides its domain
+	:param seed: random seed
+	:return: the scene, as in the SIMMC2 scene jsons
+	"""
+	rnd = random.Random(f"{seed}-scene-{scene_id}")
+	domain = 'fashion' if scene_id % 4 != 0 else 'furniture'
+	objects = []
+	for index in range(rnd.randint(8, 40) if domain == 'fashion' else rnd.randint(5, 15)):
+		height, width = rnd.randint(40, 400), rnd.randint(40, 300)
+		objects.append({
+			'prefab_path': _get_prefab_path(domain, rnd.randrange(PREFABS[domain])),
+			'unique_id': index, 'index': index,
+			'bbox': [rnd.randint(0, _IMAGE_WIDTH - width), rnd.randint(0, _IMAGE_HEIGHT - height), height, width],
+			'position': [round(rnd.uniform(-5, 5), 2), 0.0, round(rnd.uniform(-5, 5), 2)]})
+	return {'scenes': [{'objects': objects, 'relationships': {}}]}
+
+
+def _get_turn_annotation(act: str, objects: list) -> dict:
+	return {'act': act, 'act_attributes': {'slot_values': {}, 'request_slots': [], 'objects': objects}}
+
+
+def generate_dialogue(dialogue_idx: int, scene_sizes: list, clarification_responses: list, seed: int = 0) -> dict:
+	"""
+	Generates a dialogue. Some turns are ambiguous (disambiguation_label 1), where the
+	system asks for clarification and the user responds in the next turn, as in SIMMC2.
+	Each dialogue has its own random generator, so any dialogue can be generated on its own.
+
+	:param dialogue_idx: id of the dialogue
+	:param scene_sizes: number of objects of each scene to choose from, see generate_scene
+	:param clarification_responses: utterances to use as clarification responses
+	:param seed: random seed
+	:return: the dialogue, as in the SIMMC2 dialogue data
+	"""
+	rnd = random.Random(f"{seed}-dialogue-{dialogue_idx}")
+	num_turns = rnd.randint(MIN_TURNS, MAX_TURNS)
+	first_scene = rnd.randrange(len(scene_sizes))
+	scene_ids = {'0': _get_scene_name(first_scene)}
+	scene_change, second_scene = None, None
+	if num_turns > 2 and rnd.random() < 0.3:
+		scene_change, second_scene = rnd.randint(1, num_turns - 1), rnd.randrange(len(scene_sizes))
+		scene_ids[str(scene_change)] = _get_scene_name(second_scene)
+	domain = 'fashion' if first_scene % 4 != 0 else 'furniture'
+
+	turns = []
+	response_turn = False
+	for turn_idx in range(num_turns):
+		# objects must be in the current scene and, after it changes, in the previous one too
+		num_objects = scene_sizes[first_scene] if scene_change is None or turn_idx < scene_change \
+			else min(scene_sizes[first_scene], scene_sizes[second_scene])
+		words = {
+			'color': rnd.choice(_PROPERTIES[domain]['color']), 'type': rnd.choice(_PROPERTIES[domain]['type']),
+			'brand': rnd.choice(_PROPERTIES[domain]['brand']), 'region': rnd.choice(['left', 'right', 'middle']),
+			'price': rnd.randint(10, 500), 'rating': round(rnd.uniform(1, 5), 1)}
+		turn = {'turn_idx': turn_idx}
+
+		if response_turn:
+			# the user responds to the clarification request of the previous turn, about the same objects
+			turn['transcript'] = rnd.choice(clarification_responses)
+			objects = [x for x in objects if x < num_objects]
+			response_turn = False
+		else:
+			turn['transcript'] = rnd.choice(_USER_REQUESTS).format(**words)
+			objects = rnd.sample(range(num_objects), min(num_objects, rnd.choice([0, 1, 1, 1, 2, 3])))
+
+		if not response_turn and turn_idx < num_turns - 1 and rnd.random() < AMBIGUOUS_TURN_RATE:
+			turn['disambiguation_label'] = 1
+			turn['system_transcript'] = rnd.choice(_CLARIFICATION_REQUESTS).format(**words)
+			response_turn = True
+		else:
+			if rnd.random() < 0.5:
+				turn['disambiguation_label'] = 0
+			turn['system_transcript'] = rnd.choice(_SYSTEM_RESPONSES).format(**words)
+
+		turn['transcript_annotated'] = _get_turn_annotation('REQUEST:GET', objects)
+		turn['system_transcript_annotated'] = _get_turn_annotation('INFORM:GET', objects)
+		turns.append(turn)
+
+	return {
+		'dialogue_idx': dialogue_idx, 'domain': domain, 'mentioned_object_ids': [],
+		'scene_ids': scene_ids, 'dialogue': turns}
+
+
+def generate_model_turn(dialogue: dict, turn: dict, model_id: int, seed: int = 0) -> dict:
+	"""
+	Generates the prediction of a model for a turn, in the format of the SIMMC2 challenge
+	(one turn per dialogue). Models with a higher id are worse, and all models are
+	worse in ambiguous turns, where they tend to predict extra objects.
+
+	:param dialogue: the dialogue of the turn
+	:param turn: the turn to predict
+	:param model_id: id of the model
+	:param seed: random seed
+	:return: a dialogue with only the predicted turn
+	"""
+	rnd = random.Random(f"{seed}-model-{model_id}-{dialogue['dialogue_idx']}-{turn['turn_idx']}")
+	gold_objects = turn['transcript_annotated']['act_attributes']['objects']
+	is_ambiguous = turn.get('disambiguation_label') == 1
+	recall = (0.5 if is_ambiguous else 0.85) - 0.05 * model_id
+	pred_objects = [x for x in gold_objects if rnd.random() < recall]
+	if rnd.random() < (0.6 if is_ambiguous else 0.15):
+		pred_objects.append(rnd.randrange(10))
+
+	return {
+		'dialogue_idx': dialogue['dialogue_idx'],
+		'dialogue': [{
+			'turn_idx': turn['turn_idx'], 'transcript': turn['transcript'], 'pred_objects': pred_objects,
+			'transcript_annotated': _get_turn_annotation(turn['transcript_annotated']['act'], pred_objects)}]}
+
+
+class _JsonListWriter:
+	"""Writes {"dialogue_data": [...]} one dialogue at a time, so big files are never fully in memory."""
+
+	def __init__(self, file_path: str):
+		self.f_out = open(file_path, 'w')
+		self.f_out.write('{"split": "devtest", "dialogue_data": [')
+		self.empty = True
+
+	def write(self, value: dict) -> None:
+		self.f_out.write(('' if self.empty else ', ') + json.dumps(value))
+		self.empty = False
+
+	def close(self) -> None:
+		self.f_out.write(']}')
+		self.f_out.close()
+
+
+def get_num_dialogues(scale: float) -> int:
+	return max(1, round(DEVTEST_DIALOGUES * scale))
+
+
+def get_num_scenes(scale: float) -> int:
+	return min(MAX_SCENES, max(1, round(DEVTEST_SCENES * scale)))
+
+
+def write_synthetic_data(
+	output_folder: str, scale: float = 1., num_models: int = 3, seed: int = 0,
+	prediction_file: str = DEFAULT_PREDICTION_FILE) -> dict:
+	"""
+	Writes synthetic data in the same structure as the experiments expect:
+	- {output_folder}/simmc2/data: prefab metadata, scene jsons and devtest dialogues
+	- {output_folder}/data/SyntheticModel{i}: model output of each model
+
+	The same seed and scale always give the same files. Dialogues and model outputs are
+	written one dialogue at a time, so scales up to 1000x devtest fit in memory.
+
+	:param output_folder: folder to write the data
+	:param scale: size of the data compared to the SIMMC2 devtest split, e.g., 0.1, 1 or 1000
+	:param num_models: number of model output files
+	:param seed: random seed
+	:param prediction_file: name of the model output files
+	:return: dict with the 'simmc2_folder', 'data_folder' and the number of 'dialogues', 'turns' and 'scenes'
+	"""
+	simmc2_folder = os.path.join(output_folder, 'simmc2', 'data')
+	data_folder = os.path.join(output_folder, 'data')
+	os.makedirs(os.path.join(simmc2_folder, SCENES_FOLDER), exist_ok=True)
+
+	for domain in PREFABS:
+		with open(os.path.join(simmc2_folder, f"{domain}_prefab_metadata_all.json"), 'w') as f_out:
+			json.dump(generate_metadata(domain, seed), f_out)
+
+	num_scenes = get_num_scenes(scale)
+	scene_sizes = []
+	for scene_id in range(num_scenes):
+		scene = generate_scene(scene_id, seed)
+		scene_sizes.append(len(scene['scenes'][0]['objects']))
+		with open(os.path.join(simmc2_folder, SCENES_FOLDER, f"{_get_scene_name(scene_id)}_scene.json"), 'w') as f_out:
+			json.dump(scene, f_out)
+
+	model_writers = []
+	for model_id in range(num_models):
+		os.makedirs(os.path.join(data_folder, f"SyntheticModel{model_id}"), exist_ok=True)
+		model_writers.append(_JsonListWriter(os.path.join(data_folder, f"SyntheticModel{model_id}", prediction_file)))
+
+	clarification_responses = _load_clarification_responses()
+	dataset_writer = _JsonListWriter(os.path.join(simmc2_folder, DATASET_FILE))
+	num_dialogues, num_turns = get_num_dialogues(scale), 0
+	for dialogue_idx in range(num_dialogues):
+		dialogue = generate_dialogue(dialogue_idx, scene_sizes, clarification_responses, seed)
+		dataset_writer.write(dialogue)
+		for turn in dialogue['dialogue']:
+			for model_id, model_writer in enumerate(model_writers):
+				model_writer.write(generate_model_turn(dialogue, turn, model_id, seed))
+		num_turns += len(dialogue['dialogue'])
+
+	for writer in [dataset_writer] + model_writers:
+		writer.close()
+
+	return {
+		'simmc2_folder': simmc2_folder, 'data_folder': data_folder,
+		'dialogues': num_dialogues, 'turns': num_turns, 'scenes': num_scenes}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate synthetic SIMMC2 data and model outputs')
+	parser.add_argument('--output-folder', default='synthetic', help='folder to write the data')
+	parser.add_argument('--scale', type=float, default=1., help='size compared to the SIMMC2 devtest split')
+	parser.add_argument('--models', type=int, default=3, help='number of model output files')
+	parser.add_argument('--seed', type=int, default=0, help='random seed')
+	args = parser.parse_args()
+
+	summary = write_synthetic_data(args.output_folder, args.scale, args.models, args.seed)
+	print(
+		f"Generated {summary['dialogues']} dialogues ({summary['turns']} turns), {summary['scenes']} scenes "
+		f"and {args.models} model outputs in {args.output_folder}")
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Statistics of the tags of the Clarification Exchanges (CEs), e.g., the tag frequencies of simmc2_tags_*.png.
+The tags of each utterance of a CE are kept as bitmasks, so frequencies, co-occurrences and rates
+conditioned on the tags (e.g., After-CR F1 by tag pair) are matrix operations over all the CEs.
+
+Usage:
+	tag_table = CETagTable.from_dataset(dataset)
+	tag_table.get_frequencies('c_request')                       # times each tag is in the CRs
+	tag_table.get_cooccurrences('ce', split_mask)                # tag x tag matrix in a split
+	get_f1_by_tags(tag_table, model_counts, 'After-CR')          # F1 of the CEs with each tag pair
+"""
+
+import numpy as np
+
+from . import iterate_over_dataset_entries
+from . import alignment, ce, tagging
+
+
+# utterances of a CE, see ce.ClarificationExchange. 'ce' has the tags of all of them
+UTTERANCE_ROLES = ['referential_ambiguity', 'c_request', 'c_response', 'ce']
+# fine-grained tags first, then the tag collections of the paper
+DEFAULT_TAG_NAMES = tagging.TAGS + [
+	tagging.TAG_INDIVIDUAL_PROPERTY, tagging.TAG_DIALOGUE_HISTORY, tagging.TAG_RELATIONAL_CONTEXT, tagging.TAG_OTHER]
+
+
+def _get_ce_role_tags(clarification_exchange: ce.ClarificationExchange, role: str) -> list:
+	return clarification_exchange.tags if role == 'ce' else getattr(clarification_exchange, f"tags_{role}")
+
+
+class CETagTable:
+	"""
+	One row per CE (the turn before the CR), with the tags of each of its utterances as a
+	bitmask (bit i is tag_names[i]) and the global turn id of the turn before the CR, so any
+	split mask over the turns (see splits.compile_splits) also selects the CEs.
+
+	Build it with CETagTable.from_dataset.
+	"""
+
+	def __init__(self, turn_ids: np.ndarray, role_bits: dict, tag_names: list):
+		self.turn_ids = turn_ids
+		self.role_bits = role_bits      # utterance role -> int64 array of bitmasks, one per CE
+		self.tag_names = tag_names
+
+	def __len__(self) -> int:
+		return len(self.turn_ids)
+
+	def __repr__(self) -> str:
+		return f"CETagTable({len(self)} CEs, {len(self.tag_names)} tags)"
+
+	@classmethod
+	def from_dataset(cls, dataset: dict, tag_names: list = None) -> 'CETagTable':
+		"""
+		Builds the table from a dataset where the CEs are already marked, see prepare_dataset.
+
+		:param dataset: the original SIMMC2 data
+		:param tag_names: tags in the order of their bits, default DEFAULT_TAG_NAMES. Other tags found are added at the end
+		:return: the table
+		"""
+		tag_codes = {tag: i for i, tag in enumerate(tag_names or DEFAULT_TAG_NAMES)}
+		turn_ids, role_bits = [], {role: [] for role in UTTERANCE_ROLES}
+		for turn_id, (_, turn_datum) in enumerate(iterate_over_dataset_entries(dataset)):
+			if not ce.is_ce_turn(turn_datum):
+				continue
+			turn_ids.append(turn_id)
+			for role in UTTERANCE_ROLES:
+				role_bits[role].append(sum(
+					1 << tag_codes.setdefault(x, len(tag_codes)) for x in set(_get_ce_role_tags(turn_datum['ce'], role))))
+
+		if len(tag_codes) > 63:
+			raise ValueError(f"Too many CE tags for a 64-bit mask: {len(tag_codes)}")
+		return cls(
+			np.array(turn_ids, dtype=np.int64), {role: np.array(x, dtype=np.int64) for role, x in role_bits.items()},
+			list(tag_codes))
+
+	def get_tag_matrix(self, role: str = 'ce', split_mask: np.ndarray = None) -> np.ndarray:
+		"""
+		Expands the bitmasks of the CEs to a matrix.
+
+		:param role: utterance role, see UTTERANCE_ROLES
+		:param split_mask: boolean array over all the turns, to only keep the CEs in a split
+		:return: int array of shape (CEs, tags), 1 if the CE has the tag
+		"""
+		bits = self.role_bits[role] if split_mask is None else self.role_bits[role][split_mask[self.turn_ids]]
+		return ((bits[:, None] >> np.arange(len(self.tag_names), dtype=np.int64)) & 1).astype(np.int64)
+
+	def get_frequencies(self, role: str = 'ce', split_mask: np.ndarray = None) -> np.ndarray:
+		"""
+		Counts the CEs with each tag.
+
+		:param role: utterance role, see UTTERANCE_ROLES
+		:param split_mask: boolean array over all the turns, to only count the CEs in a split
+		:return: int array with the count of each tag, in the order of tag_names
+		"""
+		return self.get_tag_matrix(role, split_mask).sum(axis=0)
+
+	def get_cooccurrences(self, role: str = 'ce', split_mask: np.ndarray = None) -> np.ndarray:
+		"""
+		Counts the CEs with each pair of tags. The diagonal is the frequency of each tag.
+
+		:param role: utterance role, see UTTERANCE_ROLES
+		:param split_mask: boolean array over all the turns, to only count the CEs in a split
+		:return: int array of shape (tags, tags)
+		"""
+		tag_matrix = self.get_tag_matrix(role, split_mask)
+		return tag_matrix.T @ tag_matrix
+
+	def get_conditional_sums(
+		self, values: np.ndarray, role: str = 'ce', split_mask: np.ndarray = None) -> np.ndarray:
+		"""
+		Sums some values of the CEs with each pair of tags, e.g., their correct objects.
+
+		:param values: array with one value per CE, or of shape (CEs, k) for k values at once
+		:param role: utterance role, see UTTERANCE_ROLES
+		:param split_mask: boolean array over all the turns, to only sum the CEs in a split
+		:return: array of shape (tags, tags), or (tags, tags, k)
+		"""
+		if split_mask is not None:
+			values = values[split_mask[self.turn_ids]]
+		tag_matrix = self.get_tag_matrix(role, split_mask)
+		return np.einsum('ni,nj,n...->ij...', tag_matrix, tag_matrix, values)
+
+	def to_dict(self, split_mask: np.ndarray = None) -> dict:
+		"""
+		Gets the tag frequencies and co-occurrences of every utterance role as arrays, e.g., to plot them
+		or to save them with np.savez.
+
+		:param split_mask: boolean array over all the turns, to only count the CEs in a split
+		:return: dict with the 'tag_names' and the '<role>_frequencies' and '<role>_cooccurrences' of each role
+		"""
+		statistics = {'tag_names': np.array(self.tag_names)}
+		for role in UTTERANCE_ROLES:
+			statistics[f"{role}_frequencies"] = self.get_frequencies(role, split_mask)
+			statistics[f"{role}_cooccurrences"] = self.get_cooccurrences(role, split_mask)
+		return statistics
+
+
+def get_f1_by_tags(
+	tag_table: CETagTable, model_object_counts, part: str = 'After-CR', role: str = 'ce',
+	split_mask: np.ndarray = None, missing_policy: str = alignment.MISSING_SKIP) -> tuple:
+	"""
+	Gets the object F1 of a model in the CEs with each pair of tags, the same as evaluating
+	a split with both tags (e.g., splits.Tag('colour') & splits.Tag('spatial')) for every pair at once.
+	The diagonal is the F1 of the CEs with each tag.
+
+	:param tag_table: the tags of the CEs
+	:param model_object_counts: evaluation.ModelObjectCounts of the model
+	:param part: 'Before-CR' or 'After-CR'
+	:param role: utterance role with the tags, see UTTERANCE_ROLES
+	:param split_mask: boolean array over all the turns, to only evaluate the CEs in a split
+	:param missing_policy: 'skip' or 'empty', see alignment.MISSING_POLICIES
+	:return: (float array of F1s of shape (tags, tags), NaN if there are no CEs to evaluate,
+		int array with the CEs evaluated of each pair)
+	"""
+	counts = model_object_counts.counts_after_cr if part == 'After-CR' else model_object_counts.counts
+	counts, evaluated = counts[tag_table.turn_ids], np.ones(len(tag_table), dtype=np.int64)
+	if missing_policy == alignment.MISSING_SKIP:
+		# the same CEs Before-CR and After-CR, see evaluation.evaluate_model_counts
+		evaluated = model_object_counts.has_ce_prediction[tag_table.turn_ids].astype(np.int64)
+		counts = counts * evaluated[:, None]
+
+	sums = tag_table.get_conditional_sums(np.column_stack([counts, evaluated]), role, split_mask)
+	n_true, n_pred, n_correct, entries = (sums[..., i] for i in range(4))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		# same as rec_prec_f1, which is 0 when there are no correct objects
+		object_f1 = np.where(n_correct > 0, 2 * n_correct / (n_true + n_pred), 0.)
+	return np.where(entries > 0, object_f1, np.nan), entries
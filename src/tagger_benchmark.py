@@ -0,0 +1,145 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Benchmark of the tagger backends (see tagging.py): it runs each backend over the tagging tests and
+the utterances of a corpus, with their throughput, latency and agreement on each tag with a reference
+backend, so a faster backend can be used only if it tags the same.
+
+Usage:
+	python -m src.tagger_benchmark --dataset-file ../simmc2/data/simmc2_dials_dstc10_devtest.json
+	python -m src.tagger_benchmark --scale 1     # on synthetic data, see synthetic.py
+"""
+
+import io
+import os
+import json
+import time
+import tempfile
+import argparse
+import contextlib
+
+import numpy as np
+
+from . import iterate_over_dataset_entries
+from . import synthetic, tagging
+
+
+DEFAULT_REFERENCE = 'regex'
+
+
+def load_corpus(dataset_file: str) -> list:
+	"""
+	Loads the utterances of a dataset to tag, both user and system utterances of every turn.
+
+	:param dataset_file: path to a dataset in the same format as SIMMC2
+	:return: list of utterances
+	"""
+	with open(dataset_file, 'r') as f_in:
+		dataset = json.load(f_in)
+	return [
+		utterance for _, turn in iterate_over_dataset_entries(dataset)
+		for utterance in (turn['transcript'], turn['system_transcript'])]
+
+
+def run_tagger(tagger: tagging.Tagger, utterances: list) -> tuple:
+	"""
+	Tags the utterances one by one with the fine-grained tags, as in the tagging tests.
+
+	:param tagger: the tagger backend
+	:param utterances: list of utterances
+	:return: (list of tags of each utterance, array with the seconds taken by each utterance)
+	"""
+	utterance_tags, latencies = [], np.zeros(len(utterances))
+	for i, utterance in enumerate(utterances):
+		start_time = time.perf_counter()
+		utterance_tags.append(tagger.extract_tags(utterance, fine_grained=True, fine_grained_combined=False))
+		latencies[i] = time.perf_counter() - start_time
+	return utterance_tags, latencies
+
+
+def _get_tag_matrix(utterance_tags: list, tag_names: list) -> np.ndarray:
+	return np.array([[tag in tags for tag in tag_names] for tags in utterance_tags], dtype=bool).reshape(-1, len(tag_names))
+
+
+def run_tests(tagger: tagging.Tagger) -> bool:
+	"""Checks whether a backend passes the tagging tests, see tagging.test_utterance_tagging."""
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			tagging.test_utterance_tagging(tagger)
+		return True
+	except AssertionError:
+		return False
+
+
+def benchmark_taggers(utterances: list, tagger_names: list = None, reference: str = DEFAULT_REFERENCE) -> dict:
+	"""
+	Runs each tagger backend over a corpus and compares its tags with those of a reference backend.
+	Each backend is created new, so the cached backend starts empty.
+
+	:param utterances: list of utterances
+	:param tagger_names: backends to run, default all the registered backends
+	:param reference: backend whose tags are taken as correct
+	:return: dict of backend name -> dict with whether it passes the 'tests', 'utterances_per_s',
+		'p50_us' and 'p99_us' latencies, 'exact_match' rate and 'agreement' rate of each tag
+	"""
+	tagger_names = tagger_names or tagging.get_tagger_names()
+	reference_tags, _ = run_tagger(tagging.get_tagger(reference), utterances)
+	reference_matrix = _get_tag_matrix(reference_tags, tagging.TAGS)
+
+	results = {}
+	for tagger_name in tagger_names:
+		tagger = tagging.get_tagger(tagger_name)
+		utterance_tags, latencies = run_tagger(tagger, utterances)
+		tag_matrix = _get_tag_matrix(utterance_tags, tagging.TAGS)
+		results[tagger_name] = {
+			'tests': run_tests(tagging.get_tagger(tagger_name)),
+			'utterances_per_s': len(utterances) / latencies.sum() if latencies.sum() > 0 else 0.,
+			'p50_us': np.percentile(latencies, 50) * 1e6 if len(utterances) > 0 else np.nan,
+			'p99_us': np.percentile(latencies, 99) * 1e6 if len(utterances) > 0 else np.nan,
+			'exact_match': float(np.mean([x == y for x, y in zip(reference_tags, utterance_tags)])),
+			'agreement': dict(zip(tagging.TAGS, (tag_matrix == reference_matrix).mean(axis=0).tolist())),
+		}
+	return results
+
+
+def format_results(results: dict, reference: str = DEFAULT_REFERENCE) -> str:
+	"""Formats the results of benchmark_taggers as a table, with the agreement of each tag with the reference."""
+	lines = [
+		f"{'Tagger':<10} {'Tests':>6} {'Utt/s':>10} {'p50 (us)':>9} {'p99 (us)':>9} {'Exact':>7} " +
+		' '.join(f"{x[:8]:>8}" for x in tagging.TAGS)]
+	for tagger_name, x in results.items():
+		lines.append(
+			f"{tagger_name:<10} {'pass' if x['tests'] else 'FAIL':>6} {x['utterances_per_s']:>10.0f} {x['p50_us']:>9.1f} "
+			f"{x['p99_us']:>9.1f} {x['exact_match']:>7.2%} " + ' '.join(f"{x['agreement'][tag]:>8.2%}" for tag in tagging.TAGS))
+	lines.append(f"Exact and tag columns are the agreement with the '{reference}' backend")
+	return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the tagger backends')
+	parser.add_argument('--dataset-file', default=None, help='dataset with the utterances to tag, as SIMMC2')
+	parser.add_argument('--scale', type=float, default=1., help='size of the synthetic data if no dataset is given')
+	parser.add_argument('--taggers', nargs='+', default=None, choices=tagging.get_tagger_names(), help='default all')
+	parser.add_argument('--reference', default=DEFAULT_REFERENCE, choices=tagging.get_tagger_names())
+	parser.add_argument('--repeat', type=int, default=1, help='times to repeat the corpus')
+	args = parser.parse_args()
+
+	# the tagging tests are always part of the corpus
+	corpus = list(tagging.load_tagging_tests().keys())
+	if args.dataset_file is not None:
+		corpus += load_corpus(args.dataset_file)
+	else:
+		with tempfile.TemporaryDirectory() as temp_folder:
+			data_summary = synthetic.write_synthetic_data(temp_folder, args.scale, num_models=0)
+			corpus += load_corpus(os.path.join(data_summary['simmc2_folder'], synthetic.DATASET_FILE))
+	corpus *= args.repeat
+
+	print(f"Tagging {len(corpus)} utterances ({len(set(corpus))} unique) with {args.taggers or tagging.get_tagger_names()}")
+	print(format_results(benchmark_taggers(corpus, args.taggers, args.reference), args.reference))
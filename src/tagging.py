@@ -12,6 +12,9 @@ Code released as part of the paper "'What are you referring to?' Evaluating the
 import re
 import json
 from typing import List, Optional
+from collections import OrderedDict
+
+from . import profiling
 
 DEBUG = False
 
@@ -72,21 +75,197 @@ _TAG_KEYWORDS = {
 
 
 def _check_for_keywords_in_utterance(utterance: str, keywords: list):
-	for keyword in keywords:
+	for keywords_checked, keyword in enumerate(keywords, 1):
 		result = re.search(rf"{keyword}([\s,s.?]|$)", utterance, re.IGNORECASE)
 		if result:
+			profiling.count('regexes run', keywords_checked)
 			return result
 	else:
+		profiling.count('regexes run', len(keywords))
 		return None
 
 
+class Tagger:
+	"""
+	Base class of the tagger backends. A backend finds the keywords of each tag in an utterance,
+	and the rules to skip some matches and to combine the tags are the same for all of them.
+	Register new backends with register_tagger and select them with set_default_tagger.
+	"""
+
+	def search_keywords(self, tag: str, utterance: str) -> 'Optional[re.Match]':
+		"""
+		Searches the keywords of a tag in an utterance, in the order of _TAG_KEYWORDS.
+
+		:param tag: the tag, see _TAG_KEYWORDS
+		:param utterance: the utterance
+		:return: the match of the first keyword found, None if none is found
+		"""
+		raise NotImplementedError
+
+	def extract_tags(
+		self, utterance: str, *, gt_referenced_objects=None, fine_grained: bool = False,
+		fine_grained_combined: bool = True, is_ambiguous_utterance: bool = False) -> List[str]:
+		"""Extracts the tags from an utterance, see extract_utterance_tags."""
+		result_tags = []
+
+		# check number of objects first
+		if gt_referenced_objects is not None or '':
+			gt_referenced_objects_length = len(json.loads(gt_referenced_objects))
+			if gt_referenced_objects_length > 3:
+				result_tags.append(f"{gt_referenced_objects_length}-objects")#
+
+		for tag in _TAG_KEYWORDS:
+			# check if any keyword in utterance
+			result = self.search_keywords(tag, utterance)
+			if result:
+				if tag == TAG_PROPERTY and 'what' in utterance[:result.end()]:
+					continue
+				elif tag == TAG_PREVIOUS and 'not' in utterance:
+					continue # skip
+				elif tag in TAG_SPATIAL + TAG_RELATIONAL and 'Could you' in utterance:
+					continue # skip
+				elif tag == TAG_CONFIRMATION and is_ambiguous_utterance:
+					# generally, the initial referential ambiguity utterance does not
+					# contain confirmation words, possibly for previous turns instead
+					continue
+				if DEBUG:
+					print(f"Match for {tag} found at {result.start()}-{result.end()}: {result.group()}")
+				result_tags.append(tag)
+
+		# cluster together
+		combined_tags = []
+		for collection in _TAG_COLLECTION:
+			if any([tag in result_tags for tag in _TAG_COLLECTION[collection]]):
+				combined_tags.append(collection)
+
+		if fine_grained and fine_grained_combined:
+			return sort_tags(result_tags + combined_tags)
+		elif fine_grained and not fine_grained_combined:
+			return sort_tags(result_tags)
+		else:
+			return sort_tags(combined_tags)
+
+
+_TAGGERS = {}
+
+
+def register_tagger(name: str):
+	"""Decorator to register a tagger backend by name, see get_tagger."""
+	def _register(tagger_class):
+		_TAGGERS[name] = tagger_class
+		return tagger_class
+	return _register
+
+
+@register_tagger('regex')
+class RegexTagger(Tagger):
+	"""The original tagger: one regular expression per keyword, searched one by one."""
+
+	def search_keywords(self, tag: str, utterance: str) -> 'Optional[re.Match]':
+		return _check_for_keywords_in_utterance(utterance, _TAG_KEYWORDS[tag])
+
+
+@register_tagger('compiled')
+class CompiledTagger(Tagger):
+	"""
+	Compiles the keywords once: all the keywords of a tag in a single expression, to find quickly
+	whether any is in the utterance, and then one expression per keyword, to find the first keyword
+	that matches as RegexTagger does (its match is used by some rules). It gives the same tags.
+	"""
+
+	def __init__(self):
+		self._tag_patterns = {}
+		self._keyword_patterns = {}
+		for tag, keywords in _TAG_KEYWORDS.items():
+			self._tag_patterns[tag] = re.compile(
+				'|'.join(rf"(?:{keyword}([\s,s.?]|$))" for keyword in keywords), re.IGNORECASE)
+			self._keyword_patterns[tag] = [re.compile(rf"{keyword}([\s,s.?]|$)", re.IGNORECASE) for keyword in keywords]
+
+	def search_keywords(self, tag: str, utterance: str) -> 'Optional[re.Match]':
+		profiling.count('regexes run')
+		if self._tag_patterns[tag].search(utterance) is None:
+			return None
+		for keywords_checked, pattern in enumerate(self._keyword_patterns[tag], 1):
+			result = pattern.search(utterance)
+			if result:
+				profiling.count('regexes run', keywords_checked)
+				return result
+
+
+@register_tagger('cached')
+class CachedTagger(Tagger):
+	"""
+	Keeps the tags of the last utterances tagged by another backend, as the same
+	utterances (e.g., "Which one?") are very common in the dialogues.
+
+	:param backend: name of the backend that tags new utterances
+	:param max_size: maximum number of utterances kept
+	"""
+
+	def __init__(self, backend: str = 'compiled', max_size: int = 2 ** 16):
+		self.backend = get_tagger(backend)
+		self.max_size = max_size
+		self._cache = OrderedDict()
+
+	def search_keywords(self, tag: str, utterance: str) -> 'Optional[re.Match]':
+		return self.backend.search_keywords(tag, utterance)
+
+	def extract_tags(self, utterance: str, **kwargs) -> List[str]:
+		key = (utterance, tuple(sorted(kwargs.items())))
+		if key in self._cache:
+			self._cache.move_to_end(key)
+			profiling.count('tagging cache hits')
+		else:
+			self._cache[key] = tuple(self.backend.extract_tags(utterance, **kwargs))
+			if len(self._cache) > self.max_size:
+				self._cache.popitem(last=False)
+		return list(self._cache[key])
+
+
+def get_tagger_names() -> List[str]:
+	return list(_TAGGERS.keys())
+
+
+def get_tagger(name: str = None, **kwargs) -> Tagger:
+	"""
+	Gets a tagger backend.
+
+	:param name: name of the backend, see get_tagger_names. The default tagger if None, see set_default_tagger
+	:param kwargs: arguments of the backend, e.g., max_size of the cached backend
+	:return: the tagger
+	"""
+	if name is None:
+		return _default_tagger
+	if name not in _TAGGERS:
+		raise ValueError(f"Unknown tagger '{name}', use one of {get_tagger_names()}")
+	return _TAGGERS[name](**kwargs)
+
+
+def set_default_tagger(name: str, **kwargs) -> Tagger:
+	"""
+	Sets the tagger used by extract_utterance_tags, and so by the Clarification Exchanges.
+
+	:param name: name of the backend, see get_tagger_names
+	:param kwargs: arguments of the backend
+	:return: the new default tagger
+	"""
+	global _default_tagger, DEFAULT_TAGGER
+	_default_tagger = get_tagger(name, **kwargs)
+	DEFAULT_TAGGER = name
+	return _default_tagger
+
+
+DEFAULT_TAGGER = 'regex'
+_default_tagger = get_tagger(DEFAULT_TAGGER)
+
+
 def extract_utterance_tags(
 	utterance: str, *, gt_referenced_objects=None, fine_grained: bool = False,
 	fine_grained_combined: bool = True, is_ambiguous_utterance: bool = False) -> List[str]:
 	"""
 	Extracts the tags from an utterance. It should be called in as many utterances
 	as needed in a CE ie., both user ambiguity and system clarification request,
-	as both could contain information.
+	as both could contain information. It uses the default tagger, see set_default_tagger.
 
 	:param utterance: the utterance to extract tags from
 	:param gt_referenced_objects: the ground truth referenced objects, if available
@@ -98,44 +277,9 @@ def extract_utterance_tags(
 		price of the red one?"->confirmation tag will be removed).
 	:return: list of tags
 	"""
-	result_tags = []
-
-	# check number of objects first
-	if gt_referenced_objects is not None or '':
-		gt_referenced_objects_length = len(json.loads(gt_referenced_objects))
-		if gt_referenced_objects_length > 3:
-			result_tags.append(f"{gt_referenced_objects_length}-objects")#
-
-	for tag, keywords in _TAG_KEYWORDS.items():
-		# check if any keyword in utterance
-		result = _check_for_keywords_in_utterance(utterance, keywords)
-		if result:
-			if tag == TAG_PROPERTY and 'what' in utterance[:result.end()]:
-				continue
-			elif tag == TAG_PREVIOUS and 'not' in utterance:
-				continue # skip
-			elif tag in TAG_SPATIAL + TAG_RELATIONAL and 'Could you' in utterance:
-				continue # skip
-			elif tag == TAG_CONFIRMATION and is_ambiguous_utterance:
-				# generally, the initial referential ambiguity utterance does not
-				# contain confirmation words, possibly for previous turns instead
-				continue
-			if DEBUG:
-				print(f"Match for {tag} found at {result.start()}-{result.end()}: {result.group()}")
-			result_tags.append(tag)
-
-	# cluster together
-	combined_tags = []
-	for collection in _TAG_COLLECTION:
-		if any([tag in result_tags for tag in _TAG_COLLECTION[collection]]):
-			combined_tags.append(collection)
-
-	if fine_grained and fine_grained_combined:
-		return sort_tags(result_tags + combined_tags)
-	elif fine_grained and not fine_grained_combined:
-		return sort_tags(result_tags)
-	else:
-		return sort_tags(combined_tags)
+	return _default_tagger.extract_tags(
+		utterance, gt_referenced_objects=gt_referenced_objects, fine_grained=fine_grained,
+		fine_grained_combined=fine_grained_combined, is_ambiguous_utterance=is_ambiguous_utterance)
 
 
 def sort_tags(tags: List[str]) -> List[str]:
@@ -160,10 +304,8 @@ def count_tags(tags: List[str], *, fine_grained: bool = True) -> int:
 	return len(tags)
 
 
-def test_utterance_tagging():
-	"""Tests the utterance tagging with the test set in a file provided."""
-	# tests should be inside src/ but change as needed, print(os.getcwd())
-	test_path = 'src/tagging_tests.json'
+def load_tagging_tests(test_path: str = 'src/tagging_tests.json') -> dict:
+	"""Loads the test set of the tagging, as a dict of utterance -> sorted list of tags."""
 	with open(test_path, 'r') as f_in:
 		utterance_tagging_tests = json.load(f_in)
 
@@ -180,12 +322,19 @@ def test_utterance_tagging():
 			else:
 				test_utterances[utterance] = [tag] if tag != '' else []
 
-	for utterance, tags in test_utterances.items():
-		tags = sort_tags(tags)
+	return {utterance: sort_tags(tags) for utterance, tags in test_utterances.items()}
+
 
+def test_utterance_tagging(tagger: Tagger = None):
+	"""Tests the utterance tagging with the test set in a file provided, with the default tagger if None."""
+	# tests should be inside src/ but change as needed, print(os.getcwd())
+	test_utterances = load_tagging_tests()
+	tagger = tagger or _default_tagger
+
+	for utterance, tags in test_utterances.items():
 		# check utterance and tagging robustness with extra punctuation
 		for utt in [utterance, utterance + '.', utterance + '?']:
-			tags_extracted = extract_utterance_tags(utt, fine_grained=True, fine_grained_combined=False)
+			tags_extracted = tagger.extract_tags(utt, fine_grained=True, fine_grained_combined=False)
 			assert tags == tags_extracted, \
 				f"Test failed in utterance '{utt}'!\n test: {tags}\n found: '{tags_extracted}'"
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Read-only views over the SIMMC2 data, to access it in a different format without copying it.
+"""
+
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+
+class PredictionTurnView(Mapping):
+	"""
+	View over a turn of a model output. It is the same as the turn, but
+	'pred_objects' defaults to the objects in 'transcript_annotated' if the
+	model output does not have them, without adding them to the turn.
+
+	:param turn: the turn of the model output
+	"""
+	__slots__ = ('turn',)
+
+	def __init__(self, turn: dict):
+		self.turn = turn
+
+	def __getitem__(self, key):
+		if key == 'pred_objects' and 'pred_objects' not in self.turn:
+			return self.turn['transcript_annotated']['act_attributes']['objects']
+		return self.turn[key]
+
+	def __iter__(self):
+		yield from self.turn
+		if 'pred_objects' not in self.turn:
+			yield 'pred_objects'
+
+	def __len__(self) -> int:
+		return len(self.turn) + ('pred_objects' not in self.turn)
+
+
+class SingleTurnDialogueView(Mapping):
+	"""
+	View over a dialogue that only has one of its turns, as in the model outputs
+	of the SIMMC2 challenge. All other fields are the ones of the dialogue.
+
+	:param dialogue: the dialogue with all its turns
+	:param turn_index: position of the turn in the dialogue
+	"""
+	__slots__ = ('dialogue', 'turn_index')
+
+	def __init__(self, dialogue: dict, turn_index: int):
+		self.dialogue, self.turn_index = dialogue, turn_index
+
+	def __getitem__(self, key):
+		if key == 'dialogue':
+			return (PredictionTurnView(self.dialogue['dialogue'][self.turn_index]),)
+		return self.dialogue[key]
+
+	def __iter__(self):
+		return iter(self.dialogue)
+
+	def __len__(self) -> int:
+		return len(self.dialogue)
+
+
+class _SingleTurnDialogueList(Sequence):
+	"""List of SingleTurnDialogueView, created on access from the turn offsets."""
+
+	def __init__(self, dialogue_data: list, dialogue_positions: np.ndarray, turn_positions: np.ndarray):
+		self.dialogue_data = dialogue_data
+		self.dialogue_positions, self.turn_positions = dialogue_positions, turn_positions
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		return SingleTurnDialogueView(
+			self.dialogue_data[self.dialogue_positions[index]], int(self.turn_positions[index]))
+
+	def __len__(self) -> int:
+		return len(self.dialogue_positions)
+
+
+class SingleTurnDatasetView(Mapping):
+	"""
+	View over a model output where each dialogue has all its turns, which exposes it
+	as one dialogue per turn (the format of the SIMMC2 challenge) without copying
+	the dialogues or modifying the original data. Only the position of each turn is stored.
+
+	:param dataset: the model output, in the same format as SIMMC2
+	"""
+
+	def __init__(self, dataset: dict):
+		self.dataset = dataset
+		turn_counts = np.array([len(x['dialogue']) for x in dataset['dialogue_data']], dtype=np.int64)
+		dialogue_positions = np.repeat(np.arange(len(turn_counts), dtype=np.int32), turn_counts)
+		# position of each turn in its dialogue, from the global position minus the start of its dialogue
+		turn_positions = np.arange(len(dialogue_positions), dtype=np.int64) - \
+			np.repeat(np.cumsum(turn_counts) - turn_counts, turn_counts)
+		self.dialogue_data = _SingleTurnDialogueList(
+			dataset['dialogue_data'], dialogue_positions, turn_positions.astype(np.int32))
+
+	def __getitem__(self, key):
+		if key == 'dialogue_data':
+			return self.dialogue_data
+		return self.dataset[key]
+
+	def __iter__(self):
+		return iter(self.dataset)
+
+	def __len__(self) -> int:
+		return len(self.dataset)
+
+	def iterate_turns(self):
+		"""
+		Yields the (dialogue, turn) of each turn, see iterate_over_dataset_entries.
+		Dialogues are the original ones, with all their turns.
+		"""
+		for dialogue_datum in self.dataset['dialogue_data']:
+			for turn_datum in dialogue_datum['dialogue']:
+				yield dialogue_datum, PredictionTurnView(turn_datum)
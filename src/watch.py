@@ -0,0 +1,92 @@
+#!/usr/bin/env python3.7
+# -*- coding: utf-8 -*-
+"""
+    Author : Javier Chiyah-Garcia
+    GitHub : https://github.com/JChiyah/what-are-you-referring-to
+    Date   : August 2023
+    Python : 3.7+
+
+Code released as part of the paper "'What are you referring to?' Evaluating the Ability of Multi-Modal Dialogue Models to Process Clarificational Exchanges" accepted at SIGDIAL'23.
+
+Polling of the model folders to find new or changed model output files, e.g., while models are training.
+"""
+
+import os
+import time
+from typing import Dict
+
+from .registry import ModelRegistry
+
+
+DEFAULT_PATTERN = 'coref-pred-*.json'
+DEFAULT_INTERVAL = 10   # seconds between polls
+
+
+def _get_file_signature(file_path: str):
+	try:
+		file_stat = os.stat(file_path)
+	except OSError:     # removed since it was found
+		return None
+	return file_stat.st_mtime_ns, file_stat.st_size
+
+
+class PredictionFileWatcher:
+	"""
+	Finds new or changed model output files by polling the model folders of a registry.
+	A file is only reported once its size and modification time are the same in two
+	polls in a row, so files that are still being written are not read half-way.
+
+	:param model_registry: registry with the folder and the models to watch
+	:param pattern: glob pattern of the model output files
+	:param known_files: dict of output name -> file already evaluated, they are only
+		reported if they change. Any other file found in the first poll is reported as new
+	"""
+
+	def __init__(self, model_registry: ModelRegistry, pattern: str = DEFAULT_PATTERN, known_files: dict = None):
+		self.model_registry = model_registry
+		self.pattern = pattern
+		# file -> signature of the files already reported
+		self._reported = {x: _get_file_signature(x) for x in (known_files or {}).values()}
+		# file -> signature of the files changed in the last poll, waiting to settle
+		self._pending = {}
+
+	def poll(self) -> Dict[str, str]:
+		"""
+		Checks the model folders once.
+
+		:return: dict of output name -> file of the new or changed files, sorted by name
+		"""
+		changed_files = {}
+		pending = {}
+		for output_name, file_path in self.model_registry.discover_files(self.pattern).items():
+			signature = _get_file_signature(file_path)
+			if signature is None or self._reported.get(file_path) == signature:
+				continue
+			if self._pending.get(file_path) == signature:
+				changed_files[output_name] = file_path
+				self._reported[file_path] = signature
+			else:
+				pending[file_path] = signature     # new or still changing, check again in the next poll
+
+		self._pending = pending
+		return changed_files
+
+	def watch(self, callback, interval: float = DEFAULT_INTERVAL, max_polls: int = None) -> None:
+		"""
+		Polls the model folders until interrupted, calling a function with the changed files.
+
+		:param callback: function that takes the dict of output name -> file of the changed files
+		:param interval: seconds between polls
+		:param max_polls: stop after this number of polls, default never
+		"""
+		polls = 0
+		try:
+			while max_polls is None or polls < max_polls:
+				changed_files = self.poll()
+				if len(changed_files) > 0:
+					callback(changed_files)
+				polls += 1
+				if max_polls is None or polls < max_polls:
+					time.sleep(interval)
+		except KeyboardInterrupt:
+			pass